@@ -0,0 +1,29 @@
+# Start the server first:
+#   python -m whisperspeech.serve --port 8080
+import json
+import struct
+import time
+import http.client
+
+conn = http.client.HTTPConnection('127.0.0.1', 8080)
+request = dict(text="This is a test of the WhisperSpeech server.", lang='en', cps=15, format='wav')
+start = time.time()
+conn.request('POST', '/synthesize', body=json.dumps(request), headers={'Content-Type': 'application/json'})
+response = conn.getresponse()
+if response.status != 200:
+    raise SystemExit(f"{response.status}: {response.read().decode()}")
+
+save_path = 'output.wav'
+with open(save_path, 'wb') as f:
+    received = 0
+    # the audio is streamed while it is generated, so we can save (or play) it chunk by chunk
+    while chunk := response.read1(65536):
+        f.write(chunk)
+        # the first 44 bytes are the WAV header
+        if received <= 44 < received + len(chunk): print(f"first audio after {time.time() - start:.2f} s")
+        received += len(chunk)
+    # the server does not know the length in advance so we fix the sizes in the WAV header
+    size = f.tell()
+    f.seek(4); f.write(struct.pack('<I', size - 8))
+    f.seek(40); f.write(struct.pack('<I', size - 44))
+print(f"saved {save_path} after {time.time() - start:.2f} s")
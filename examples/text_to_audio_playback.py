@@ -38,15 +38,14 @@ sentences = re.split(r'[.!?;]+\s*', input_text)
 audio_queue = queue.Queue()
 
 def process_text_to_audio(sentences, pipe):
-    for sentence in sentences:  # Iterate through each sentence
-        if sentence:  # Ensure the sentence is not empty
-            audio_tensor = pipe.generate(sentence)  # Generate audio tensor for the sentence
-            audio_np = (audio_tensor.cpu().numpy() * 32767).astype(np.int16)  # Convert tensor to numpy array, scale, and cast to int16
-            if len(audio_np.shape) == 1:  # Check if the numpy array is 1D
-                audio_np = np.expand_dims(audio_np, axis=0)  # Add a new dimension to make it 2D
-            else:
-                audio_np = audio_np.T  # Transpose the numpy array if it's not 1D
-            audio_queue.put(audio_np)  # Put the audio numpy array into the queue
+    # T2S, S2A and the vocoder work on different sentences at the same time
+    for audio_tensor in pipe.generate_pipelined([x for x in sentences if x]):  # Skip the empty sentences
+        audio_np = (audio_tensor.cpu().numpy() * 32767).astype(np.int16)  # Convert tensor to numpy array, scale, and cast to int16
+        if len(audio_np.shape) == 1:  # Check if the numpy array is 1D
+            audio_np = np.expand_dims(audio_np, axis=0)  # Add a new dimension to make it 2D
+        else:
+            audio_np = audio_np.T  # Transpose the numpy array if it's not 1D
+        audio_queue.put(audio_np)  # Put the audio numpy array into the queue
     audio_queue.put(None)  # Signal that processing is complete
 
 def play_audio_from_queue(audio_queue):
@@ -0,0 +1,75 @@
+import torch
+import pytest
+from types import SimpleNamespace
+
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer, Tunables as T2STunables
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer, Tunables as S2ATunables
+
+# tiny models with random weights, enough to check the inference code paths on the CPU
+# (`optimize` gets a dict of `optimize` arguments, the models run in fp32 without `torch.compile` by default)
+
+def _optimize(model, optimize):
+    if optimize is not None: model.optimize(**dict(dict(dtype=torch.float32, torch_compile=False), **optimize))
+    return model
+
+@pytest.fixture
+def make_t2s():
+    def make(seed=0, optimize=None, early_eot=False, **kwargs):
+        torch.manual_seed(seed)
+        kwargs = dict(dict(depth=2, n_head=3, ttoks_len=550, stoks_len=750, stoks_codes=513), **kwargs)
+        model = _optimize(TSARTransformer(**kwargs, tunables=T2STunables()).eval(), optimize)
+        if early_eot:
+            # make the end of text token likely so the texts finish at different steps
+            torch.manual_seed(5)
+            emb = model.embeddings.embedding.merged_out
+            emb[513] += torch.randn_like(emb[513]) * 2
+        return model
+    return make
+
+@pytest.fixture
+def make_s2a():
+    def make(seed=0, optimize=None, **kwargs):
+        torch.manual_seed(seed)
+        kwargs = dict(dict(depth=2, n_head=3, ctx_n=2250, stoks_len=750, stoks_codes=513, quantizers=4, spk_width=192), **kwargs)
+        return _optimize(SADelARTransformer(**kwargs, tunables=S2ATunables()).eval(), optimize)
+    return make
+
+@pytest.fixture
+def speaker():
+    torch.manual_seed(1)
+    return torch.randn(192)
+
+@pytest.fixture
+def stoks():
+    # semantic tokens of a few lengths (below the 512 codes of the tiny S2A model)
+    torch.manual_seed(0)
+    return [torch.randint(0, 512, (n,)) for n in [10, 25, 7, 18]]
+
+@pytest.fixture
+def make_vocoder():
+    def make(seed=0):
+        # Vocos with random weights and the EnCodec codebooks only (like in a bundle)
+        from whisperspeech.a2wav import Vocoder
+        from whisperspeech.bundle import _encodec_features
+        from vocos import Vocos
+        from vocos.pretrained import instantiate_class
+        torch.manual_seed(seed)
+        config = dict(backbone = dict(class_path='vocos.models.VocosBackbone',
+                                      init_args=dict(input_channels=128, dim=384, intermediate_dim=1152, num_layers=8, adanorm_num_embeddings=4)),
+                      head = dict(class_path='vocos.heads.ISTFTHead', init_args=dict(dim=384, n_fft=1280, hop_length=320, padding="same")))
+        fe = _encodec_features(torch.randn(8 * 1024, 128), bins=1024, bandwidths=[1.5, 3.0, 6.0, 12.0])
+        vocos = Vocos(fe, instantiate_class(args=(), init=config['backbone']), instantiate_class(args=(), init=config['head']))
+        return Vocoder(device='cpu', vocos=vocos.eval(), config=config)
+    return make
+
+@pytest.fixture
+def pipe(make_t2s, make_s2a, make_vocoder, tmp_path):
+    # a Pipeline with the tiny models loaded from a bundle, the T2S model stops after 40 tokens
+    from whisperspeech.bundle import save_bundle
+    from whisperspeech.pipeline import Pipeline
+    models = SimpleNamespace(t2s=make_t2s(stoks_len=40, optimize=dict(max_batch_size=2)), s2a=make_s2a(optimize=dict(max_batch_size=2)),
+                             vocoder=make_vocoder())
+    save_bundle(models, tmp_path/'bundle.safetensors')
+    pipe = Pipeline(bundle=tmp_path/'bundle.safetensors', device='cpu')
+    yield pipe
+    if pipe.batcher is not None: pipe.batcher.close()
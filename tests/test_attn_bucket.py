@@ -0,0 +1,16 @@
+import torch
+
+def test_t2s_attn_bucket(make_t2s):
+    ref = make_t2s(optimize=dict(max_batch_size=1)).generate("Hello world", T=0, N=40, show_progress_bar=False)
+    t2s = make_t2s(optimize=dict(max_batch_size=1, attn_bucket=16))
+    lengths = []
+    step = lambda: lengths.append(t2s.decoder.layers[0].attn.kv_cache.length)
+    # attending only to the filled part of the KV cache gives the same tokens
+    assert torch.equal(t2s.generate("Hello world", T=0, N=40, show_progress_bar=False, step=step), ref)
+    assert lengths[0] == 16 and lengths[-1] == 48
+    assert t2s.decoder.layers[0].attn.kv_cache.length is None
+
+def test_s2a_attn_bucket(make_s2a, speaker, stoks):
+    ref = make_s2a(optimize=dict(max_batch_size=1)).generate(stoks[1], speaker.unsqueeze(0), T=0, show_progress_bar=False)
+    s2a = make_s2a(optimize=dict(max_batch_size=1, attn_bucket=16))
+    assert torch.equal(s2a.generate(stoks[1], speaker.unsqueeze(0), T=0, show_progress_bar=False), ref)
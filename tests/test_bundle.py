@@ -0,0 +1,33 @@
+import pytest
+import torch
+from types import SimpleNamespace
+
+from whisperspeech.bundle import save_bundle, load_bundle, bundle_contents
+
+@pytest.mark.parametrize('optimize', [
+    dict(),
+    dict(quantize='int8'),
+    dict(quantize='int4', kv_block_size=16),
+    dict(kv_dtype=torch.int8),
+], ids=['plain', 'int8', 'int4-paged', 'int8-kv'])
+def test_bundle_round_trip(optimize, speaker, make_t2s, make_s2a, make_vocoder, tmp_path):
+    t2s_optimize = dict(optimize, max_batch_size=2)
+    if 'kv_dtype' in optimize: t2s_optimize['ttoks_buckets'] = [64, 128]
+    pipe = SimpleNamespace(t2s=make_t2s(optimize=t2s_optimize, early_eot=True),
+                           s2a=make_s2a(optimize=dict(optimize, max_batch_size=2)), vocoder=make_vocoder())
+    save_bundle(pipe, tmp_path/'bundle.safetensors')
+    t2s, s2a, vocoder = load_bundle(tmp_path/'bundle.safetensors', device='cpu')
+    # with greedy sampling the loaded models give exactly the same tokens
+    stoks = pipe.t2s.generate("Hello world", T=0, N=20, show_progress_bar=False)
+    assert torch.equal(t2s.generate("Hello world", T=0, N=20, show_progress_bar=False), stoks)
+    stoks = stoks[0].clamp(max=511)
+    atoks = pipe.s2a.generate(stoks, speaker.unsqueeze(0), T=0, N=20, show_progress_bar=False)
+    assert torch.equal(s2a.generate(stoks, speaker.unsqueeze(0), T=0, N=20, show_progress_bar=False), atoks)
+    assert torch.equal(vocoder.decode(atoks), pipe.vocoder.decode(atoks))
+
+def test_bundle_contents_shares_tensors(make_t2s, make_s2a, make_vocoder):
+    pipe = SimpleNamespace(t2s=make_t2s(optimize=dict()), s2a=make_s2a(optimize=dict()), vocoder=make_vocoder())
+    t2s, _, _ = load_bundle(bundle_contents(pipe), device='cpu')
+    # the models loaded from `bundle_contents` use the same weights (e.g. in shared memory)
+    for (name, p), p2 in zip(pipe.t2s.named_parameters(), t2s.parameters()):
+        assert p.data_ptr() == p2.data_ptr(), name
@@ -0,0 +1,22 @@
+import torch
+import torch.nn as nn
+import torch._inductor.compile_fx as compile_fx
+from torch._inductor import config as inductor_config
+
+from whisperspeech import inference
+
+def test_compile_freezing(monkeypatch):
+    calls = []
+    freezing_compiler = compile_fx.fw_compiler_freezing
+    def spy(*args, **kwargs):
+        calls.append(1)
+        return freezing_compiler(*args, **kwargs)
+    monkeypatch.setattr(compile_fx, 'fw_compiler_freezing', spy)
+    linear = nn.Linear(16, 16).eval()
+    fun = inference.compile(lambda x: linear(x), 'cpu')
+    x = torch.randn(2, 16)
+    with torch.no_grad(): y = fun(x)
+    assert torch.allclose(y, linear(x))
+    # the weights were frozen into this graph but the setting did not leak into the global config
+    assert calls
+    assert not inductor_config.freezing
@@ -0,0 +1,54 @@
+import torch
+
+from whisperspeech.continuous_batching import T2SScheduler, S2AScheduler
+
+# with greedy sampling all the batched code paths should give exactly the same tokens as `generate`
+
+TXTS = ['Hello world', 'Second text is a little bit longer.', 'Third', 'Fourth one']
+
+def test_t2s_scheduler(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=3), early_eot=True)
+    Ns = [30, 50, 20, 40]
+    scheduler = T2SScheduler(t2s, T=0)
+    reqs = [scheduler.submit(txt, N=N) for txt, N in zip(TXTS, Ns)]
+    scheduler.run()
+    for txt, N, req in zip(TXTS, Ns, reqs):
+        assert torch.equal(req.stoks, t2s.generate(txt, N=N, T=0, show_progress_bar=False)[0])
+
+def test_s2a_scheduler(speaker, make_s2a, stoks):
+    s2a = make_s2a(optimize=dict(max_batch_size=3))
+    speakers = [speaker * (i + 1) for i in range(len(stoks))]
+    scheduler = S2AScheduler(s2a, T=0)
+    reqs = [scheduler.submit(x, spk) for x, spk in zip(stoks, speakers)]
+    scheduler.run()
+    for x, spk, req in zip(stoks, speakers, reqs):
+        assert torch.equal(req.atoks, s2a.generate(x, spk.unsqueeze(0), T=0, show_progress_bar=False)[0])
+
+def test_s2a_scheduler_chunks(speaker, make_s2a, stoks):
+    s2a = make_s2a(optimize=dict(max_batch_size=3))
+    scheduler = S2AScheduler(s2a, T=0)
+    reqs = [scheduler.submit(x, speaker, chunk_len=16) for x in stoks[:2]]
+    chunks = [[] for _ in reqs]
+    while scheduler.busy:
+        scheduler.step()
+        for req, xs in zip(reqs, chunks):
+            while req.chunks: xs.append(req.chunks.pop(0))
+    for req, xs in zip(reqs, chunks):
+        assert torch.equal(torch.cat(xs, -1), req.atoks)
+
+def test_scheduler_cancel(speaker, make_t2s, make_s2a, stoks):
+    t2s = make_t2s(optimize=dict(max_batch_size=2), early_eot=True)
+    scheduler = T2SScheduler(t2s, T=0)
+    running, kept, queued = [scheduler.submit(txt, N=30) for txt in TXTS[:3]]
+    scheduler.step()
+    assert scheduler.cancel(queued) and scheduler.cancel(running) and not scheduler.cancel(running)
+    scheduler.run()
+    assert not running.done and not queued.done
+    assert torch.equal(kept.stoks, t2s.generate(TXTS[1], N=30, T=0, show_progress_bar=False)[0])
+    s2a = make_s2a(optimize=dict(max_batch_size=2))
+    scheduler = S2AScheduler(s2a, T=0)
+    running, kept = [scheduler.submit(x, speaker) for x in stoks[:2]]
+    scheduler.step()
+    assert scheduler.cancel(running)
+    scheduler.run()
+    assert torch.equal(kept.atoks, s2a.generate(kept.stoks, speaker.unsqueeze(0), T=0, show_progress_bar=False)[0])
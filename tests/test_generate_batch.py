@@ -0,0 +1,31 @@
+import torch
+
+TXTS = ['Hello world', 'Second text is a little bit longer.', 'Third', 'Fourth one']
+
+def test_t2s_generate_batch(make_t2s):
+    # with greedy sampling every text gets the same tokens as with `generate`
+    t2s = make_t2s(optimize=dict(max_batch_size=3), early_eot=True)
+    langs, cpss = ['en', 'pl', 'en', 'de'], [15, 12, 10, 18]
+    out = t2s.generate_batch(TXTS, cps=cpss, lang=langs, T=0, N=40, show_progress_bar=False)
+    for txt, lang, cps, stoks in zip(TXTS, langs, cpss, out):
+        assert torch.equal(stoks, t2s.generate(txt, cps=cps, lang=lang, T=0, N=40, show_progress_bar=False)[0])
+
+def test_t2s_generate_batch_retires_rows(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=2), early_eot=True)
+    eot = t2s.stoks_codes + t2s.tunables.padding_token_offset
+    generate_next = t2s.generate_next
+    def short_first_row(toks, positions, *args, **kwargs):
+        next_toks = generate_next(toks, positions, *args, **kwargs)
+        # the texts in the first row end after 3 tokens
+        if positions[0,0] == 3: next_toks[0] = eot
+        return next_toks
+    t2s.generate_next = short_first_row
+    steps = []
+    out = t2s.generate_batch(TXTS, T=0, N=40, show_progress_bar=False, step=lambda: steps.append(1))
+    assert [len(x) for x in out] == [3, 12, 3, 3]
+    # the first row is refilled with the next texts while the second one is still decoding
+    assert len(steps) == 13
+
+def test_t2s_generate_batch_progress_bar(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=2), early_eot=True)
+    assert len(t2s.generate_batch(TXTS[:3], T=0, N=20)) == 3
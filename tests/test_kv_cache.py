@@ -0,0 +1,36 @@
+import torch
+
+def _cache_bytes(model):
+    return sum(x.nbytes for l in model.decoder.layers for x in l.attn.kv_cache.tensors)
+
+def test_int8_kv_cache(make_t2s, make_s2a, speaker, stoks):
+    t2s = make_t2s(optimize=dict(max_batch_size=2, dtype=torch.bfloat16))
+    t2s_int8 = make_t2s(optimize=dict(max_batch_size=2, dtype=torch.bfloat16, kv_dtype=torch.int8))
+    assert t2s_int8.decoder.layers[0].attn.kv_cache.k_cache.dtype == torch.int8
+    # the int8 cache with its scales takes (a bit more than) half of the memory of the bf16 one
+    assert _cache_bytes(t2s_int8) < 0.6 * _cache_bytes(t2s)
+    # with greedy sampling the tiny models give the same tokens
+    ref = t2s.generate("Hello world", T=0, N=20, show_progress_bar=False)
+    assert torch.equal(t2s_int8.generate("Hello world", T=0, N=20, show_progress_bar=False), ref)
+    s2a = make_s2a(optimize=dict(max_batch_size=1, kv_dtype=torch.int8))
+    atoks = s2a.generate(stoks[0], speaker.unsqueeze(0), T=0, show_progress_bar=False)
+    assert atoks.shape[:2] == (1, 4)
+
+def test_paged_kv_cache(make_t2s, make_s2a, speaker, stoks):
+    from whisperspeech.continuous_batching import T2SScheduler, S2AScheduler
+    txts = ['Hello world', 'Second text is a little bit longer.', 'Third']
+    t2s = make_t2s(optimize=dict(max_batch_size=2), early_eot=True)
+    paged = make_t2s(optimize=dict(max_batch_size=2, kv_block_size=16), early_eot=True)
+    kv_blocks = paged.decoder.kv_blocks
+    # the pool starts smaller than a full cache, the blocks are only handed out when the rows need them
+    assert _cache_bytes(paged) < 0.6 * _cache_bytes(t2s)
+    assert torch.equal(paged.generate(txts[0], T=0, N=40, show_progress_bar=False), t2s.generate(txts[0], T=0, N=40, show_progress_bar=False))
+    assert kv_blocks.used_blocks == 0
+    ref = T2SScheduler(t2s, T=0).generate(txts, N=40)
+    for x, y in zip(T2SScheduler(paged, T=0).generate(txts, N=40), ref): assert torch.equal(x, y)
+    assert kv_blocks.used_blocks == 0 and 0 < kv_blocks.peak_blocks <= 2 * 3
+    s2a = make_s2a(optimize=dict(max_batch_size=2))
+    paged = make_s2a(optimize=dict(max_batch_size=2, kv_block_size=16))
+    ref = S2AScheduler(s2a, T=0).generate(stoks, [speaker] * len(stoks))
+    for x, y in zip(S2AScheduler(paged, T=0).generate(stoks, [speaker] * len(stoks)), ref): assert torch.equal(x, y)
+    assert paged.decoder.kv_blocks.used_blocks == 0
@@ -0,0 +1,35 @@
+import os
+import pytest
+import torch
+
+from whisperspeech import inference
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason="needs /proc/self/maps")
+
+def _mmapped(fname):
+    # the address ranges where `fname` is mapped into our process
+    ranges = []
+    with open('/proc/self/maps') as f:
+        for line in f:
+            if line.rstrip().endswith(str(fname)):
+                start, end = [int(x, 16) for x in line.split()[0].split('-')]
+                ranges.append((start, end))
+    return lambda t: any(start <= t.untyped_storage().data_ptr() < end for start, end in ranges)
+
+def _mmapped_fraction(model, fname):
+    is_mmapped = _mmapped(fname)
+    params = list(model.parameters())
+    return sum(p.nbytes for p in params if is_mmapped(p)) / sum(p.nbytes for p in params)
+
+def test_load_safetensors_mmap(make_t2s, tmp_path):
+    from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+    inference.save_safetensors(make_t2s(), tmp_path/'t2s.safetensors')
+    t2s = TSARTransformer.load_model(local_filename=str(tmp_path/'t2s.safetensors'), device='cpu')
+    assert _mmapped_fraction(t2s, tmp_path/'t2s.safetensors') == 1
+
+def test_pipeline_bundle_mmap(pipe, tmp_path):
+    # the bundle stores the weights in the layout and dtype `optimize` produces so they are used as they are
+    fname = tmp_path/'bundle.safetensors'
+    assert _mmapped_fraction(pipe.t2s, fname) == 1
+    assert _mmapped_fraction(pipe.s2a, fname) == 1
+    assert _mmapped_fraction(pipe.vocoder.vocos, fname) == 1
@@ -0,0 +1,14 @@
+import pytest
+
+@pytest.mark.parametrize('text', ['', '  \n '])
+def test_generate_long_empty(pipe, text):
+    assert pipe.generate_long(text).shape == (1, 0)
+
+def test_generate_long(pipe, monkeypatch):
+    # the tiny T2S model only fits about 20 characters into a chunk
+    batch_sizes = []
+    decode_batch = pipe.vocoder.decode_batch
+    monkeypatch.setattr(pipe.vocoder, 'decode_batch', lambda atokss: batch_sizes.append(len(atokss)) or decode_batch(atokss))
+    audio = pipe.generate_long("Hello world. This is a test. And another sentence.")
+    assert len(batch_sizes) == 1 and batch_sizes[0] > 1
+    assert audio.shape[0] == 1 and audio.shape[1] > 0
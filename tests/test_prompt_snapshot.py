@@ -0,0 +1,31 @@
+import torch
+
+from whisperspeech.continuous_batching import T2SScheduler, S2AScheduler
+
+def test_t2s_prompt_snapshot(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=2), early_eot=True)
+    txt, prompt = "Hello world", torch.randint(0, 512, (6,))
+    snapshot = t2s.prefill_prompt(txt, prompt)
+    # restoring the snapshot gives the same tokens as prefilling the prompt for every request
+    ref = t2s.generate(txt, stoks_prompt=prompt, T=0, N=40, show_progress_bar=False)
+    assert torch.equal(t2s.generate(txt, prompt_snapshot=snapshot, T=0, N=40, show_progress_bar=False), ref)
+    scheduler = T2SScheduler(t2s, T=0)
+    reqs = [scheduler.submit(txt, N=40, prompt_snapshot=snapshot) for _ in range(3)]
+    scheduler.run()
+    for req in reqs: assert torch.equal(req.stoks, ref[0])
+
+def test_s2a_prompt_snapshot(make_s2a, speaker, stoks):
+    s2a = make_s2a(optimize=dict(max_batch_size=2))
+    torch.manual_seed(0)
+    prompt = torch.randint(0, 1024, (1, 4, 5))
+    spk = speaker.unsqueeze(0)
+    snapshot = s2a.prefill_prompt(stoks[1], spk, prompt)
+    ref = s2a.generate(stoks[1], spk, atoks_prompt=prompt, T=0, show_progress_bar=False)
+    assert torch.equal(s2a.generate(stoks[1], spk, prompt_snapshot=snapshot, T=0, show_progress_bar=False), ref)
+    # the scheduler keeps the delayed prompt tokens of the higher quantizers (`generate` samples them again)
+    # so we compare it with itself
+    scheduler = S2AScheduler(s2a, T=0)
+    ref = scheduler.submit(stoks[1], speaker, atoks_prompt=prompt)
+    reqs = [scheduler.submit(stoks[1], speaker, prompt_snapshot=snapshot) for _ in range(2)]
+    scheduler.run()
+    for req in reqs: assert torch.equal(req.atoks, ref.atoks)
@@ -0,0 +1,30 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from whisperspeech.modules import QuantizedLinear
+
+@pytest.mark.parametrize('quantize', [None, 'int8', 'int4', 'dynamic'])
+def test_optimize_quantize_generate(quantize, speaker, make_t2s, make_s2a):
+    t2s = make_t2s(optimize=dict(max_batch_size=1, quantize=quantize))
+    stoks = t2s.generate("Hello world", T=0, N=12, show_progress_bar=False)
+    assert stoks.shape[0] == 1 and len(stoks[0]) > 0
+    s2a = make_s2a(optimize=dict(max_batch_size=1, quantize=quantize))
+    atoks = s2a.generate(stoks[0].clamp(max=511), speaker.unsqueeze(0), T=0, N=12, show_progress_bar=False)
+    assert atoks.shape[:2] == (1, 4)
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize('bits, kernel', [(8, 'aten::_weight_int8pack_mm'), (4, 'aten::_weight_int4pack_mm_for_cpu')])
+def test_quantized_linear_fused_kernels(bits, kernel, dtype):
+    torch.manual_seed(0)
+    linear = nn.Linear(256, 384)
+    q = QuantizedLinear.from_linear(linear, bits=bits)
+    x = torch.randn(3, 256, dtype=dtype)
+    # the reference dequantizes the weights
+    ref = F.linear(x.float(), q.unpack().float()) * q.scales + q.bias
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+        y = q(x)
+    assert kernel in {e.name for e in prof.events()}
+    assert y.dtype == dtype
+    assert (y.float() - ref).abs().max() < 0.02 * ref.abs().max()
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+import torch
+from concurrent.futures import CancelledError
+
+from whisperspeech.request_batching import RequestBatcher
+
+def test_cancel_the_future_before_decoding(pipe):
+    batcher = RequestBatcher(pipe, T=0)
+    try:
+        cancelled, kept = [batcher.submit("Hello world.", pipe.default_speaker) for _ in range(2)]
+        assert cancelled.future.cancel()
+        assert kept.future.result(timeout=120).shape[-1] > 0
+    finally:
+        batcher.close()
+
+def test_cancel_while_decoding(pipe):
+    batcher = RequestBatcher(pipe, T=0)
+    try:
+        streaming = batcher.submit("Hello world.", pipe.default_speaker, chunk_len=10)
+        cancelled, kept = [batcher.submit("Hello world.", pipe.default_speaker) for _ in range(2)]
+        next(streaming.atoks_chunks())
+        batcher.cancel(streaming)
+        batcher.cancel(cancelled)
+        list(streaming.atoks_chunks()) # the stream ends
+        with pytest.raises(CancelledError): cancelled.future.result(timeout=120)
+        assert kept.future.result(timeout=120).shape[-1] > 0
+    finally:
+        batcher.close()
+
+def test_agenerate_timeout(pipe):
+    async def main():
+        kept = asyncio.ensure_future(pipe.agenerate("Hello world."))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(pipe.agenerate("Hello world."), timeout=0.1)
+        return await asyncio.wait_for(kept, timeout=120)
+    assert asyncio.run(main()).shape[-1] > 0
+
+def test_agenerate_stream_close(pipe):
+    cancelled = []
+    batcher = pipe._batcher()
+    cancel = batcher.cancel
+    batcher.cancel = lambda req: cancelled.append(req) or cancel(req)
+    async def main():
+        stream = pipe.agenerate_stream("Hello world. This is a longer text.", chunk_len=10)
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first
+    assert asyncio.run(main()).shape[-1] > 0
+    assert len(cancelled) == 1 and cancelled[0].cancelled
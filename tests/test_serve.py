@@ -0,0 +1,58 @@
+import json
+import threading
+import http.client
+import pytest
+import torch
+
+from whisperspeech.serve import SynthesisServer
+
+@pytest.fixture
+def server(pipe):
+    pipe.speaker_cache.register('alice', torch.randn(192))
+    server = SynthesisServer(pipe, ('127.0.0.1', 0), max_queue=2)
+    server.batcher.T = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _request(server, method, path, body=None, headers={}):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=120)
+    conn.putrequest(method, path)
+    if isinstance(body, (dict, list)): body = json.dumps(body).encode()
+    headers = dict({'Content-Type': 'application/json', 'Content-Length': str(len(body or b''))}, **headers)
+    for k,v in headers.items(): conn.putheader(k, v)
+    conn.endheaders(body)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+def test_serve_health(server):
+    assert _request(server, 'GET', '/health') == (200, b'{"status": "ok"}\n')
+    assert _request(server, 'GET', '/nothing')[0] == 404
+
+@pytest.mark.parametrize('body', [[1], {}, {'text': ' '}, {'text': 'hi', 'lang': 'xx'}, {'text': 'hi', 'cps': 100},
+                                  {'text': 'hi', 'speaker': 'bob'}, {'text': 'hi', 'format': 'mp3'}, b'{not json'])
+def test_serve_bad_request(server, body):
+    assert _request(server, 'POST', '/synthesize', body)[0] == 400
+
+@pytest.mark.parametrize('length', ['abc', '-1', '99999999'])
+def test_serve_bad_content_length(server, length):
+    assert _request(server, 'POST', '/synthesize', {'text': 'hi'}, headers={'Content-Length': length})[0] == 400
+
+def test_serve_stream(server, monkeypatch):
+    vocoder = server.pipe.vocoder
+    stitch_stream, fragments = vocoder.stitch_stream, []
+    def spy(streams, **kwargs):
+        streams = list(streams)
+        fragments.append(len(streams))
+        return stitch_stream(streams, **kwargs)
+    monkeypatch.setattr(vocoder, 'stitch_stream', spy)
+    status, data = _request(server, 'POST', '/synthesize', {'text': "Hello world. This is a test. And another sentence.", 'speaker': 'alice'})
+    assert status == 200
+    assert data[:4] == b'RIFF' and len(data) > 44 and (len(data) - 44) % 2 == 0
+    # the audio of all the text fragments is crossfaded into one stream
+    assert fragments[0] > 1
+    metrics = _request(server, 'GET', '/metrics')[1].decode()
+    assert 'whisperspeech_requests_total{outcome="completed"} 1' in metrics
+    assert 'whisperspeech_queue_depth 0' in metrics
@@ -0,0 +1,31 @@
+import threading
+import torch
+
+TXTS = ['Hello world', 'Second text is a little bit longer.', 'Third', 'Fourth one']
+
+# with greedy sampling the concurrent calls should give exactly the same tokens as `generate`
+
+def test_sessions(speaker, make_t2s, make_s2a, stoks):
+    t2s, s2a = make_t2s(optimize=dict(max_batch_size=1), early_eot=True), make_s2a(optimize=dict(max_batch_size=1))
+    refs = [(t2s.generate(txt, T=0, N=30, show_progress_bar=False)[0], s2a.generate(x, speaker.unsqueeze(0), T=0, N=30, show_progress_bar=False)[0])
+            for txt, x in zip(TXTS, stoks)]
+    out = [None] * len(TXTS)
+    def work(i):
+        t2s_session, s2a_session = t2s.new_session(), s2a.new_session()
+        for j in range(i, len(TXTS), 2):
+            out[j] = (t2s.generate(TXTS[j], T=0, N=30, show_progress_bar=False, session=t2s_session)[0],
+                      s2a.generate(stoks[j], speaker.unsqueeze(0), T=0, N=30, show_progress_bar=False, session=s2a_session)[0])
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(2)]
+    for th in threads: th.start()
+    for th in threads: th.join()
+    for (ref_stoks, ref_atoks), (out_stoks, out_atoks) in zip(refs, out):
+        assert torch.equal(out_stoks, ref_stoks) and torch.equal(out_atoks, ref_atoks)
+
+def test_pipeline_max_sessions(pipe):
+    pipe.max_sessions = 1
+    with pipe._session() as first, pipe._session() as second, pipe._session() as third:
+        # the first caller gets the default caches, the concurrent ones get their own
+        assert first == (None, None)
+        assert second[0] is not None and second[0] is not third[0]
+    # the default caches are always kept, the extra ones only up to `max_sessions`
+    assert pipe.free_sessions == [third, (None, None)]
@@ -0,0 +1,39 @@
+import torch
+
+from whisperspeech.speaker_cache import SpeakerCache, file_hash
+
+def test_speaker_cache(tmp_path):
+    cache = SpeakerCache(tmp_path/'speakers.npz', maxsize=2)
+    emb = torch.randn(192)
+    cache.put('abc', emb)
+    cache.register('alice', emb * 2)
+    assert torch.equal(cache.get('abc'), emb)
+    assert torch.equal(cache.get_named('alice'), emb * 2)
+    assert cache.get('alice') is None and cache.get_named('abc') is None
+    # the embeddings are kept on disk for other processes (and restarts)
+    other = SpeakerCache(tmp_path/'speakers.npz')
+    assert torch.equal(other.get('abc'), emb)
+    assert other.names == ['alice']
+
+def test_speaker_cache_lru():
+    cache = SpeakerCache(maxsize=2)
+    for i in range(3): cache.put(str(i), torch.full((192,), float(i)))
+    assert cache.get('0') is None
+    assert cache.get('2') is not None
+
+def test_extract_spk_emb_cache(pipe, tmp_path, monkeypatch):
+    calls = []
+    def extract(fname):
+        calls.append(fname)
+        return torch.randn(192)
+    monkeypatch.setattr(pipe, '_extract_spk_emb', extract)
+    (tmp_path/'a.wav').write_bytes(b'some audio')
+    (tmp_path/'b.wav').write_bytes(b'some audio')
+    emb = pipe.extract_spk_emb(tmp_path/'a.wav')
+    # the files are identified by their contents
+    assert torch.equal(pipe.extract_spk_emb(tmp_path/'b.wav'), emb)
+    assert len(calls) == 1
+    assert torch.equal(pipe.speaker_cache.get(file_hash(tmp_path/'a.wav')), emb)
+    pipe.register_speaker('bob', tmp_path/'a.wav')
+    assert torch.equal(pipe.get_speaker('bob'), emb)
+    assert len(calls) == 1
@@ -0,0 +1,24 @@
+import torch
+
+from whisperspeech import inference
+
+def test_speculative_greedy(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=1), early_eot=True)
+    ref = t2s.generate("Hello world", T=0, N=40, show_progress_bar=False)
+    # with greedy sampling the result does not depend on the draft model, only the number of accepted tokens does
+    for draft, all_accepted in [(make_t2s(optimize=dict(max_batch_size=1), early_eot=True), True),
+                                (make_t2s(seed=1, depth=1, optimize=dict(max_batch_size=1)), False)]:
+        stoks = t2s.generate_speculative("Hello world", draft, k=4, T=0, N=40)
+        assert torch.equal(stoks, ref)
+        stats = t2s.speculative_stats
+        assert (stats['accepted'] == stats['drafted']) == all_accepted
+
+def test_speculative_sample_distribution():
+    torch.manual_seed(0)
+    logits, draft_logits = torch.randn(2, 6), torch.randn(1, 6)
+    counts = torch.zeros(6)
+    for _ in range(4000):
+        draft_tok = inference.sample(draft_logits, T=1.0)[0]
+        counts[inference.speculative_sample(logits, draft_logits, draft_tok, T=1.0)[0]] += 1
+    # the first token follows the target model distribution
+    assert (counts / counts.sum() - logits[0].softmax(-1)).abs().max() < 0.03
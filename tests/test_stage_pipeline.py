@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+from whisperspeech.stage_pipeline import StagePipeline
+
+def test_stage_pipeline_order():
+    stages = [lambda x: x + 1, lambda x: x * 2, str]
+    assert list(StagePipeline(stages, queue_size=1).map(range(10))) == [str((x + 1) * 2) for x in range(10)]
+
+def test_stage_pipeline_thread_budgets():
+    prev = torch.get_num_threads()
+    budget = lambda x: x + [torch.get_num_threads()]
+    out = list(StagePipeline([budget, budget, budget], threads=[3, 1, 2]).map([[]] * 4))
+    assert out == [[3, 1, 2]] * 4
+    # the budgets only apply to the stage threads
+    assert torch.get_num_threads() == prev
+
+def test_stage_pipeline_failure():
+    def fail(x):
+        if x == 3: raise ValueError(x)
+        return x
+    results = []
+    with pytest.raises(ValueError):
+        for x in StagePipeline([fail, lambda x: x]).map(range(10)): results.append(x)
+    assert results == [0, 1, 2]
@@ -0,0 +1,18 @@
+import torch
+
+def test_ttoks_buckets(make_t2s):
+    t2s = make_t2s(optimize=dict(max_batch_size=1, ttoks_buckets=[16, 64, 128]), early_eot=True)
+    lengths = []
+    run_encoder = t2s.run_encoder
+    def spy(in_ttoks, *args):
+        lengths.append(in_ttoks.shape[-1])
+        return run_encoder(in_ttoks, *args)
+    t2s.run_encoder = spy
+    txt = "A text that needs the second bucket."
+    bucketed = t2s.generate(txt, T=0, N=20, show_progress_bar=False)
+    # the text (with the start and end tokens) does not fit into 16 bytes
+    assert lengths == [64]
+    # the padding is masked so the result does not depend on the bucket
+    t2s.ttoks_buckets = [128]
+    assert torch.equal(t2s.generate(txt, T=0, N=20, show_progress_bar=False), bucketed)
+    assert lengths == [64, 128]
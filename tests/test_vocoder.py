@@ -0,0 +1,18 @@
+import torch
+
+def test_stitch_stream(make_vocoder):
+    vocoder = make_vocoder()
+    torch.manual_seed(0)
+    # streams of chunks with different lengths, some of them shorter than the crossfade (or empty)
+    lengths = [[500, 3000, 100], [700], [], [2500, 2500], [30, 40, 5000]]
+    streams = [[torch.randn(1, n) for n in stream] for stream in lengths]
+    expected = vocoder.stitch([torch.cat(stream, dim=-1) for stream in streams if stream], overlap=6)
+    chunks = list(vocoder.stitch_stream(iter(stream) for stream in streams))
+    assert torch.allclose(torch.cat(chunks, dim=-1), expected)
+    # only the end of a stream waits for the next one
+    started = []
+    def stream(i):
+        started.append(i)
+        yield from streams[i]
+    first = next(vocoder.stitch_stream(stream(i) for i in range(len(streams))))
+    assert started == [0] and first.shape[-1] == 3500 - 6 * 320
@@ -0,0 +1,38 @@
+import os
+import sys
+import time
+import signal
+import pytest
+import torch
+
+from whisperspeech.worker_pool import core_groups, WorkerPool
+
+def test_core_groups():
+    assert core_groups(2, cores=range(5)) == [[0, 1, 2], [3, 4]]
+    assert core_groups(3, cores=[4, 5]) == [[4], [5], [4]]
+
+def _wait_for(cond, timeout=60):
+    start = time.monotonic()
+    while not cond():
+        assert time.monotonic() - start < timeout
+        time.sleep(0.05)
+
+@pytest.mark.skipif(sys.platform == 'win32', reason="needs POSIX signals")
+def test_worker_pool_dead_worker(pipe):
+    with WorkerPool(pipe, workers=2) as pool:
+        assert pool.map(["Hello world."], speaker=None)[0].shape[0] == 1
+        stopped, other = pool.workers
+        # the stopped worker gets the next request (the idle workers are served in order) and cannot finish it
+        os.kill(stopped.process.pid, signal.SIGSTOP)
+        lost = pool.submit("Lost request.")
+        _wait_for(lambda: stopped.future is lost)
+        os.kill(stopped.process.pid, signal.SIGKILL)
+        with pytest.raises(RuntimeError, match="worker process died"):
+            lost.result(timeout=60)
+        # the pool goes on with the other worker
+        _wait_for(lambda: pool.workers == [other])
+        assert pool.submit("Next request.").result(timeout=120).shape[0] == 1
+        os.kill(other.process.pid, signal.SIGKILL)
+        _wait_for(lambda: not pool.workers)
+        with pytest.raises(RuntimeError, match="all the worker processes died"):
+            pool.submit("No workers left.")
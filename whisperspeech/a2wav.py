@@ -4,18 +4,27 @@
 __all__ = ['Vocoder']
 
 # %% ../nbs/6. Quality-boosting vocoder.ipynb 1
-from vocos import Vocos
 from whisperspeech import inference
+import itertools
 import torch
-import torchaudio
 
 # %% ../nbs/6. Quality-boosting vocoder.ipynb 2
 class Vocoder:
-    def __init__(self, repo_id="charactr/vocos-encodec-24khz", device=None):
+    def __init__(self, repo_id="charactr/vocos-encodec-24khz", device=None, vocos=None, config=None):
         if device is None: device = inference.get_compute_device()
         if device == 'mps': device = 'cpu' # mps does not currently work with vocos, thus only cuda or cpu
         self.device = device
-        self.vocos = Vocos.from_pretrained(repo_id).to(device)
+        if vocos is None:
+            # vocos (with torchaudio and EnCodec) and huggingface_hub take a while to import
+            import yaml
+            from vocos import Vocos
+            from huggingface_hub import hf_hub_download
+            vocos = Vocos.from_pretrained(repo_id)
+            # already downloaded by `from_pretrained`, we keep it to be able to save the vocoder in a bundle
+            with open(hf_hub_download(repo_id=repo_id, filename="config.yaml")) as f:
+                config = yaml.safe_load(f)
+        self.vocos = vocos.to(device)
+        self.config = config
 
     def is_notebook(self):
         try:
@@ -37,8 +46,82 @@ class Vocoder:
         features = self.vocos.codes_to_features(atoks)
         bandwidth_id = torch.tensor({2: 0, 4: 1, 8: 2}[q]).to(self.device)  # Move tensor to the same device as model
         return self.vocos.decode(features, bandwidth_id=bandwidth_id)
+
+    @torch.no_grad()
+    def decode_stream(self, atoks_chunks, overlap=12):
+        """Vocodes consecutive chunks of acoustic tokens and yields the audio as soon as it is ready.
+
+        Every chunk is decoded together with the last `overlap` frames of the previous ones and the
+        overlapping audio is crossfaded to hide the chunk boundaries."""
+        hop = 320 # samples per EnCodec frame at 24kHz
+        history, tail = None, None
+        for atoks in atoks_chunks:
+            if atoks.shape[-1] == 0: continue
+            window = atoks if history is None else torch.cat([history, atoks.to(history.device)], dim=-1)
+            audio = self.decode(window)
+            if tail is not None:
+                n = tail.shape[-1]
+                fade = torch.linspace(0, 1, n, device=audio.device)
+                audio = torch.cat([tail * (1 - fade) + audio[..., :n] * fade, audio[..., n:]], dim=-1)
+            # hold back the end of the window to crossfade it with the next one
+            history = window[..., -overlap:]
+            keep = history.shape[-1] * hop
+            tail = audio[..., -keep:]
+            if audio.shape[-1] > keep: yield audio[..., :-keep]
+        if tail is not None: yield tail
+        
+    @torch.no_grad()
+    def decode_batch(self, atoks_list, batch_size=16):
+        """Vocodes a list of acoustic token sequences of different lengths, `batch_size` at a time.
+
+        Returns a list of `(1, samples)` audio tensors."""
+        hop = 320 # samples per EnCodec frame at 24kHz
+        audios = []
+        for i in range(0, len(atoks_list), batch_size):
+            group = atoks_list[i:i+batch_size]
+            t = max(x.shape[-1] for x in group)
+            # pad by repeating the last frame, the extra audio is cut off below
+            batch = torch.stack([torch.cat([x, x[:,-1:].expand(-1, t - x.shape[-1])], dim=-1) for x in group])
+            audio = self.decode(batch)
+            audios += [audio[j:j+1,:x.shape[-1] * hop] for j,x in enumerate(group)]
+        return audios
+
+    def stitch(self, audios, overlap=6):
+        """Concatenates audio fragments, crossfading them over `overlap` EnCodec frames."""
+        hop = 320 # samples per EnCodec frame at 24kHz
+        out = audios[0]
+        for audio in audios[1:]:
+            n = min(overlap * hop, out.shape[-1], audio.shape[-1])
+            fade = torch.linspace(0, 1, n, device=audio.device)
+            out = torch.cat([out[...,:out.shape[-1]-n], out[...,out.shape[-1]-n:] * (1 - fade) + audio[...,:n] * fade, audio[...,n:]], dim=-1)
+        return out
+
+    def stitch_stream(self, audio_streams, overlap=6):
+        """Like `stitch` but for a sequence of audio streams (e.g. from `decode_stream`), yields the audio as soon as
+        it is final. The last `overlap` frames of every stream are held back until the next one starts."""
+        hop = 320 # samples per EnCodec frame at 24kHz
+        keep = overlap * hop
+        out = None # the audio we did not yield yet
+        for stream in audio_streams:
+            stream = iter(stream)
+            if out is not None:
+                # we need the first `overlap` frames of the next stream to crossfade it with the end of the previous one
+                head = []
+                for audio in stream:
+                    head.append(audio)
+                    if sum(x.shape[-1] for x in head) >= keep: break
+                if not head: continue
+                stream = itertools.chain([self.stitch([out, torch.cat(head, dim=-1)], overlap=overlap)], stream)
+                out = None
+            for audio in stream:
+                out = audio if out is None else torch.cat([out, audio], dim=-1)
+                if out.shape[-1] > keep:
+                    yield out[...,:-keep]
+                    out = out[...,-keep:]
+        if out is not None: yield out
         
     def decode_to_file(self, fname, atoks):
+        import torchaudio
         audio = self.decode(atoks)
         torchaudio.save(fname, audio.cpu(), 24000)
         if self.is_notebook():
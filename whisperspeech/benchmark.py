@@ -5,10 +5,18 @@ __all__ = []
 
 # %% ../nbs/C. Benchmark.ipynb 2
 import time
+import sys
+import copy
+import subprocess
 import torch
+import torch.nn.functional as F
 from fastcore.script import call_parse
 from whisperspeech.pipeline import Pipeline
 from whisperspeech.inference import get_compute_device
+from whisperspeech import inference
+from whisperspeech.continuous_batching import T2SScheduler, S2AScheduler
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech.worker_pool import WorkerPool
 
 # %% ../nbs/C. Benchmark.ipynb 3
 def measure(fun, iterations = 10):
@@ -21,6 +29,237 @@ def measure(fun, iterations = 10):
     ts = torch.tensor(ts)
     return ts.mean(), ts.std()
 
+# %% ../nbs/C. Benchmark.ipynb 4
+def t2s_decoding_step(t2s, txt, cps=15, lang='en', bs=1):
+    """Runs the T2S encoder on `txt` and returns a function that runs a single decoding step at a given position."""
+    t2s.ensure_tokenizer()
+    dev = t2s.device
+    ttoks, cpss, langs = t2s.prep(txt, cps=cps, lang=lang)
+    xenc, xenc_positions, cps_emb = t2s.run_encoder(ttoks, langs, cpss)
+    xenc = xenc.expand(bs, -1, -1)
+    toks = torch.zeros((bs,1), dtype=torch.long, device=dev)
+    positions = torch.arange(t2s.stoks_len, device=dev)
+    T = torch.tensor(0.7, device=dev)
+    def step(i):
+        t2s.decoder.reserve_kv_cache(bs, i+1)
+        return t2s.generate_next(toks, positions[i:i+1], cps_emb, xenc, xenc_positions, T, None)
+    return step, xenc, xenc_positions
+
+def s2a_decoding_step(s2a, stoks, speaker, bs=1):
+    """Runs the S2A encoder on `stoks` and returns a function that runs a single decoding step at a given position."""
+    dev = s2a.device
+    stoks = F.pad(stoks.to(dev), (1, s2a.stoks_len - len(stoks) - 1), value=s2a.stoks_codes-1).unsqueeze(0)
+    speakers = speaker.to(device=dev, dtype=s2a.dtype).unsqueeze(0)
+    xenc, xenc_positions, _ = s2a.run_encoder(stoks, speakers)
+    xenc = xenc.expand(bs, -1, -1)
+    toks = torch.full((bs,s2a.quantizers,1), s2a.codes+1, dtype=torch.long, device=dev)
+    positions = torch.arange(s2a.ctx_n, device=dev)
+    T = torch.tensor(0.7, device=dev)
+    def step(i):
+        s2a.decoder.reserve_kv_cache(bs, i+1)
+        return s2a.generate_next(toks, positions[i:i+1], None, xenc, xenc_positions, T, None)
+    return step, xenc, xenc_positions
+
+@torch.no_grad()
+def measure_cross_kv_cache(model, step, xenc, xenc_positions, positions=range(1,101), iterations=10):
+    """Measures the per-token decoding time with and without the cross-attention K/V cache."""
+    run = lambda: [step(i) for i in positions]
+    run() # warmup
+    uncached, _ = measure(run, iterations=iterations)
+    model.decoder.prime_cross_kv_cache(xenc[:1], xenc_positions) # the batch rows share the same input
+    try:
+        run() # warmup (torch.compile specializes on the cache state)
+        cached, _ = measure(run, iterations=iterations)
+    finally:
+        model.decoder.invalidate_cross_kv_cache()
+    return uncached / len(positions), cached / len(positions)
+
+@torch.no_grad()
+def measure_attention_bound(model, step, xenc, xenc_positions, attn_bucket, positions, iterations=10):
+    """Measures the per-token decoding time at different positions, first with the self-attention over the
+    whole KV cache and then bounded to its filled part (rounded up to `attn_bucket`)."""
+    old_bucket = model.decoder.attn_bucket
+    model.decoder.prime_cross_kv_cache(xenc[:1], xenc_positions) # the batch rows share the same input
+    results = []
+    try:
+        for bucket in [None, attn_bucket]:
+            model.decoder.attn_bucket = bucket
+            ts = []
+            for i in positions:
+                model.decoder.bound_self_attention(i+1)
+                step(i) # warmup (torch.compile traces a new graph for every bucket)
+                ts.append(measure(lambda: step(i), iterations=iterations)[0])
+            results.append(ts)
+    finally:
+        model.decoder.attn_bucket = old_bucket
+        model.decoder.bound_self_attention(None)
+        model.decoder.invalidate_cross_kv_cache()
+    return results
+
+def measure_prompt_snapshot(generate, prompt_kwargs, snapshot, iterations=10):
+    """Measures the latency of `generate(**prompt_kwargs)` and of `generate(prompt_snapshot=snapshot)`."""
+    results = []
+    for kwargs in [prompt_kwargs, dict(prompt_snapshot=snapshot)]:
+        generate(**kwargs) # warmup
+        results.append(measure(lambda: generate(**kwargs), iterations=iterations))
+    return results
+
+def measure_stream(pipe, txt, iterations=10, **kwargs):
+    """Measures the time-to-first-chunk and the total time of `Pipeline.generate_stream`."""
+    ttfcs, totals = [], []
+    for x in range(iterations):
+        start = time.time()
+        for i,chunk in enumerate(pipe.generate_stream(txt, **kwargs)):
+            chunk = chunk.cpu() # waits for the computation to finish
+            if i == 0: ttfcs.append(time.time() - start)
+        totals.append(time.time() - start)
+    ttfcs, totals = torch.tensor(ttfcs), torch.tensor(totals)
+    return (ttfcs.mean(), ttfcs.std()), (totals.mean(), totals.std())
+
+def measure_throughput(fun, iterations=10):
+    """Measures the throughput of `fun` which should return the list of generated token sequences."""
+    ts, ns = [], []
+    for x in range(iterations):
+        start = time.time()
+        outputs = fun()
+        getattr(torch, get_compute_device()).synchronize()
+        ts.append(time.time() - start)
+        ns.append(sum(x.numel() for x in outputs))
+    return sum(ns) / sum(ts)
+
+def measure_worker_pool(pipe, txts, workers, iterations=3, torch_compile=False):
+    """Measures the throughput of a `WorkerPool` with `workers` processes generating all the `txts`,
+    returns the requests per second and the seconds of audio generated per second."""
+    with WorkerPool(pipe, workers=workers, torch_compile=torch_compile) as pool:
+        pool.map(txts) # warmup
+        start = time.time()
+        samples = sum(audio.shape[-1] for x in range(iterations) for audio in pool.map(txts))
+        elapsed = time.time() - start
+    return len(txts) * iterations / elapsed, samples / 24000 / elapsed
+
+def measure_speculative(t2s, draft, txt, draft_tokens=4, iterations=10):
+    """Measures the T2S throughput without and with speculative decoding (see `TSARTransformer.generate_speculative`),
+    also returns the fraction of the draft tokens that were accepted."""
+    drafted, accepted = 0, 0
+    def speculative():
+        nonlocal drafted, accepted
+        out = t2s.generate(txt, draft=draft, draft_tokens=draft_tokens)
+        drafted += t2s.speculative_stats['drafted']
+        accepted += t2s.speculative_stats['accepted']
+        return [out]
+    regular = lambda: [t2s.generate(txt, show_progress_bar=False)]
+    regular(); speculative() # warmup
+    drafted, accepted = 0, 0
+    return measure_throughput(regular, iterations=iterations), measure_throughput(speculative, iterations=iterations), accepted / max(drafted, 1)
+
+def cpu_profiles(torch_compile=True):
+    """The `optimize` settings worth comparing on the CPU: fp16 (the GPU default), fp32, bf16 (only with native
+    bf16 support) and dynamic int8 quantization, each with and without `torch.compile`."""
+    dtypes = {'fp16': torch.float16, 'fp32': torch.float32}
+    if inference.cpu_dtype() == torch.bfloat16: dtypes['bf16'] = torch.bfloat16
+    profiles = {name: dict(dtype=dtype) for name, dtype in dtypes.items()}
+    profiles['int8 dynamic'] = dict(quantize='dynamic')
+    return {f"{name}{' compiled' if c else ''}": dict(kwargs, torch_compile=c)
+            for c in ([False, True] if torch_compile else [False]) for name, kwargs in profiles.items()}
+
+def measure_profiles(t2s, s2a, txt, stoks, speaker, profiles, iterations=10):
+    """Measures the T2S and S2A generation time with every `optimize` settings in `profiles` (a dict of name → kwargs).
+
+    `t2s` and `s2a` should not be optimized yet, we optimize a copy of them for every profile."""
+    results = {}
+    for name, kwargs in profiles.items():
+        # every profile compiles new copies of the same functions, we don't want to hit the recompilation limit
+        torch.compiler.reset()
+        t, s = copy.deepcopy(t2s), copy.deepcopy(s2a)
+        t.optimize(**kwargs)
+        s.optimize(**kwargs)
+        def run_t2s(): return t.generate(txt, show_progress_bar=False)
+        def run_s2a(): return s.generate(stoks, speaker.unsqueeze(0), show_progress_bar=False)
+        # warmup (and compilation)
+        run_t2s()
+        run_s2a()
+        results[name] = measure(run_t2s, iterations=iterations), measure(run_s2a, iterations=iterations)
+    return results
+
+def weight_quantization_profiles(torch_compile=True):
+    """The default CPU dtype (see `inference.cpu_dtype`) with full precision, int8 and int4 weights."""
+    dtype = inference.cpu_dtype()
+    return {name: dict(dtype=dtype, quantize=quantize, torch_compile=torch_compile)
+            for name, quantize in [({torch.bfloat16: 'bf16', torch.float32: 'fp32'}[dtype], None), ('int8', 'int8'), ('int4', 'int4')]}
+
+def measure_token_agreement(t2s, s2a, txt, stoks, speaker, profiles):
+    """Decodes greedily with every profile and returns the fraction of T2S and S2A tokens that match the fp32 model.
+
+    The decoding follows its own output so everything after the first mismatch can differ, this makes it
+    a pessimistic quality measure."""
+    def generate(kwargs):
+        t, s = copy.deepcopy(t2s), copy.deepcopy(s2a)
+        t.optimize(**dict(kwargs, torch_compile=False))
+        s.optimize(**dict(kwargs, torch_compile=False))
+        return (t.generate(txt, T=0, show_progress_bar=False),
+                s.generate(stoks, speaker.unsqueeze(0), T=0, show_progress_bar=False))
+    def agreement(a, b):
+        n = min(a.shape[-1], b.shape[-1])
+        return (a[...,:n] == b[...,:n]).float().mean().item()
+    ref_stoks, ref_atoks = generate(dict(dtype=torch.float32))
+    results = {}
+    for name, kwargs in profiles.items():
+        out_stoks, out_atoks = generate(kwargs)
+        results[name] = agreement(out_stoks, ref_stoks), agreement(out_atoks, ref_atoks)
+    return results
+
+def kv_cache_bytes_per_slot(model):
+    """Returns the memory used by the self- and cross-attention K/V caches of one batch row."""
+    caches = [l.attn.kv_cache for l in model.decoder.layers] + [l.cross_attn.kv_cache for l in model.decoder.layers if l.cross_attn]
+    total = sum(t.numel() * t.element_size() for c in caches for t in c.tensors)
+    return total // caches[0].k_cache.shape[0]
+
+def paged_kv_cache_usage(model):
+    """Returns the peak memory used by the paged self-attention K/V caches (see `BaseDecoder.setup_kv_cache`)
+    and the memory regular caches with the same number of rows would take."""
+    kvb = model.decoder.kv_blocks
+    caches = [l.attn.kv_cache for l in model.decoder.layers]
+    per_block = sum(t.numel() * t.element_size() for c in caches for t in c.tensors) // kvb.num_blocks
+    return kvb.peak_blocks * per_block, kvb.table.numel() * per_block
+
+def print_paged_kv_cache_usage(name, model):
+    paged, dense = paged_kv_cache_usage(model)
+    print(f"{name} self-attention K/V cache: {paged/2**20:.1f} MB at peak with blocks of {model.decoder.kv_blocks.block_size}, {dense/2**20:.1f} MB without paging ({dense/paged:.1f}x)")
+
+def measure_kv_cache_budget(model, fun, budget, kv_dtype=None, iterations=10, **kwargs):
+    """Finds the largest batch size with K/V caches that fit in `budget` bytes and measures the throughput of
+    `fun(model, bs)` at this batch size. `model` should not be optimized yet, we optimize a copy of it."""
+    probe = copy.deepcopy(model)
+    probe.optimize(max_batch_size=1, kv_dtype=kv_dtype, **dict(kwargs, torch_compile=False))
+    per_slot = kv_cache_bytes_per_slot(probe)
+    del probe
+    bs = int(budget // per_slot)
+    assert bs > 0, f"a single batch row needs {per_slot/2**20:.1f} MB of K/V cache"
+    torch.compiler.reset()
+    model = copy.deepcopy(model)
+    model.optimize(max_batch_size=bs, kv_dtype=kv_dtype, **kwargs)
+    fun(model, bs) # warmup
+    return per_slot, bs, measure_throughput(lambda: fun(model, bs), iterations=iterations)
+
+def measure_import_time(module='whisperspeech.pipeline', top=10):
+    """Imports `module` in a fresh interpreter with `-X importtime`, returns the total import time and the `top`
+    slowest packages (cumulative, in seconds)."""
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True, check=True).stderr
+    # the imports are listed after all their dependencies, the indentation shows the nesting
+    children = {}
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        name, t = name.strip(), int(cumulative) / 1e6
+        if depth == 1: children[name] = t
+        elif depth == 0:
+            if name == module: return t, sorted(children.items(), key=lambda x: -x[1])[:top]
+            children = {}
+    raise ValueError(f"{module} not found in the -X importtime output")
+
+# %% ../nbs/C. Benchmark.ipynb 5
 @call_parse
 def benchmark(
     t2s_ref='collabora/whisperspeech:t2s-small-en+pl.model',
@@ -31,27 +270,112 @@ def benchmark(
     s2a_ctx_n : int = None,
     t2s_ctx_n : int = None,
     iterations = 10,
+    device : str = None, # the compute device (e.g. `cpu`), autodetected by default
+    cross_kv_cache : bool = False, # compare the per-token decoding time with and without the cross-attention K/V cache
+    stream : bool = False, # measure the time-to-first-chunk of `Pipeline.generate_stream`
+    stream_chunk_len : int = 75, # the chunk length (in EnCodec frames) used for streaming
+    draft_ref : str = None, # compare the T2S throughput with speculative decoding using this (smaller) draft T2S model
+    draft_tokens : int = 4, # the number of tokens the draft model proposes in every speculative decoding round
+    pipelined : bool = False, # compare generating sentences one by one with the overlapped T2S, S2A and vocoder stages of `Pipeline.generate_pipelined`
+    stage_threads : str = None, # comma separated CPU thread budgets of the T2S, S2A and vocoder stages (e.g. `4,8,2`)
+    prompt_snapshot : bool = False, # compare the latency of generating with a voice prompt and with a prefilled prompt snapshot
+    continuous_batching : bool = False, # compare the T2S throughput of the continuous batching scheduler with `generate(bs=max_batch_size)`
+    ttoks_buckets : str = None, # comma separated T2S encoder length buckets (e.g. `64,128,256`)
+    attn_bucket : int = None, # bound the decoder self-attention to the filled part of the KV cache (in multiples of this) and compare the per-token time at different positions
+    kv_dtype : str = None, # the K/V cache dtype (`int8`)
+    kv_block_size : int = None, # page the self-attention K/V caches in blocks of this many positions (with `continuous_batching` compare the peak memory use with regular caches)
+    kv_cache_budget : float = None, # compare the memory per batch slot and the throughput at the largest batch size that fits in this many GB of K/V caches with the default and int8 caches (best combined with `attn_bucket`)
+    import_time : bool = False, # only measure how long `import whisperspeech.pipeline` takes (and which packages are the slowest)
+    startup : bool = False, # only measure the `Pipeline` startup time with sequential and parallel model loading
+    cpu_profile : bool = False, # only compare the real-time factor of the CPU inference options (dtypes, dynamic int8 quantization, torch.compile)
+    weight_quantization : bool = False, # only compare the speed and the token agreement (with fp32) of the int8 and int4 weights on the CPU
+    worker_pool : str = None, # only compare the CPU throughput of `WorkerPool` with these comma separated numbers of worker processes (e.g. `1,2,4,8`)
 ):
+    if import_time:
+        total, slowest = measure_import_time()
+        print(f"import whisperspeech.pipeline: {total:.3f} s")
+        for name, t in slowest: print(f"  {name:40s} {t:.3f} s")
+        return
+
     max_batch_size = max_batch_size or batch_size
+    if device: inference.preferred_device = device
+    if kv_dtype: kv_dtype = getattr(torch, kv_dtype)
+
+    if startup:
+        # the first load downloads the models and warms up the page cache
+        Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False, device=device)
+        for parallel_load in [False, True]:
+            pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, device=device, torch_compile=not no_torch_compile,
+                            max_batch_size=max_batch_size, parallel_load=parallel_load)
+            stages = "  ".join(f"{k}: {v:.3f} s" for k,v in pipe.startup_times.items() if k != 'total')
+            print(f"Startup ({'parallel' if parallel_load else 'sequential'}): {pipe.startup_times['total']:.3f} s    {stages}")
+        return
+
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False, device=device)
+
+    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+    stoks = torch.zeros(250)
+    t = len(stoks)/25
+
+    if cpu_profile:
+        results = measure_profiles(pipe.t2s, pipe.s2a, txt, stoks, pipe.default_speaker, cpu_profiles(not no_torch_compile), iterations=iterations)
+        base = sum(mean for (mean, std) in results['fp16'])
+        for name, ((t2s_mean, t2s_std), (s2a_mean, s2a_std)) in results.items():
+            total = t2s_mean + s2a_mean
+            print(f"{name:22s}  T2S: {t2s_mean:.3f} ± {t2s_std:.3f} s    S2A: {s2a_mean:.3f} ± {s2a_std:.3f} s    RTF: {total/t:.3f} ({base/total:.2f}x vs fp16)")
+        return
+
+    if worker_pool:
+        # the workers compile their own models (and warm up), we do not run anything here
+        pipe.t2s.optimize(max_batch_size=1, torch_compile=False)
+        pipe.s2a.optimize(max_batch_size=1, torch_compile=False)
+        counts = [int(x) for x in worker_pool.split(',')]
+        txts = [txt] * 2 * max(counts)
+        base = None
+        for n in counts:
+            rps, audio_rate = measure_worker_pool(pipe, txts, n, iterations=iterations, torch_compile=not no_torch_compile)
+            base = base or rps
+            print(f"{n:3d} workers: {rps:.2f} requests/s, {audio_rate:.1f} s of audio per second ({rps/base:.2f}x)")
+        return
+
+    if kv_cache_budget:
+        runs = [
+            ("T2S", pipe.t2s, lambda model, bs: list(model.generate(txt, bs=bs, show_progress_bar=False))),
+            ("S2A", pipe.s2a, lambda model, bs: list(model.generate(stoks, pipe.default_speaker.unsqueeze(0), bs=bs, show_progress_bar=False))),
+        ]
+        for name, model, fun in runs:
+            for cache_dtype in [None, torch.int8]:
+                per_slot, bs, throughput = measure_kv_cache_budget(model, fun, kv_cache_budget * 2**30, kv_dtype=cache_dtype,
+                                                                   iterations=iterations, torch_compile=not no_torch_compile, attn_bucket=attn_bucket)
+                label = 'int8' if cache_dtype else 'default'
+                print(f"{name} {label:7s} K/V cache: {per_slot/2**20:.1f} MB per slot, max batch size {bs}, {throughput:.1f} tokens/s")
+        return
 
-    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False)
+    if weight_quantization:
+        profiles = weight_quantization_profiles(not no_torch_compile)
+        results = measure_profiles(pipe.t2s, pipe.s2a, txt, stoks, pipe.default_speaker, profiles, iterations=iterations)
+        agreements = measure_token_agreement(pipe.t2s, pipe.s2a, txt, stoks, pipe.default_speaker, profiles)
+        base = sum(mean for (mean, std) in next(iter(results.values())))
+        for name, ((t2s_mean, t2s_std), (s2a_mean, s2a_std)) in results.items():
+            total = t2s_mean + s2a_mean
+            t2s_agreement, s2a_agreement = agreements[name]
+            print(f"{name:5s}  T2S: {t2s_mean:.3f} ± {t2s_std:.3f} s    S2A: {s2a_mean:.3f} ± {s2a_std:.3f} s    RTF: {total/t:.3f} ({base/total:.2f}x)"
+                  f"    tokens matching fp32: T2S {t2s_agreement:.1%} S2A {s2a_agreement:.1%}")
+        return
 
     if t2s_ctx_n:
         pipe.t2s.stoks_len = t2s_ctx_n
         pipe.t2s.decoder.mask = torch.empty(t2s_ctx_n, t2s_ctx_n).fill_(-torch.inf).triu_(1).to(get_compute_device())
     
-    pipe.t2s.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile)
+    if ttoks_buckets: ttoks_buckets = [int(x) for x in ttoks_buckets.split(',')]
+    pipe.t2s.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile, ttoks_buckets=ttoks_buckets, attn_bucket=attn_bucket, kv_dtype=kv_dtype, kv_block_size=kv_block_size)
 
     if s2a_ctx_n:
         pipe.s2a.ctx_n = s2a_ctx_n
         pipe.s2a.decoder.mask = torch.empty(s2a_ctx_n, s2a_ctx_n).fill_(-torch.inf).triu_(1).to(get_compute_device())
 
-    pipe.s2a.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile)
+    pipe.s2a.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile, attn_bucket=attn_bucket, kv_dtype=kv_dtype, kv_block_size=kv_block_size)
 
-    txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
-    stoks = torch.zeros(250)
-    t = len(stoks)/25
-    
     def t2s():
         return pipe.t2s.generate(txt, bs=batch_size, show_progress_bar=False)
     def s2a():
@@ -65,3 +389,76 @@ def benchmark(
     s2a_mean, s2a_std = measure(s2a, iterations=iterations)
     print(f"T2S: {t2s_mean:.3f} ± {t2s_std:.3f} s    S2A: {s2a_mean:.3f} ± {s2a_std:.3f} s    Total: {t2s_mean+s2a_mean:.3f} s")
     print(f"     {t/t2s_mean:.2f}x                  {t/s2a_mean:.2f}x                    {t/(t2s_mean+s2a_mean):.2f}x")
+
+    if cross_kv_cache:
+        for name, model, (step, xenc, xenc_positions) in [
+            ("T2S", pipe.t2s, t2s_decoding_step(pipe.t2s, txt, bs=batch_size)),
+            ("S2A", pipe.s2a, s2a_decoding_step(pipe.s2a, stoks, pipe.default_speaker, bs=batch_size)),
+        ]:
+            uncached, cached = measure_cross_kv_cache(model, step, xenc, xenc_positions, iterations=iterations)
+            print(f"{name} per-token: {uncached*1000:.2f} ms without the cross-attention K/V cache, {cached*1000:.2f} ms with it ({uncached/cached:.2f}x)")
+
+    if attn_bucket:
+        for name, model, length, (step, xenc, xenc_positions) in [
+            ("T2S", pipe.t2s, pipe.t2s.stoks_len, t2s_decoding_step(pipe.t2s, txt, bs=batch_size)),
+            ("S2A", pipe.s2a, pipe.s2a.ctx_n, s2a_decoding_step(pipe.s2a, stoks, pipe.default_speaker, bs=batch_size)),
+        ]:
+            positions = range(0, length, length // 6)
+            whole, bounded = measure_attention_bound(model, step, xenc, xenc_positions, attn_bucket, positions, iterations=iterations)
+            for i, a, b in zip(positions, whole, bounded):
+                print(f"{name} per-token at position {i:4d}: {a*1000:.2f} ms attending to the whole KV cache, {b*1000:.2f} ms bounded ({a/b:.2f}x)")
+
+    if stream:
+        measure_stream(pipe, txt, iterations=1, chunk_len=stream_chunk_len) # warmup
+        (ttfc_mean, ttfc_std), (total_mean, total_std) = measure_stream(pipe, txt, iterations=iterations, chunk_len=stream_chunk_len)
+        print(f"Streaming: first chunk after {ttfc_mean:.3f} ± {ttfc_std:.3f} s    Total: {total_mean:.3f} ± {total_std:.3f} s")
+
+    if draft_ref:
+        draft = TSARTransformer.load_model(draft_ref, device=pipe.t2s.device)
+        draft.optimize(max_batch_size=1, torch_compile=False, attn_bucket=attn_bucket, kv_dtype=kv_dtype, kv_block_size=kv_block_size)
+        regular, speculative, acceptance = measure_speculative(pipe.t2s, draft, txt, draft_tokens=draft_tokens, iterations=iterations)
+        print(f"T2S throughput: {regular:.1f} tokens/s, {speculative:.1f} tokens/s with speculative decoding ({draft_tokens} draft tokens, "
+              f"{acceptance:.1%} accepted, {speculative/regular:.2f}x)")
+
+    if pipelined:
+        sentences = [x + "." for x in txt.rstrip(".").split(", ")] * 2
+        threads = [int(x) for x in stage_threads.split(',')] if stage_threads else None
+        serial = lambda: [pipe.vocoder.decode(pipe.generate_atoks(x)) for x in sentences]
+        overlapped = lambda: list(pipe.generate_pipelined(sentences, threads=threads))
+        serial(); overlapped() # warmup
+        (serial_mean, serial_std), (overlapped_mean, overlapped_std) = [measure(fun, iterations=iterations) for fun in [serial, overlapped]]
+        print(f"{len(sentences)} sentences: {serial_mean:.3f} ± {serial_std:.3f} s one by one, {overlapped_mean:.3f} ± {overlapped_std:.3f} s with overlapped stages ({serial_mean/overlapped_mean:.2f}x)")
+
+    if prompt_snapshot:
+        # a long prompt and a short continuation so the prefill is a large part of the latency
+        stoks_prompt, atoks_prompt = stoks[:150].long(), torch.zeros((1, pipe.s2a.quantizers, 450), dtype=torch.long)
+        speakers = pipe.default_speaker.unsqueeze(0)
+        runs = [
+            ("T2S", lambda **kw: pipe.t2s.generate(txt, N=200, show_progress_bar=False, **kw), dict(stoks_prompt=stoks_prompt),
+             pipe.t2s.prefill_prompt(txt, stoks_prompt)),
+            ("S2A", lambda **kw: pipe.s2a.generate(stoks, speakers, N=525, show_progress_bar=False, **kw), dict(atoks_prompt=atoks_prompt),
+             pipe.s2a.prefill_prompt(stoks, speakers, atoks_prompt)),
+        ]
+        for name, generate, prompt_kwargs, snapshot in runs:
+            (a, a_std), (b, b_std) = measure_prompt_snapshot(generate, prompt_kwargs, snapshot, iterations=iterations)
+            print(f"{name} with a {snapshot.length} token prompt: {a:.3f} ± {a_std:.3f} s prefilled every time, {b:.3f} ± {b_std:.3f} s restored from a snapshot")
+
+    if continuous_batching:
+        # independent requests of different lengths, 4 times more than we have slots
+        words = txt.split()
+        txts = [" ".join(words[:(i * 7) % len(words) + 1]) for i in range(4 * max_batch_size)]
+        sched = T2SScheduler(pipe.t2s)
+        sched.generate(txts[:max_batch_size]) # warmup
+        batched = measure_throughput(lambda: list(pipe.t2s.generate(txt, bs=max_batch_size, show_progress_bar=False)), iterations=iterations)
+        scheduled = measure_throughput(lambda: sched.generate(txts), iterations=iterations)
+        print(f"T2S throughput: {batched:.1f} tokens/s with generate(bs={max_batch_size}), {scheduled:.1f} tokens/s with continuous batching of {len(txts)} requests")
+        if kv_block_size: print_paged_kv_cache_usage("T2S", pipe.t2s)
+
+        stokss = [stoks[:(i * 37) % len(stoks) + 25] for i in range(4 * max_batch_size)]
+        speakers = [pipe.default_speaker] * len(stokss)
+        sched = S2AScheduler(pipe.s2a)
+        sched.generate(stokss[:max_batch_size], speakers) # warmup
+        batched = measure_throughput(lambda: list(pipe.s2a.generate(stoks, pipe.default_speaker.unsqueeze(0), bs=max_batch_size, show_progress_bar=False)), iterations=iterations)
+        scheduled = measure_throughput(lambda: sched.generate(stokss, speakers), iterations=iterations)
+        print(f"S2A throughput: {batched:.1f} tokens/s with generate(bs={max_batch_size}), {scheduled:.1f} tokens/s with continuous batching of {len(stokss)} requests")
+        if kv_block_size: print_paged_kv_cache_usage("S2A", pipe.s2a)
@@ -0,0 +1,169 @@
+"""Saving and loading optimized models as single-file inference bundles."""
+
+__all__ = ['bundle_contents', 'save_bundle', 'load_bundle', 'create_bundle']
+
+import json
+import dataclasses
+import importlib
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+from fastcore.script import call_parse
+
+from whisperspeech.a2wav import Vocoder
+from whisperspeech.modules import QuantizedLinear
+
+# bump this if the layout of the model after `optimize` changes
+BUNDLE_FORMAT = 'whisperspeech-bundle-1'
+
+def _optimize_args(model):
+    # recover the `optimize` arguments from the optimized model
+    args = dict(max_batch_size = model.decoder.layers[0].attn.kv_cache_rows,
+                dtype = str(model.dtype).split('.')[-1],
+                attn_bucket = model.decoder.attn_bucket)
+    if getattr(model, 'ttoks_buckets', None): args['ttoks_buckets'] = list(model.ttoks_buckets)
+    if getattr(model, 'quantize', None): args['quantize'] = model.quantize
+    if model.decoder.layers[0].attn.kv_cache.k_scale is not None: args['kv_dtype'] = 'int8'
+    if model.decoder.kv_blocks is not None: args['kv_block_size'] = model.decoder.kv_blocks.block_size
+    return args
+
+def _tensors(model, skip=lambda name: False):
+    # all the parameters and buffers (including the non-persistent ones)
+    return {name:t for name, t in [*model.named_parameters(), *model.named_buffers()] if not skip(name)}
+
+def _model_tensors(model):
+    # the int4 kernel weights are recreated from the quantized weights (their layout depends on the PyTorch version)
+    return _tensors(model, skip=lambda name: name.endswith(('.int4pack', '.scales_and_zeros')))
+
+def _model_metadata(model):
+    cls = type(model)
+    meta = dict(cls = f"{cls.__module__}.{cls.__qualname__}",
+                config = model.__stored_args__,
+                tunables = dataclasses.asdict(model.tunables),
+                optimize = _optimize_args(model))
+    if cls.get_extra_state is not nn.Module.get_extra_state: meta['extra_state'] = model.get_extra_state()
+    return meta
+
+def _vocos_tensors(vocoder):
+    # we only need the EnCodec codebooks to decode the tokens, not the whole EnCodec model
+    return _tensors(vocoder.vocos, skip=lambda name: name.startswith('feature_extractor.encodec.'))
+
+def bundle_contents(pipe):
+    """Returns the `(metadata, tensors)` of a bundle of the Pipeline `pipe` without copying the weights.
+
+    `load_bundle` accepts these instead of a file name, e.g. to rebuild the models in another process
+    from tensors in shared memory (see `WorkerPool`)."""
+    # the packed int8 weights are not regular parameters
+    assert 'dynamic' not in [getattr(pipe.t2s, 'quantize', None), getattr(pipe.s2a, 'quantize', None)], "dynamically quantized models cannot be bundled"
+    fe = pipe.vocoder.vocos.feature_extractor
+    metadata = dict(format = BUNDLE_FORMAT,
+                    t2s = _model_metadata(pipe.t2s),
+                    s2a = _model_metadata(pipe.s2a),
+                    vocos = dict(config = pipe.vocoder.config, bins = fe.encodec.quantizer.bins, bandwidths = fe.bandwidths))
+    tensors = dict(t2s = _model_tensors(pipe.t2s), s2a = _model_tensors(pipe.s2a), vocos = _vocos_tensors(pipe.vocoder))
+    return metadata, tensors
+
+def save_bundle(pipe, fname):
+    """Saves the optimized T2S and S2A models of the Pipeline `pipe` together with the vocoder into a single
+    safetensors file that `load_bundle` can load without any conversion steps."""
+    from safetensors.torch import save_file
+    metadata, groups = bundle_contents(pipe)
+    # safetensors does not support tensors that share memory so we have to clone them
+    save_file({f"{group}.{k}":v.detach().contiguous().clone() for group, tensors in groups.items() for k,v in tensors.items()}, fname,
+              metadata = {k:json.dumps(v) for k,v in metadata.items()})
+
+def _assign(model, tensors):
+    for name, t in tensors.items():
+        module_name, _, attr = name.rpartition('.')
+        m = model.get_submodule(module_name)
+        setattr(m, attr, nn.Parameter(t, requires_grad=False) if attr in m._parameters else t)
+
+def _load_model(meta, tensors, device, torch_compile):
+    module_name, cls_name = meta['cls'].rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    args = dict(meta['optimize'], dtype = getattr(torch, meta['optimize']['dtype']))
+    if 'kv_dtype' in args: args['kv_dtype'] = getattr(torch, args['kv_dtype'])
+    # build the model on the meta device so the initialization and the weight merging in `optimize` are free,
+    # all the real tensors come from the bundle
+    with torch.device('meta'):
+        model = getattr(module, cls_name)(**meta['config'], tunables=module.Tunables(**meta['tunables']))
+        model.eval()
+        model.optimize(torch_compile=False, **args)
+    _assign(model, tensors)
+    for m in model.modules():
+        if isinstance(m, QuantizedLinear): m.pack()
+    if 'extra_state' in meta: model.set_extra_state(meta['extra_state'])
+    # the KV caches are empty so we did not store them
+    kv_blocks = model.decoder.kv_blocks
+    if kv_blocks is not None: kv_blocks.table = torch.zeros_like(kv_blocks.table, device=device)
+    for l in model.decoder.layers:
+        l.attn.kv_cache = l.attn.kv_cache.new_empty(kv_blocks, device=device)
+        l.cross_attn.kv_cache = l.cross_attn.kv_cache.new_empty(device=device)
+    assert not any(p.is_meta for p in model.parameters()), "incomplete bundle"
+    # the compile settings depend on the device so we can only compile after loading the weights
+    if torch_compile: model.compile_generate()
+    return model
+
+def _encodec_features(codebook_weights, bins, bandwidths):
+    # we only decode tokens so we only need the codebooks and not the whole EnCodec model
+    # (vocos, with torchaudio and EnCodec, takes a while to import so we only import it when we need it)
+    from vocos.feature_extractors import EncodecFeatures
+    fe = EncodecFeatures.__new__(EncodecFeatures)
+    nn.Module.__init__(fe) # skips loading EnCodec
+    fe.encodec = SimpleNamespace(quantizer=SimpleNamespace(bins=bins))
+    fe.codebook_weights = nn.Parameter(codebook_weights, requires_grad=False)
+    fe.bandwidths = bandwidths
+    return fe
+
+def _load_vocoder(meta, tensors, device):
+    from vocos import Vocos
+    from vocos.pretrained import instantiate_class
+    fe = _encodec_features(tensors.pop('feature_extractor.codebook_weights'), meta['bins'], meta['bandwidths'])
+    with torch.device('meta'):
+        backbone = instantiate_class(args=(), init=meta['config']['backbone'])
+        head = instantiate_class(args=(), init=meta['config']['head'])
+    vocos = Vocos(fe, backbone, head)
+    _assign(vocos, tensors)
+    assert not any(t.is_meta for t in _tensors(vocos).values()), "incomplete bundle"
+    return Vocoder(device=device, vocos=vocos.eval(), config=meta['config'])
+
+def _read_bundle(fname):
+    from safetensors import safe_open
+    groups = {'t2s': {}, 's2a': {}, 'vocos': {}}
+    with safe_open(fname, framework='pt', device='cpu') as f:
+        metadata = {k:json.loads(v) for k,v in f.metadata().items()}
+        for k in f.keys():
+            group, name = k.split('.', 1)
+            groups[group][name] = f.get_tensor(k)
+    return metadata, groups
+
+def load_bundle(fname, device=None, torch_compile=False):
+    """Loads the models saved with `save_bundle`, returns a `(t2s, s2a, vocoder)` tuple ready for inference.
+
+    The weights are memory-mapped on the CPU (see `inference.load_safetensors`). Instead of a file name `fname`
+    can also be the `(metadata, tensors)` returned by `bundle_contents`, the CPU models then use the same tensors."""
+    from whisperspeech import inference
+    if device is None: device = inference.get_compute_device()
+    vocoder_device = 'cpu' if device == 'mps' else device # see `Vocoder`
+    metadata, groups = _read_bundle(fname) if isinstance(fname, (str, Path)) else fname
+    assert metadata.get('format') == BUNDLE_FORMAT, f"unsupported bundle format: {metadata.get('format')}"
+    groups = {group:{k:v.to(vocoder_device if group == 'vocos' else device) for k,v in tensors.items()} for group, tensors in groups.items()}
+    t2s = _load_model(metadata['t2s'], groups['t2s'], device, torch_compile)
+    s2a = _load_model(metadata['s2a'], groups['s2a'], device, torch_compile)
+    vocoder = _load_vocoder(metadata['vocos'], groups['vocos'], vocoder_device)
+    return t2s, s2a, vocoder
+
+@call_parse
+def create_bundle(
+    output:Path, # the bundle file name (`.safetensors`)
+    t2s_ref:str=None, # the T2S model reference (see `Pipeline`)
+    s2a_ref:str=None, # the S2A model reference (see `Pipeline`)
+    max_batch_size:int=1, # the number of KV cache rows
+    ttoks_buckets:str=None, # comma separated T2S encoder length buckets (e.g. `64,128,256`)
+):
+    from whisperspeech.pipeline import Pipeline
+    if ttoks_buckets: ttoks_buckets = [int(x) for x in ttoks_buckets.split(',')]
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, device='cpu', max_batch_size=max_batch_size, ttoks_buckets=ttoks_buckets)
+    save_bundle(pipe, output)
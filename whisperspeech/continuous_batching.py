@@ -0,0 +1,316 @@
+"""Continuous batching schedulers for T2S and S2A decoding."""
+
+__all__ = ['T2SRequest', 'T2SScheduler', 'S2ARequest', 'S2AScheduler']
+
+import dataclasses
+import collections
+import torch
+import torch.nn.functional as F
+
+from whisperspeech import inference
+
+def _reserve_kv_cache(model, slots, lengths, session):
+    # with a paged K/V cache every slot only takes the blocks it needs so far
+    if (model.decoder.kv_blocks if session is None else session.kv_blocks) is None: return
+    for slot, (req, length) in enumerate(zip(slots, lengths.tolist())):
+        if req is not None: model.decoder.reserve_kv_cache([slot], length, session=session)
+
+def _cancel(scheduler, req):
+    # the requests are compared by identity (`==` would compare the tensors of the dataclasses)
+    for i, x in enumerate(scheduler.queue):
+        if x is req:
+            del scheduler.queue[i]
+            return True
+    for slot, x in enumerate(scheduler.slots):
+        if x is req:
+            scheduler._free(slot)
+            return True
+    return False
+
+@dataclasses.dataclass
+class T2SRequest:
+    txt: str
+    cps: float = 15
+    lang: str = "en"
+    N: int = None
+    prompt_snapshot: inference.PromptSnapshot = None
+    stoks: torch.Tensor = None # the generated semantic tokens, set when the request is finished
+
+    @property
+    def done(self):
+        return self.stoks is not None
+
+class T2SScheduler:
+    """Continuous batching of T2S decoding across independent requests.
+
+    Every row of the KV cache (see `TSARTransformer.optimize(max_batch_size=...)`) is a slot for one request.
+    New texts are admitted into free slots between decoding steps, every slot tracks its own position
+    and a row is retired as soon as it samples the end-of-text token.
+
+    With a `session` (see `TSARTransformer.new_session`) the scheduler uses its K/V caches instead of the default ones."""
+    def __init__(self, t2s, T=0.7, top_k=None, session=None):
+        assert t2s.decoder.layers[0].attn.kv_cache is not None, "please call optimize() on the model to set up the KV cache"
+        self.t2s = t2s
+        self.session = session
+        self.max_batch_size = B = t2s.decoder.layers[0].attn.kv_cache_rows
+        self.N = t2s.stoks_len
+        self.eot = t2s.stoks_codes + t2s.tunables.padding_token_offset
+        self.top_k = top_k
+        dev = t2s.device
+        self.T = torch.tensor(T, device=dev)
+
+        self.toks = torch.zeros((B, self.N), dtype=torch.long, device=dev)
+        self.positions = torch.zeros(B, dtype=torch.long, device=dev) # position of the last token in every slot
+        self.active = torch.zeros(B, dtype=torch.bool, device=dev)
+        self.xenc = torch.zeros((B, t2s.ttoks_len, t2s.width), dtype=t2s.dtype, device=dev)
+        self.xenc_positions = torch.arange(t2s.ttoks_len, device=dev)
+        self.cps_emb = torch.zeros((B, 1, t2s.width), dtype=t2s.dtype, device=dev)
+        self.slots = [None] * B
+        self.queue = collections.deque()
+
+    def submit(self, txt, cps=15, lang="en", N=None, prompt_snapshot=None):
+        """Queues a text for generation and returns a `T2SRequest` that will receive the result.
+
+        `prompt_snapshot` (see `TSARTransformer.prefill_prompt`) is restored into the slot instead of running the encoder."""
+        req = T2SRequest(txt, cps=cps, lang=lang, N=min(N or self.N, self.N), prompt_snapshot=prompt_snapshot)
+        self.queue.append(req)
+        return req
+
+    @property
+    def busy(self):
+        return len(self.queue) > 0 or any(x is not None for x in self.slots)
+
+    def _admit(self, slot, req):
+        t2s = self.t2s
+        ttoks, langs, cpss = t2s.encode_text(req.txt, cps=req.cps, lang=req.lang)
+        snapshot = req.prompt_snapshot
+        if snapshot is not None:
+            assert snapshot.matches(ttoks, langs, cpss), "the prompt snapshot was made for a different text"
+            xenc, xenc_positions, cps_emb, padding_mask = snapshot.encoder_state
+        else:
+            xenc, xenc_positions, cps_emb, padding_mask = t2s.run_encoder_bucketed(ttoks, langs, cpss)
+        self.xenc[slot,:xenc.shape[1]] = xenc[0]
+        if cps_emb is not None: self.cps_emb[slot] = cps_emb[0]
+        t2s.decoder.prime_cross_kv_cache(xenc, xenc_positions, rows=slice(slot, slot+1), padding_mask=padding_mask, session=self.session)
+        self.toks[slot] = 0
+        self.toks[slot,0] = self.eot # the start token is the same as the padding token
+        self.positions[slot] = 0
+        if snapshot is not None:
+            # the next step feeds the last prompt token
+            self.toks[slot,:snapshot.toks.shape[1]] = snapshot.toks[0]
+            self.positions[slot] = snapshot.length
+            t2s.decoder.restore_kv_cache(snapshot.kv, [slot], session=self.session)
+        self.active[slot] = True
+        self.slots[slot] = req
+
+    @torch.no_grad()
+    def step(self):
+        """Admits queued requests into free slots and runs one decoding step for the whole batch.
+
+        Returns the list of requests finished in this step."""
+        for slot in range(self.max_batch_size):
+            if not self.queue: break
+            if self.slots[slot] is None: self._admit(slot, self.queue.popleft())
+        if not any(x is not None for x in self.slots): return []
+
+        positions = self.positions.unsqueeze(1)
+        self.t2s.decoder.bound_self_attention(int(self.positions.max()) + 1, session=self.session)
+        _reserve_kv_cache(self.t2s, self.slots, self.positions + 1, self.session)
+        with inference.inference_context():
+            next_toks = self.t2s.generate_next(self.toks.gather(1, positions), positions, self.cps_emb,
+                                               self.xenc, self.xenc_positions, self.T, self.top_k, session=self.session)
+        self.toks.scatter_(1, positions + 1, next_toks.to(torch.long))
+        self.positions = torch.where(self.active, self.positions + 1, 0)
+
+        finished = []
+        eot = (next_toks[:,0] == self.eot).tolist()
+        for slot, (req, pos) in enumerate(zip(self.slots, self.positions.tolist())):
+            if req is None: continue
+            if eot[slot] or pos + 1 >= req.N:
+                req.stoks = self.toks[slot, 1:pos if eot[slot] else pos+1].clone()
+                self._free(slot)
+                finished.append(req)
+        return finished
+
+    def _free(self, slot):
+        self.t2s.decoder.release_kv_cache([slot], session=self.session)
+        self.slots[slot] = None
+        self.active[slot] = False
+        # a retired slot at the end of the context would write past `toks` in the next step
+        self.positions[slot] = 0
+
+    def cancel(self, req):
+        """Drops a queued or running request, its slot is free for the next one. Returns False if `req` is not
+        in the scheduler (e.g. it is already finished)."""
+        return _cancel(self, req)
+
+    def run(self):
+        """Decodes until all the submitted requests are finished."""
+        while self.busy: self.step()
+
+    def generate(self, txts, cps=15, lang="en", N=None):
+        """Generates semantic tokens for a list of texts, keeping all the slots busy."""
+        reqs = [self.submit(txt, cps=cps, lang=lang, N=N) for txt in txts]
+        self.run()
+        return [req.stoks for req in reqs]
+
+@dataclasses.dataclass
+class S2ARequest:
+    stoks: torch.Tensor
+    speaker: torch.Tensor
+    N: int = None
+    atoks_prompt: torch.Tensor = None
+    prompt_snapshot: inference.PromptSnapshot = None
+    chunk_len: int = None # if set, the frames are also appended to `chunks` in pieces of this length as soon as they are sampled
+    chunks: list = dataclasses.field(default_factory=list)
+    emitted: int = 0 # the number of frames already appended to `chunks`
+    atoks: torch.Tensor = None # the generated acoustic tokens, set when the request is finished
+
+    @property
+    def done(self):
+        return self.atoks is not None
+
+class S2AScheduler:
+    """Continuous batching of S2A decoding across utterances of different lengths.
+
+    Works like `T2SScheduler` but every slot also keeps its own speaker embedding, number of frames to generate
+    and (with an `atoks_prompt`) start position. The delay pattern is tracked separately for every row: quantizer `q`
+    is only sampled at positions `i > q` and prompt tokens are kept instead of sampled ones (the prompt is
+    prefilled one position per decoding step)."""
+    def __init__(self, s2a, T=0.7, top_k=None, session=None):
+        assert s2a.decoder.layers[0].attn.kv_cache is not None, "please call optimize() on the model to set up the KV cache"
+        self.s2a = s2a
+        self.session = session
+        self.max_batch_size = B = s2a.decoder.layers[0].attn.kv_cache_rows
+        self.top_k = top_k
+        dev = s2a.device
+        self.T = torch.tensor(T, device=dev)
+        Q = s2a.quantizers
+
+        self.toks = torch.full((B, Q, s2a.ctx_n), s2a.codes+1, dtype=torch.long, device=dev)
+        self.positions = torch.ones(B, dtype=torch.long, device=dev) # the next position to sample in every slot
+        self.prompt_lens = torch.zeros(B, dtype=torch.long, device=dev)
+        self.active = torch.zeros(B, dtype=torch.bool, device=dev)
+        self.quantizer_ids = torch.arange(Q, device=dev)
+        self.xenc = torch.zeros((B, s2a.stoks_len, s2a.width), dtype=s2a.dtype, device=dev)
+        self.xenc_positions = torch.arange(s2a.stoks_len, device=dev)
+        self.slots = [None] * B
+        self.queue = collections.deque()
+
+    def submit(self, stoks, speaker, N=None, atoks_prompt=None, prompt_snapshot=None, chunk_len=None):
+        """Queues semantic tokens for generation and returns a `S2ARequest` that will receive the result.
+
+        `prompt_snapshot` (see `SADelARTransformer.prefill_prompt`) replaces `atoks_prompt` and is restored into the slot
+        instead of running the encoder. With a `chunk_len` the request also collects the finished frames in `chunks`
+        (like `SADelARTransformer.generate_chunks`)."""
+        assert atoks_prompt is None or prompt_snapshot is None, "the prompt is already in the snapshot"
+        req = S2ARequest(stoks, speaker, N=min(N or len(stoks) * 3, self.s2a.ctx_n), atoks_prompt=atoks_prompt, prompt_snapshot=prompt_snapshot,
+                         chunk_len=chunk_len)
+        self.queue.append(req)
+        return req
+
+    @property
+    def busy(self):
+        return len(self.queue) > 0 or any(x is not None for x in self.slots)
+
+    def _admit(self, slot, req):
+        s2a = self.s2a
+        dev = s2a.device
+        stoks = F.pad(req.stoks.to(dev), (1, s2a.stoks_len - len(req.stoks) - 1), value=s2a.stoks_codes-1).unsqueeze(0)
+        speakers = req.speaker.to(device=dev, dtype=s2a.dtype).reshape(1, -1)
+        snapshot = req.prompt_snapshot
+        if snapshot is not None:
+            assert snapshot.matches(stoks, speakers), "the prompt snapshot was made for different inputs"
+            xenc, xenc_positions, _ = snapshot.encoder_state
+        elif hasattr(s2a, 'cond_embeddings'):
+            xenc, xenc_positions, _ = s2a.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+        else:
+            xenc, xenc_positions, _ = s2a.run_encoder(stoks, speakers)
+        self.xenc[slot] = xenc[0]
+        s2a.decoder.prime_cross_kv_cache(xenc, xenc_positions, rows=slice(slot, slot+1), session=self.session)
+        self.toks[slot] = s2a.codes+1
+        prompt_len = 0
+        if snapshot is not None:
+            self.toks[slot,:,:snapshot.toks.shape[-1]] = snapshot.toks[0]
+            prompt_len = snapshot.length
+            s2a.decoder.restore_kv_cache(snapshot.kv, [slot], session=self.session)
+        elif req.atoks_prompt is not None:
+            prompt = req.atoks_prompt.to(dev).reshape(s2a.quantizers, -1)
+            prompt_len = prompt.shape[-1]
+            for i in range(s2a.quantizers):
+                self.toks[slot,i,1+i:prompt_len+i+1] = prompt[i]
+        self.prompt_lens[slot] = prompt_len
+        # the next step feeds the last prompt position (the prompt positions before it are already in the restored cache)
+        self.positions[slot] = prompt_len + 1 if snapshot is not None else 1
+        self.active[slot] = True
+        self.slots[slot] = req
+
+    def _finish(self, slot, req):
+        N = req.N
+        toks = self.toks[slot,:,1:N].clone()
+        for j in range(self.s2a.quantizers):
+            toks[j] = torch.roll(toks[j], -j)
+        req.atoks = toks[:,:N-4]
+        if req.chunk_len is not None and req.atoks.shape[-1] > req.emitted: req.chunks.append(req.atoks[:,req.emitted:])
+        self._free(slot)
+
+    def _free(self, slot):
+        self.s2a.decoder.release_kv_cache([slot], session=self.session)
+        self.slots[slot] = None
+        self.active[slot] = False
+        self.positions[slot] = 1
+
+    def cancel(self, req):
+        """Drops a queued or running request, its slot is free for the next one. Returns False if `req` is not
+        in the scheduler (e.g. it is already finished)."""
+        return _cancel(self, req)
+
+    def _emit_chunks(self, slot, req, i):
+        # after sampling position i all the quantizers of frames up to i - quantizers are known
+        while min(i - self.s2a.quantizers + 1, req.N-4) - req.emitted >= req.chunk_len:
+            t0, t1 = req.emitted, req.emitted + req.chunk_len
+            req.chunks.append(torch.stack([self.toks[slot,j,1+t0+j:1+t1+j] for j in range(self.s2a.quantizers)]))
+            req.emitted = t1
+
+    @torch.no_grad()
+    def step(self):
+        """Admits queued requests into free slots and runs one decoding step for the whole batch.
+
+        Returns the list of requests finished in this step."""
+        for slot in range(self.max_batch_size):
+            if not self.queue: break
+            if self.slots[slot] is None: self._admit(slot, self.queue.popleft())
+        if not any(x is not None for x in self.slots): return []
+
+        B, Q, _ = self.toks.shape
+        positions = self.positions.unsqueeze(1)
+        self.s2a.decoder.bound_self_attention(int(self.positions.max()), session=self.session)
+        _reserve_kv_cache(self.s2a, self.slots, self.positions, self.session)
+        with inference.inference_context():
+            prev = self.toks.gather(2, (positions - 1).view(B,1,1).expand(B,Q,1))
+            sampled = self.s2a.generate_next(prev, positions - 1, None, self.xenc, self.xenc_positions, self.T, self.top_k, session=self.session)
+        # delay pattern: quantizer q starts at position q+1 and keeps the prompt tokens up to position prompt_len+q
+        idx = positions.view(B,1,1).expand(B,Q,1)
+        sample_q = (self.quantizer_ids < positions) & (positions > self.prompt_lens.unsqueeze(1) + self.quantizer_ids)
+        new = torch.where(sample_q.unsqueeze(-1), sampled.to(torch.long), self.toks.gather(2, idx))
+        self.toks.scatter_(2, idx, new)
+        self.positions = torch.where(self.active, self.positions + 1, 1)
+
+        finished = []
+        for slot, (req, pos) in enumerate(zip(self.slots, self.positions.tolist())):
+            if req is None: continue
+            if req.chunk_len is not None: self._emit_chunks(slot, req, pos - 1)
+            if pos >= min(req.N, self.s2a.ctx_n-1):
+                self._finish(slot, req)
+                finished.append(req)
+        return finished
+
+    def run(self):
+        """Decodes until all the submitted requests are finished."""
+        while self.busy: self.step()
+
+    def generate(self, stoks, speakers, N=None):
+        """Generates acoustic tokens for lists of semantic tokens and speaker embeddings, keeping all the slots busy."""
+        reqs = [self.submit(x, spk, N=N) for x, spk in zip(stoks, speakers)]
+        self.run()
+        return [req.atoks for req in reqs]
@@ -10,14 +10,21 @@ from fastcore.script import call_parse
 
 from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
 from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech import inference
 
 # %% ../nbs/C3. Convert to FP16.ipynb 2
 @call_parse
-def convert_model(fname:Path, output:Path):
+def convert_model(
+    fname:Path, # the source model file
+    output:Path, # the output file (use a `.safetensors` extension to get a file that can be memory-mapped)
+):
     spec = torch.load(fname)
     if 'speaker_map' in spec['config']:
         model = SADelARTransformer.load_model(spec=spec)
     else:
         model = TSARTransformer.load_model(spec=spec)
     model.switch_dtypes(torch.float16)
-    model.save_model(output)
+    if output.suffix == '.safetensors':
+        inference.save_safetensors(model, output)
+    else:
+        model.save_model(output)
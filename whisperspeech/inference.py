@@ -4,9 +4,11 @@
 __all__ = ['get_compute_device']
 
 # %% ../nbs/D. Common inference utilities.ipynb 1
+import json
+import dataclasses
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
-from huggingface_hub import hf_hub_download
 
 from contextlib import nullcontext
 
@@ -32,11 +34,67 @@ def load_model(ref=None, spec=None, device='cpu'):
     if spec is not None: return spec
     if ":" in ref:
         repo_id, filename = ref.split(":", 1)
+        from huggingface_hub import hf_hub_download # slow to import
         local_filename = hf_hub_download(repo_id=repo_id, filename=filename)
     else:
         local_filename = ref
+    return load_spec(local_filename, device=device)
+
+def load_spec(local_filename, device='cpu'):
+    """Loads a model spec (config, tunables and state_dict) from a `.model` or `.safetensors` file."""
+    if str(local_filename).endswith('.safetensors'): return load_safetensors(local_filename, device=device)
     return torch.load(local_filename, map_location=device)
 
+def save_safetensors(model, fname):
+    """Saves the model as a safetensors file which can be memory-mapped when loading (see `load_safetensors`)."""
+    from safetensors.torch import save_file
+    state_dict = model.state_dict()
+    metadata = dict(config = model.__stored_args__, tunables = dataclasses.asdict(model.tunables),
+                    dtype = str(getattr(model, 'dtype', torch.float32)).split('.')[-1])
+    # non-tensor entries (like the S2A speaker map) go into the metadata
+    extra_state = {k:state_dict.pop(k) for k in list(state_dict) if not isinstance(state_dict[k], torch.Tensor)}
+    if extra_state: metadata['extra_state'] = extra_state
+    # safetensors does not support tensors that share memory so we have to clone them
+    save_file({k:v.contiguous().clone() for k,v in state_dict.items()}, fname,
+              metadata = {k:json.dumps(v) for k,v in metadata.items()})
+
+def load_safetensors(fname, device='cpu'):
+    """Loads a model spec from a safetensors file.
+
+    On the CPU the weights are memory-mapped (copy-on-write) so all the processes that load the same
+    file share the same pages. The spec has an additional `mmap` flag so `load_model` assigns these
+    tensors to the model parameters instead of copying them.
+
+    `optimize` merges the attention projections and switches the dtypes, which copies almost all the weights,
+    so the pages are only shared by models used without `optimize`. Save optimized models as a bundle instead
+    (see `bundle.save_bundle`), it stores the weights in their final layout and dtype."""
+    from safetensors import safe_open
+    state_dict = {}
+    with safe_open(fname, framework='pt', device=str(device or 'cpu')) as f:
+        metadata = {k:json.loads(v) for k,v in f.metadata().items()}
+        for k in f.keys(): state_dict[k] = f.get_tensor(k)
+    state_dict.update(metadata.get('extra_state', {}))
+    return dict(config = metadata['config'], tunables = metadata['tunables'], state_dict = state_dict,
+                dtype = getattr(torch, metadata['dtype']), mmap = True)
+
+def weight_quantization(state_dict):
+    """Returns `'int8'` or `'int4'` if the state_dict holds quantized weights (see `QuantizedLinear`), `None` otherwise."""
+    dtypes = {v.dtype for k,v in state_dict.items() if k.endswith('.weight') and isinstance(v, torch.Tensor)}
+    if torch.int8 in dtypes: return 'int8'
+    if torch.uint8 in dtypes: return 'int4'
+
+def load_state_dict(model, spec):
+    """Loads the spec state_dict into the model, without copying the weights of memory-mapped specs."""
+    # the quantized layers have a different structure so we have to quantize the model first
+    quantize = weight_quantization(spec['state_dict'])
+    if quantize: model.quantize_weights(quantize)
+    if spec.get('mmap'):
+        # switch the model to the stored dtype first so the tensors can be used as they are
+        model.switch_dtypes(spec['dtype'])
+        model.load_state_dict(spec['state_dict'], assign=True)
+    else:
+        model.load_state_dict(spec['state_dict'])
+
 # %% ../nbs/D. Common inference utilities.ipynb 5
 def inference_context():
     if torch.cuda.is_available():
@@ -44,6 +102,38 @@ def inference_context():
     else:
         return nullcontext()
 
+def allow_recompiles(n):
+    """Raises the `torch.compile` recompilation limit to at least `n` graphs per function.
+
+    Needed when we specialize the graphs on a number of lengths (with `fullgraph=True` going over the
+    limit is an error instead of a silent fallback to eager mode)."""
+    import torch._dynamo
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, n)
+
+def cpu_dtype():
+    """Returns `torch.bfloat16` if the CPU has native bf16 instructions (AVX512-BF16 or AMX), `torch.float32` otherwise."""
+    native_bf16 = [getattr(torch.cpu, name, lambda: False) for name in ['_is_avx512_bf16_supported', '_is_amx_tile_supported']]
+    return torch.bfloat16 if any(supported() for supported in native_bf16) else torch.float32
+
+def default_dtype(device):
+    # fp16 matmuls are emulated (and very slow) on most CPUs
+    return cpu_dtype() if torch.device(device).type == 'cpu' else torch.float16
+
+def quantize_dynamic(modules):
+    """Replaces all the `nn.Linear` layers inside `modules` with int8 layers that quantize the activations on the fly.
+
+    CPU only, the rest of the model has to stay in fp32."""
+    for m in modules:
+        torch.ao.quantization.quantize_dynamic(m, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def compile(fun, device, fullgraph=True):
+    """`torch.compile`s a decoding step function with the settings that work best on `device`."""
+    if torch.device(device).type == 'cpu':
+        # CUDA graphs (`reduce-overhead`) do not exist on the CPU, instead we let Inductor constant-fold
+        # the weights and prepack them for oneDNN (only for this function, the global Inductor config stays as it is)
+        return torch.compile(fun, fullgraph=fullgraph, options=dict(freezing=True))
+    return torch.compile(fun, mode="reduce-overhead", fullgraph=fullgraph)
+
 # from https://github.com/pytorch-labs/gpt-fast/blob/main/generate.py
 def multinomial_sample_one_no_sync(probs_sort): # Does multinomial sampling without a cuda synchronization
     q = torch.empty_like(probs_sort).exponential_(1)
@@ -64,3 +154,45 @@ def sample(logits, T=1.0, top_k=None):
     probs = logits_to_probs(logits, T, top_k)
     idx_next = multinomial_sample_one_no_sync(probs)
     return idx_next
+
+def speculative_sample(logits, draft_logits, draft_toks, T=1.0, top_k=None):
+    """Checks the `k` tokens proposed by a draft model with the standard speculative sampling acceptance rule.
+
+    `logits` are the target model logits for the `k` drafted positions and the one after them `(k+1, vocab)`,
+    `draft_logits` `(k, vocab)` are the draft model logits the `draft_toks` `(k,)` were sampled from (with the same
+    `T` and `top_k`). Returns the accepted draft tokens followed by one token sampled from the target model so the
+    result has the same distribution as sampling from the target model token by token."""
+    k = len(draft_toks)
+    p = logits_to_probs(logits.float(), T, top_k)
+    q = logits_to_probs(draft_logits.float(), T, top_k)
+    idx = torch.arange(k, device=p.device)
+    # a drafted token is accepted with probability min(1, p/q), the first rejection ends the run
+    accept = torch.rand(k, device=p.device) * q[idx, draft_toks] < p[idx, draft_toks]
+    n = int(accept.cumprod(0).sum())
+    if n < k:
+        # resample the rejected position from the part of p that q does not cover
+        residual = (p[n] - q[n]).clamp(min=0)
+        probs = residual if residual.sum() > 0 else p[n]
+    else:
+        probs = p[k]
+    return torch.cat([draft_toks[:n], multinomial_sample_one_no_sync(probs).to(draft_toks.dtype)])
+
+# %% ../nbs/D. Common inference utilities.ipynb 6
+@dataclasses.dataclass
+class PromptSnapshot:
+    """The decoder state after prefilling a prompt (see `prefill_prompt` in the T2S and S2A models).
+
+    The decoder cross-attends to the encoder output so a snapshot is only valid for the encoder `inputs` it was
+    created with. Restoring it skips both the encoder and the prompt prefill."""
+    inputs: tuple # the encoder inputs
+    encoder_state: tuple # the encoder outputs
+    toks: torch.Tensor # the decoder input tokens of the prompt
+    kv: list # the raw self-attention K/V cache contents of every decoder layer (see `BaseDecoder.snapshot_kv_cache`)
+
+    @property
+    def length(self):
+        # we store all the prompt positions except the last one which is fed into the first decoding step
+        return self.kv[0][0].shape[1]
+
+    def matches(self, *inputs):
+        return len(inputs) == len(self.inputs) and all(a is b or (a is not None and b is not None and torch.equal(a, b)) for a, b in zip(inputs, self.inputs))
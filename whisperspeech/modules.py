@@ -1,8 +1,9 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/A. Neural modules.ipynb.
 
 # %% auto 0
-__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'MultiHeadAttention',
-           'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector', 'FlexEmbeddings']
+__all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'QuantizedLinear', 'quantize_linears', 'init_transformer', 'sinusoids',
+           'KVBlockTable', 'KVCache', 'MultiHeadAttention', 'ResidualAttentionBlock', 'DecodingSession', 'BaseDecoder',
+           'EmbeddingProjector', 'FlexEmbeddings']
 
 # %% ../nbs/A. Neural modules.ipynb 2
 import torch
@@ -32,6 +33,106 @@ class LinearHead(nn.Linear):
 class QueryHead(nn.Linear):
     pass
 
+class QuantizedLinear(nn.Module):
+    """A linear layer with int8 or int4 weights (symmetric, with one scale per output channel).
+
+    The activations stay in floating point. Decoding one token at a time is limited by how fast we can read
+    the weights so on the CPU the fused kernels run almost 2x (int8) or 4x (int4) faster than bf16. They are
+    only vectorized for bf16 activations so fp32 and fp16 activations are rounded to bf16 for them (the rounding
+    errors are much smaller than the quantization errors). int4 weights are stored two per byte (the low nibble
+    first), offset by 8."""
+    def __init__(self, in_features, out_features, bias=True, bits=8):
+        super().__init__()
+        assert bits in (4, 8), "only int8 and int4 weights are supported"
+        assert bits == 8 or in_features % 2 == 0, "int4 weights need an even number of input features"
+        self.in_features, self.out_features, self.bits = in_features, out_features, bits
+        if bits == 8:
+            self.register_buffer('weight', torch.zeros(out_features, in_features, dtype=torch.int8))
+        else:
+            self.register_buffer('weight', torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+        self.register_buffer('scales', torch.ones(out_features))
+        self.register_buffer('bias', torch.zeros(out_features) if bias else None)
+        # the int4 weights repacked for the fused CPU kernel (the layout is internal to PyTorch so we never save it)
+        self.groupsize = next((g for g in (256, 128, 64, 32) if in_features % g == 0), None)
+        self.register_buffer('int4pack', None, persistent=False)
+        self.register_buffer('scales_and_zeros', None, persistent=False)
+
+    @classmethod
+    def from_linear(cls, linear, bits=8):
+        weight = linear.weight.detach().float()
+        qmax = 2 ** (bits - 1) - 1
+        scales = (weight.abs().amax(dim=1) / qmax).clamp(min=1e-8)
+        q = (weight / scales[:,None]).round().clamp(-qmax - 1, qmax)
+        new = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits).to(weight.device)
+        return new.set_weights(q, scales, linear.bias.detach() if linear.bias is not None else None)
+
+    @classmethod
+    def merge(cls, layers, mults):
+        """Concatenates the outputs of `layers` (multiplied by `mults`) like `MultiHeadAttention.merge_linears`."""
+        q = torch.cat([x.unpack() for x in layers])
+        scales = torch.cat([x.scales.float() * m for x,m in zip(layers, mults)])
+        bias = torch.cat([torch.zeros(x.out_features, device=q.device) if x.bias is None else x.bias.float() * m
+                          for x,m in zip(layers, mults)])
+        new = cls(layers[0].in_features, scales.shape[0], bits=layers[0].bits).to(q.device)
+        return new.set_weights(q, scales, bias)
+
+    def set_weights(self, q, scales, bias=None):
+        """Stores the integer weights `q` (a float or integer tensor) with the per-channel `scales`."""
+        if self.bits == 8:
+            self.weight = q.to(torch.int8)
+        else:
+            q = (q + 8).to(torch.uint8)
+            self.weight = q[:,::2] | (q[:,1::2] << 4)
+        self.scales = scales.to(self.scales.dtype)
+        if bias is not None: self.bias = bias.to(self.scales.dtype)
+        self.pack()
+        return self
+
+    def unpack(self):
+        """Returns the integer weights as an `(out_features, in_features)` int8 tensor."""
+        if self.bits == 8: return self.weight
+        return torch.stack([self.weight & 15, self.weight >> 4], dim=-1).view(self.out_features, -1).to(torch.int8) - 8
+
+    def pack(self):
+        # the fused kernels only exist for the CPU
+        if self.weight.device.type != 'cpu': return
+        # and they crash on weights that are not 64-byte aligned (which can happen with memory-mapped files)
+        if self.weight.data_ptr() % 64: self.weight = self.weight.clone()
+        if self.bits != 4 or self.groupsize is None: return
+        self.int4pack = torch.ops.aten._convert_weight_to_int4pack_for_cpu((self.unpack() + 8).to(torch.int32), 1)
+        # the kernel computes `(q - 8) * scale + zero` with a scale for every `groupsize` inputs
+        scales = self.scales.expand(self.in_features // self.groupsize, -1)
+        self.scales_and_zeros = torch.stack([scales, torch.zeros_like(scales)], dim=-1).contiguous()
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.pack()
+
+    def forward(self, x):
+        shape, dtype = x.shape[:-1], x.dtype
+        x = x.reshape(-1, self.in_features)
+        if x.device.type == 'cpu' and self.bits == 8:
+            y = torch.ops.aten._weight_int8pack_mm(x.to(torch.bfloat16), self.weight, self.scales.to(torch.bfloat16)).to(dtype)
+        elif x.device.type == 'cpu' and self.int4pack is not None:
+            y = torch.ops.aten._weight_int4pack_mm_for_cpu(x.to(torch.bfloat16), self.int4pack, self.groupsize,
+                                                           self.scales_and_zeros.to(torch.bfloat16)).to(dtype)
+        else:
+            # no fused kernel, dequantize the weights
+            y = F.linear(x, self.unpack().to(x.dtype)) * self.scales.to(x.dtype)
+        if self.bias is not None: y = y + self.bias.to(y.dtype)
+        return y.view(*shape, self.out_features)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, bits={self.bits}"
+
+def quantize_linears(modules, bits=8):
+    """Replaces all the `nn.Linear` layers inside `modules` with `QuantizedLinear` ones."""
+    for module in modules:
+        for name, m in list(module.named_modules()):
+            for child_name, child in list(m.named_children()):
+                if isinstance(child, nn.Linear):
+                    setattr(m, child_name, QuantizedLinear.from_linear(child, bits))
+
 # based on https://github.com/karpathy/minGPT/blob/master/mingpt/model.py#L163
 def init_transformer(m):
     if isinstance(m, (nn.Linear, nn.Embedding)):
@@ -52,6 +153,166 @@ def sinusoids(length, channels, max_timescale=10000):
     return torch.cat([torch.sin(scaled_time), torch.cos(scaled_time)], dim=1)
 
 # %% ../nbs/A. Neural modules.ipynb 5
+class KVBlockTable:
+    """Maps the positions of every batch row to fixed-size blocks of the paged self-attention K/V caches.
+
+    All the layers of a decoder share one table (every layer has its own pool of blocks with the same layout).
+    Blocks are handed out to the rows as they grow and returned to the pool with `release`. Block 0 is never
+    handed out: the unallocated entries point to it so the idle rows of a batch have somewhere to write."""
+    def __init__(self, max_batch_size, max_seq_len, block_size, num_blocks, device=None):
+        assert num_blocks > 1, "we need at least one block besides the scratch block"
+        self.block_size = block_size
+        self.max_seq_len = max_seq_len
+        self.num_blocks = self.initial_blocks = num_blocks
+        self.table = torch.zeros((max_batch_size, math.ceil(max_seq_len / block_size)), dtype=torch.long, device=device)
+        self.free = list(range(num_blocks-1, 0, -1))
+        self.blocks = [[] for _ in range(max_batch_size)]
+        self.peak_blocks = 0
+
+    def new_empty(self):
+        """Returns a table with the same layout and the initial number of blocks but nothing allocated."""
+        return KVBlockTable(self.table.shape[0], self.max_seq_len, self.block_size, self.initial_blocks, device=self.table.device)
+
+    @property
+    def used_blocks(self):
+        return sum(len(x) for x in self.blocks)
+
+    def missing(self, row, length):
+        """Returns the number of blocks `row` still needs to hold `length` positions."""
+        return max(0, math.ceil(length / self.block_size) - len(self.blocks[row]))
+
+    def add_blocks(self, n):
+        self.free.extend(range(self.num_blocks + n - 1, self.num_blocks - 1, -1))
+        self.num_blocks += n
+
+    def reserve(self, row, length):
+        n = self.missing(row, length)
+        if n == 0: return
+        if n > len(self.free): raise RuntimeError(f"out of K/V cache blocks ({self.num_blocks} in total)")
+        blocks = self.blocks[row]
+        new = [self.free.pop() for _ in range(n)]
+        self.table[row, len(blocks):len(blocks)+n] = torch.tensor(new, device=self.table.device)
+        blocks.extend(new)
+        self.peak_blocks = max(self.peak_blocks, self.used_blocks)
+
+    def release(self, row):
+        blocks = self.blocks[row]
+        if not blocks: return
+        self.free.extend(reversed(blocks))
+        self.table[row, :len(blocks)] = 0
+        blocks.clear()
+
+    def index(self, rows, positions):
+        """Returns the cache index of `positions` (shared `(n,)` or per row `(rows, n)`) in the first `rows` rows.
+        The index puts the positions before the heads so the values have to be `(rows, n, heads, head_dim)`."""
+        if positions.dim() == 1: positions = positions.expand(rows, -1)
+        return self.table[:rows].gather(1, positions // self.block_size), slice(None), positions % self.block_size
+
+    def pages(self, rows, length):
+        """Returns the blocks holding the first `length` positions of the first `rows` rows."""
+        return self.table[:rows,:math.ceil((length or self.max_seq_len) / self.block_size)]
+
+def _unpage(x, length):
+    # (rows, blocks, heads, block_size, head_dim) -> (rows, heads, positions, head_dim)
+    b, n, h, bs, d = x.shape
+    return x.transpose(1, 2).reshape(b, h, n * bs, d)[:,:,:length]
+
+class KVCache:
+    """The K/V cache of one attention layer together with the state of the generation that uses it.
+
+    `shape` is `(max_batch_size, heads, max_seq_len, head_dim)` or, with a `KVBlockTable`, `(num_blocks, heads,
+    block_size, head_dim)` (a pool of blocks, see `BaseDecoder.setup_kv_cache`). With `kv_dtype=torch.int8`
+    the keys and values are stored as int8 with a scale for every head and position (which takes half the memory
+    of an fp16 cache).
+
+    This is deliberately not a `nn.Module`: `torch.compile` (with Inductor freezing) treats module buffers as
+    constants and would recompile the decoding step for every new cache."""
+    def __init__(self, shape, dtype=torch.float32, kv_dtype=None, kv_blocks=None, device=None):
+        self.k_cache = torch.zeros(shape, dtype=kv_dtype or dtype, device=device)
+        self.v_cache = torch.zeros(shape, dtype=kv_dtype or dtype, device=device)
+        # per-head and per-position scales of the int8 K/V cache
+        if kv_dtype == torch.int8:
+            self.k_scale = torch.zeros((*shape[:3], 1), dtype=dtype, device=device)
+            self.v_scale = torch.zeros((*shape[:3], 1), dtype=dtype, device=device)
+        else:
+            assert kv_dtype is None, "only int8 K/V caches are supported"
+            self.k_scale, self.v_scale = None, None
+        self.kv_blocks = kv_blocks
+        self.primed = False # see `MultiHeadAttention.prime_kv_cache`
+        self.shared = False
+        self.length = None # see `BaseDecoder.bound_self_attention`
+        self.padding_mask = None
+
+    def new_empty(self, kv_blocks=None, device=None):
+        """Returns an empty cache with the same layout (for a paged cache the pool size follows `kv_blocks`)."""
+        shape = self.k_cache.shape if kv_blocks is None else (kv_blocks.num_blocks, *self.k_cache.shape[1:])
+        kv_dtype = torch.int8 if self.k_scale is not None else None
+        return KVCache(shape, dtype=self.dtype, kv_dtype=kv_dtype, kv_blocks=kv_blocks, device=device or self.k_cache.device)
+
+    @property
+    def tensors(self):
+        return [x for x in [self.k_cache, self.v_cache, self.k_scale, self.v_scale] if x is not None]
+
+    def grow(self, n):
+        """Adds `n` empty blocks to the pool of a paged cache."""
+        for name in ['k_cache', 'v_cache', 'k_scale', 'v_scale']:
+            x = getattr(self, name)
+            if x is not None: setattr(self, name, torch.cat([x, x.new_zeros((n, *x.shape[1:]))]))
+
+    @property
+    def rows(self):
+        # the maximum batch size
+        return self.kv_blocks.table.shape[0] if self.kv_blocks is not None else self.k_cache.shape[0]
+
+    @property
+    def dtype(self):
+        # the dtype of the keys and values we read from the cache
+        return self.k_cache.dtype if self.k_scale is None else self.k_scale.dtype
+
+    def store(self, index, k, v):
+        """Writes `k` and `v` to `self.[kv]_cache[index]`, quantizing them for an int8 cache."""
+        if self.k_scale is None:
+            self.k_cache[index] = k.to(self.k_cache.dtype)
+            self.v_cache[index] = v.to(self.v_cache.dtype)
+            return
+        for cache, scales, x in [(self.k_cache, self.k_scale, k), (self.v_cache, self.v_scale, v)]:
+            scale = x.float().abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127
+            cache[index] = (x.float() / scale).round().to(torch.int8)
+            scales[index] = scale.to(scales.dtype)
+
+    def read(self, rows, length):
+        """Returns the keys and values of the first `rows` cache rows and `length` positions."""
+        if self.kv_blocks is not None:
+            pages = self.kv_blocks.pages(rows, length)
+            length = length or self.kv_blocks.max_seq_len
+            k, v = _unpage(self.k_cache[pages], length), _unpage(self.v_cache[pages], length)
+            if self.k_scale is not None:
+                k = k.to(self.k_scale.dtype) * _unpage(self.k_scale[pages], length)
+                v = v.to(self.v_scale.dtype) * _unpage(self.v_scale[pages], length)
+            return k, v
+        k, v = self.k_cache[:rows,:,:length], self.v_cache[:rows,:,:length]
+        if self.k_scale is not None:
+            k = k.to(self.k_scale.dtype) * self.k_scale[:rows,:,:length]
+            v = v.to(self.v_scale.dtype) * self.v_scale[:rows,:,:length]
+        return k, v
+
+    def state(self, row, length):
+        """Returns a copy of the raw cache contents (with the int8 scales) of the first `length` positions of `row`."""
+        if self.kv_blocks is not None:
+            pages = self.kv_blocks.table[row:row+1,:math.ceil(length / self.kv_blocks.block_size)]
+            return [_unpage(x[pages], length)[0].clone() for x in self.tensors]
+        return [x[row,:,:length].clone() for x in self.tensors]
+
+    def load_state(self, row, state):
+        """Writes the cache contents returned by `state` into the first positions of `row`."""
+        length = state[0].shape[1]
+        if self.kv_blocks is not None:
+            positions = torch.arange(length, device=self.k_cache.device)
+            index = self.kv_blocks.table[row, positions // self.kv_blocks.block_size], slice(None), positions % self.kv_blocks.block_size
+            for x, s in zip(self.tensors, state): x[index] = s.transpose(0, 1)
+        else:
+            for x, s in zip(self.tensors, state): x[row,:,:length] = s
+
 class MultiHeadAttention(nn.Module):
     def __init__(self, n_state: int, n_head: int, qk_scale: float = 1, rope: bool = False, cross=False):
         super().__init__()
@@ -66,9 +327,8 @@ class MultiHeadAttention(nn.Module):
         self.query_subsampling = 1
         self.key_subsampling = 1
 
-        self.cached_kvx = None
-        self.register_buffer('k_cache', None)
-        self.register_buffer('v_cache', None)
+        # the default `KVCache`, the forward pass can also use one from a `DecodingSession`
+        self.kv_cache = None
         
         self.rotary = None
         if rope:
@@ -76,12 +336,61 @@ class MultiHeadAttention(nn.Module):
         self.qkv = None
         self.kv = None
 
-    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32):
-        cache_shape = (max_batch_size, self.n_head, max_seq_len, self.n_state//self.n_head)
-        self.k_cache = torch.zeros(cache_shape, dtype=dtype, device=self.key.weight.device)
-        self.v_cache = torch.zeros(cache_shape, dtype=dtype, device=self.value.weight.device)
+    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32, kv_dtype=None, kv_blocks=None, device=None):
+        """Allocates the default K/V cache (see `KVCache`) on `device`. The cache is not a buffer so `dtype` and `device`
+        should already be the final ones (`switch_dtypes` does not convert it). We cannot take the device from the weights
+        because the dynamically quantized linear layers do not have a `weight` tensor.
+
+        With a `KVBlockTable` the cache is a pool of `kv_blocks.num_blocks` blocks instead of
+        `max_batch_size` rows of `max_seq_len` positions (see `BaseDecoder.setup_kv_cache`)."""
+        if kv_blocks is not None:
+            cache_shape = (kv_blocks.num_blocks, self.n_head, kv_blocks.block_size, self.n_state//self.n_head)
+        else:
+            cache_shape = (max_batch_size, self.n_head, max_seq_len, self.n_state//self.n_head)
+        self.kv_cache = KVCache(cache_shape, dtype=dtype, kv_dtype=kv_dtype, kv_blocks=kv_blocks, device=device)
+
+    @property
+    def kv_cache_rows(self):
+        # the maximum batch size
+        return self.kv_cache.rows
+
+    def prime_kv_cache(self, kvx, kv_positions, rows=None, padding_mask=None, cache=None):
+        """Projects `kvx` into the K/V cache once so the following forward calls can skip it.
+        
+        Only useful for cross-attention where `kvx` (the encoder output) is constant during generation.
+        `rows` selects the cache rows to fill (by default the first `kvx.shape[0]` ones). If `rows` is not given
+        and `kvx` has a single row it is shared (without copying) by every row of the batch.
+
+        Without `rows` the attention only looks at the first `kvx.shape[1]` cache entries (so a shorter
+        encoder output means cheaper decoding steps). `padding_mask` (a boolean `(b, kvx.shape[1])` tensor)
+        marks the positions that should be ignored. `cache` defaults to the layer's own `kv_cache`."""
+        cache = self.kv_cache if cache is None else cache
+        assert cache is not None, "please call setup_kv_cache before priming it"
+        assert cache.kv_blocks is None, "only the cross-attention cache can be primed"
+        assert kvx.shape[0] <= cache.rows, "please pass in a larger max_batch_size to setup_kv_cache"
+        cache.shared = rows is None and kvx.shape[0] == 1
+        k, v = self.project_kv(kvx, kv_positions)
+        if rows is None:
+            rows = slice(0, kvx.shape[0])
+            cache.length = kvx.shape[1]
+        else:
+            # other rows may need a longer cache, the positions we did not fill are masked below
+            cache.length = cache.k_cache.shape[2]
+        cache.store((rows, slice(None), kv_positions), k, v)
+        if padding_mask is not None and cache.padding_mask is None:
+            cache.padding_mask = torch.zeros((cache.k_cache.shape[0], 1, 1, cache.k_cache.shape[2]),
+                                             dtype=cache.dtype, device=cache.k_cache.device)
+        if cache.padding_mask is not None:
+            cache.padding_mask[rows] = -torch.inf
+            if padding_mask is None: padding_mask = torch.zeros(kvx.shape[:2], dtype=torch.bool, device=kvx.device)
+            cache.padding_mask[rows,0,0,kv_positions] = torch.where(padding_mask, -torch.inf, 0).to(cache.padding_mask)
+        cache.primed = True
+
+    def invalidate_kv_cache(self, cache=None):
+        (self.kv_cache if cache is None else cache).primed = False
 
     def merge_linears(self, layers, mults):
+        if isinstance(layers[0], QuantizedLinear): return QuantizedLinear.merge(layers, mults)
         bias = [x.bias for x in layers if x.bias is not None][0]
         din, dout = layers[0].weight.shape
         new = nn.Linear(din, len(layers) * dout).to(layers[0].weight.device)
@@ -93,7 +402,7 @@ class MultiHeadAttention(nn.Module):
     def convert_for_eval(self):
         if self.qkv or self.kv: raise AttributeError("already converted")
         
-        self.odim = self.key.weight.shape[1]
+        self.odim = self.key.in_features
         if self.cross:
             self.q = self.merge_linears([self.query], [self.sqrt_qk_scale])
             self.kv = self.merge_linears([self.key, self.value],
@@ -108,6 +417,16 @@ class MultiHeadAttention(nn.Module):
             x = rope_rotate(x, x_positions * subsampling, *self.rotary(x))
         return x.permute(0, 2, 1, 3)
 
+    def project_kv(self, kvx, kv_positions):
+        if self.kv:
+            k,v = self.kv(kvx).split(self.odim, dim=-1)
+        else:
+            k = self.key(kvx) * self.sqrt_qk_scale
+            v = self.value(kvx)
+        k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
+        v = self.split_heads(v, kv_positions)
+        return k, v
+
     def forward(
         self,
         qx,
@@ -116,34 +435,51 @@ class MultiHeadAttention(nn.Module):
         kv_positions,
         causal = False,
         mask=None,
+        cache=None,
     ):
-        if self.k_cache is not None:
-            assert qx.shape[0] <= self.k_cache.shape[0], "please pass in a larger max_batch_size to setup_kv_cache"
+        # `cache` is a `KVCache` from a `DecodingSession`, without it we use the default one
+        cache = self.kv_cache if cache is None else cache
+        if cache is not None:
+            assert qx.shape[0] <= cache.rows, "please pass in a larger max_batch_size to setup_kv_cache"
         if self.qkv:
             q,k,v = self.qkv(qx).split(self.odim, dim=-1)
         elif self.kv:
             q = self.q(qx)
-            k,v = self.kv(kvx).split(self.odim, dim=-1)
         else:
             q,k,v = None,None,None
         
         if q is None: q = self.query(qx) * self.sqrt_qk_scale
         q = self.split_heads(q, q_positions, rope = self.rotary, subsampling = self.query_subsampling)
 
-        if kvx is not self.cached_kvx:
-            if k is None: k = self.key(kvx) * self.sqrt_qk_scale
-            k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
-            if v is None: v = self.value(kvx)
-            v = self.split_heads(v, kv_positions)
-            if self.k_cache is not None:
-                self.k_cache[:k.shape[0],:,kv_positions] = k
-                self.v_cache[:v.shape[0],:,kv_positions] = v
-
-        if self.k_cache is not None:
-            k, v = self.k_cache[:k.shape[0]], self.v_cache[:v.shape[0]]
+        primed = cache is not None and cache.primed
+        if primed:
+            # the cross-attention K/V were already projected by `prime_kv_cache`
+            rows = 1 if cache.shared else qx.shape[0]
+            k, v = [x.expand(qx.shape[0], -1, -1, -1) for x in cache.read(rows, cache.length)]
+        else:
+            if self.qkv:
+                k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
+                v = self.split_heads(v, kv_positions)
+            else:
+                k, v = self.project_kv(kvx, kv_positions)
+            if cache is not None:
+                if cache.kv_blocks is not None:
+                    cache.store(cache.kv_blocks.index(k.shape[0], kv_positions), k.transpose(1,2), v.transpose(1,2))
+                elif kv_positions.dim() == 2:
+                    # every batch row is at a different position (continuous batching)
+                    rows = torch.arange(k.shape[0], device=k.device).unsqueeze(1)
+                    cache.store((rows, slice(None), kv_positions), k.transpose(1,2), v.transpose(1,2))
+                else:
+                    cache.store((slice(None, k.shape[0]), slice(None), kv_positions), k, v)
+                # the entries past `cache.length` are in the future (see `BaseDecoder.bound_self_attention`)
+                k, v = cache.read(k.shape[0], cache.length)
 
         if mask is not None:
             mask = mask[q_positions,:k.shape[-2]]
+            if q_positions.dim() == 2: mask = mask.unsqueeze(1) # add the head dimension
+        if primed and cache.padding_mask is not None:
+            padding_mask = cache.padding_mask[:rows,:,:,:cache.length]
+            mask = padding_mask if mask is None else mask + padding_mask
             
         wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
         
@@ -185,7 +521,8 @@ def rotate_half(x):
     )
 
 def rope_rotate(x, positions, cos, sin):
-    return x * cos[:,positions] + rotate_half(x) * sin[:,positions]
+    # positions can be shared by the whole batch (n,) or separate for every row (b,n)
+    return x * cos[0,positions] + rotate_half(x) * sin[0,positions]
 
 # %% ../nbs/A. Neural modules.ipynb 7
 class ResidualAttentionBlock(nn.Module):
@@ -206,10 +543,10 @@ class ResidualAttentionBlock(nn.Module):
         )
         self.mlp_ln = LayerNorm(n_state)
     
-    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None):
-        self.attn.setup_kv_cache(max_batch_size, max_seq_len)
+    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None, dtype=torch.float32, kv_dtype=None, kv_blocks=None, device=None):
+        self.attn.setup_kv_cache(max_batch_size, max_seq_len, dtype=dtype, kv_dtype=kv_dtype, kv_blocks=kv_blocks, device=device)
         if self.cross_attn:
-            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len)
+            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len, dtype=dtype, kv_dtype=kv_dtype, device=device)
     
     def forward(
         self,
@@ -219,16 +556,29 @@ class ResidualAttentionBlock(nn.Module):
         xa_positions: Optional[Tensor] = None,
         causal = False,
         mask=None,
+        cache=None,
+        cross_cache=None,
     ):
         lnx = self.attn_ln(x)
-        x = x + self.attn(lnx, x_positions, lnx, x_positions, causal=causal, mask=mask)
+        x = x + self.attn(lnx, x_positions, lnx, x_positions, causal=causal, mask=mask, cache=cache)
         if self.cross_attn:
             lnx = self.cross_attn_ln(x)
-            x = x + self.cross_attn(lnx, x_positions, xa, xa_positions)
+            x = x + self.cross_attn(lnx, x_positions, xa, xa_positions, cache=cross_cache)
         x = x + self.mlp(self.mlp_ln(x))
         return x
 
 # %% ../nbs/A. Neural modules.ipynb 8
+class DecodingSession:
+    """A separate set of K/V caches for a decoder (see `BaseDecoder.new_session`).
+
+    All the generation state lives in the caches so several threads can decode at the same time with one copy of
+    the weights, as long as every one of them passes its own session to the model. `caches` holds the
+    `(self-attention, cross-attention)` `KVCache` pair of every layer and `kv_blocks` the block table of
+    the paged self-attention caches."""
+    def __init__(self, caches, kv_blocks=None):
+        self.caches = caches
+        self.kv_blocks = kv_blocks
+
 class BaseDecoder(nn.Module):
     def __init__(self, depth=6, n_head=6, width=384, qk_scale=1, ffn_mult=4, length=2250, rope=False):
         super().__init__()
@@ -244,10 +594,101 @@ class BaseDecoder(nn.Module):
         
         mask = torch.empty(length, length).fill_(-torch.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
-
-    def forward(self, x, x_positions, xenc, xenc_positions):
-        for i,l in enumerate(self.layers):
-            x = l(x, x_positions, xenc, xenc_positions, causal=self.training, mask=self.mask if not self.training else None)
+        self.attn_bucket = None
+        self.kv_blocks = None
+
+    def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len, dtype=torch.float32, kv_dtype=None, block_size=None, num_blocks=None):
+        """Allocates the K/V caches of all the layers.
+
+        With `block_size` the self-attention caches are paged: the positions of every batch row are stored in
+        blocks of `block_size` entries taken from a shared pool as the row grows (see `reserve_kv_cache`) so the
+        memory use follows the number of tokens we actually generate instead of `max_batch_size * max_seq_len`.
+        The pool starts with `num_blocks` blocks (by default enough for one full-length row) and grows on demand."""
+        self.kv_blocks = None
+        if block_size is not None:
+            num_blocks = num_blocks or math.ceil(max_seq_len / block_size) + 1
+            self.kv_blocks = KVBlockTable(max_batch_size, max_seq_len, block_size, num_blocks, device=self.mask.device)
+        for l in self.layers:
+            l.setup_kv_cache(max_batch_size, max_seq_len, max_cross_seq_len, dtype=dtype, kv_dtype=kv_dtype, kv_blocks=self.kv_blocks,
+                             device=self.mask.device)
+
+    def new_session(self):
+        """Returns a `DecodingSession` with new, empty K/V caches laid out like the default ones (see `setup_kv_cache`).
+
+        All the methods that use the caches take an optional `session`, without it they use the default caches
+        stored in the layers."""
+        kv_blocks = self.kv_blocks.new_empty() if self.kv_blocks is not None else None
+        return DecodingSession([(l.attn.kv_cache.new_empty(kv_blocks), l.cross_attn.kv_cache.new_empty()) for l in self.layers], kv_blocks)
+
+    def _caches(self, session):
+        # the (self-attention, cross-attention) K/V caches of every layer
+        if session is not None: return session.caches
+        return [(l.attn.kv_cache, l.cross_attn.kv_cache) for l in self.layers]
+
+    def reserve_kv_cache(self, rows, length, session=None):
+        """Makes sure the paged self-attention caches of `rows` (a row count or a list of rows) have room for
+        `length` positions, growing the pool of blocks if needed. Does nothing for regular caches."""
+        kvb = self.kv_blocks if session is None else session.kv_blocks
+        if kvb is None: return
+        rows = range(rows) if isinstance(rows, int) else rows
+        missing = sum(kvb.missing(row, length) for row in rows)
+        if missing > len(kvb.free):
+            # grow geometrically so we do not reallocate the pools (and recompile) on every new block
+            n = max(missing - len(kvb.free), kvb.num_blocks // 2)
+            for cache, _ in self._caches(session): cache.grow(n)
+            kvb.add_blocks(n)
+        for row in rows: kvb.reserve(row, length)
+
+    def release_kv_cache(self, rows=None, session=None):
+        """Returns the blocks of the paged self-attention caches of `rows` (by default all of them) to the pool."""
+        kvb = self.kv_blocks if session is None else session.kv_blocks
+        if kvb is None: return
+        for row in range(len(kvb.blocks)) if rows is None else rows: kvb.release(row)
+
+    @property
+    def kv_cache_bucket(self):
+        # the granularity of `bound_self_attention`
+        return self.attn_bucket or (self.kv_blocks.block_size if self.kv_blocks is not None else None)
+
+    def snapshot_kv_cache(self, row, length, session=None):
+        """Copies the self-attention K/V caches of the first `length` positions of `row` in every layer."""
+        return [cache.state(row, length) for cache, _ in self._caches(session)]
+
+    def restore_kv_cache(self, snapshot, rows, session=None):
+        """Copies a `snapshot_kv_cache` snapshot into `rows` (a row count or a list of rows)."""
+        rows = range(rows) if isinstance(rows, int) else rows
+        self.reserve_kv_cache(rows, snapshot[0][0].shape[1], session=session)
+        for row in rows:
+            for (cache, _), state in zip(self._caches(session), snapshot): cache.load_state(row, state)
+
+    def bound_self_attention(self, length, session=None):
+        """Limits the self-attention to the first `length` KV cache entries during generation.
+
+        The length is rounded up to a multiple of `attn_bucket` so `torch.compile` only has to trace one
+        graph per bucket. Does nothing if `attn_bucket` is not set (and `None` resets it to the whole cache).
+        Paged caches are always bounded (by default to whole blocks) since reading them means gathering the blocks."""
+        bucket = self.kv_cache_bucket
+        if length is not None and bucket is not None:
+            length = min(math.ceil(length / bucket) * bucket, self.mask.shape[0])
+        else:
+            length = None
+        for cache, _ in self._caches(session):
+            cache.length = length
+
+    def prime_cross_kv_cache(self, xenc, xenc_positions, rows=None, padding_mask=None, session=None):
+        """Computes the cross-attention K/V for all layers once per generation."""
+        for l, (_, cache) in zip(self.layers, self._caches(session)):
+            l.cross_attn.prime_kv_cache(xenc, xenc_positions, rows=rows, padding_mask=padding_mask, cache=cache)
+
+    def invalidate_cross_kv_cache(self, session=None):
+        for l, (_, cache) in zip(self.layers, self._caches(session)):
+            l.cross_attn.invalidate_kv_cache(cache=cache)
+
+    def forward(self, x, x_positions, xenc, xenc_positions, session=None):
+        caches = [(None, None)] * len(self.layers) if session is None else session.caches
+        for i,(l,(cache,cross_cache)) in enumerate(zip(self.layers, caches)):
+            x = l(x, x_positions, xenc, xenc_positions, causal=self.training, mask=self.mask if not self.training else None,
+                  cache=cache, cross_cache=cross_cache)
 
         x = self.ln_post(x)
 
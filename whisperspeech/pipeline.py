@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/7. Pipeline.ipynb.
 
 # %% auto 0
-__all__ = ['Pipeline']
+__all__ = ['split_text', 'Pipeline']
 
 # %% ../nbs/7. Pipeline.ipynb 1
 from os.path import expanduser
@@ -9,11 +9,50 @@ import torch
 from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
 from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
 from whisperspeech.a2wav import Vocoder
-from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond
+from whisperspeech import inference
+from whisperspeech.continuous_batching import T2SScheduler, S2AScheduler
+from whisperspeech.speaker_cache import SpeakerCache, file_hash
+from whisperspeech.stage_pipeline import StagePipeline
+from whisperspeech.request_batching import RequestBatcher
 import traceback
+import asyncio
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
 # %% ../nbs/7. Pipeline.ipynb 2
+def _split_fragment(text, fits, patterns):
+    if fits(text): return [text]
+    if not patterns:
+        # a single word over the limit, we have to cut it
+        n = len(text)
+        while n > 1 and not fits(text[:n]): n -= 1
+        return [text[:n]] + _split_fragment(text[n:], fits, patterns)
+    return [x for part in re.split(patterns[0], text) if part for x in _split_fragment(part, fits, patterns[1:])]
+
+def split_text(text, max_bytes=548, max_chars=None):
+    """Splits `text` into chunks of whole sentences that are at most `max_bytes` long in UTF-8
+    and have at most `max_chars` characters.
+
+    Sentences over the limit are split on punctuation and, if that is not enough, on spaces."""
+    fits = lambda x: len(x.encode('utf-8')) <= max_bytes and (max_chars is None or len(x) <= max_chars)
+    chunks = []
+    for sentence in re.split(r'(?<=[.!?…])\s+', text.strip()):
+        if chunks and fits(chunks[-1] + " " + sentence):
+            chunks[-1] += " " + sentence
+            continue
+        # start a new chunk and split the sentence if it's too long
+        fragments = _split_fragment(sentence, fits, [r'(?<=[,;:])\s+', r'\s+'])
+        chunks.append(fragments[0])
+        for fragment in fragments[1:]:
+            if fits(chunks[-1] + " " + fragment): chunks[-1] += " " + fragment
+            else: chunks.append(fragment)
+    return chunks
+
+# %% ../nbs/7. Pipeline.ipynb 3
 class Pipeline:
     default_speaker = torch.tensor(
        [-0.2929, -0.4503,  0.4155, -0.1417,  0.0473, -0.1624, -0.2322,  0.7071,
@@ -42,42 +81,133 @@ class Pipeline:
          0.2702,  0.1699, -0.1443, -0.9614,  0.3261,  0.1718,  0.3545, -0.0686]
     )
     
-    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None):
+    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None, max_batch_size=1, ttoks_buckets=None,
+                 speaker_cache=None, bundle=None, parallel_load=True, dtype=None, quantize=None, kv_dtype=None, kv_block_size=None,
+                 max_sessions=4):
+        """`speaker_cache` can be a path to an `.npz` file that will keep the extracted (and registered)
+        speaker embeddings across restarts or a `SpeakerCache` instance (by default they are only cached in memory).
+
+        `bundle` loads all the models from a file created with `save_bundle` (the model references and
+        optimization settings are ignored in this case). The bundle weights are memory-mapped on the CPU and, unlike
+        the weights of `.safetensors` model files which `optimize` copies, stay shared by all the processes loading them.
+
+        `dtype`, `quantize`, `kv_dtype` and `kv_block_size` are passed to the models `optimize` methods, by default we run in fp16 on GPUs
+        and in bf16 or fp32 (depending on the CPU capabilities) on the CPU.
+
+        With `parallel_load` the T2S, S2A and Vocos models are loaded (and optimized) in separate threads.
+        The time spent in every stage (in seconds) is stored in `startup_times`.
+
+        All the `generate` methods can be called from several threads at once, every concurrent call decodes
+        with its own KV caches (see `DecodingSession`) while the weights are shared. Up to `max_sessions` idle
+        sets of caches are kept for reuse, the ones created for more concurrent calls are freed afterwards."""
+        start = time.perf_counter()
+        self.startup_times = {}
         if device is None: device = inference.get_compute_device()
         self.device = device
+        self.encoder = None
+        if not isinstance(speaker_cache, SpeakerCache): speaker_cache = SpeakerCache(speaker_cache)
+        self.speaker_cache = speaker_cache
+        # `None` uses the caches created by `optimize`, extra sessions are only allocated for concurrent callers
+        self.free_sessions = [(None, None)]
+        self.max_sessions = max_sessions
+        self.sessions_lock = threading.Lock()
+        self.batcher = None # started by the first `agenerate` call
+        if bundle is not None:
+            from whisperspeech.bundle import load_bundle
+            with self._timed('bundle'):
+                self.t2s, self.s2a, self.vocoder = load_bundle(bundle, device=device, torch_compile=torch_compile)
+            self.startup_times['total'] = time.perf_counter() - start
+            return
+        stages = [
+            lambda: self._load_t2s(t2s_ref, device, optimize, dict(max_batch_size=max_batch_size, torch_compile=torch_compile, ttoks_buckets=ttoks_buckets,
+                                                                      dtype=dtype, quantize=quantize, kv_dtype=kv_dtype, kv_block_size=kv_block_size)),
+            lambda: self._load_s2a(s2a_ref, device, optimize, dict(max_batch_size=max_batch_size, torch_compile=torch_compile,
+                                                                      dtype=dtype, quantize=quantize, kv_dtype=kv_dtype, kv_block_size=kv_block_size)),
+            lambda: self._load_vocoder(device),
+        ]
+        if parallel_load:
+            # loading is mostly file I/O and deserialization which do not hold the GIL
+            with ThreadPoolExecutor(len(stages)) as pool:
+                for f in [pool.submit(stage) for stage in stages]: f.result()
+        else:
+            for stage in stages: stage()
+        self.startup_times['total'] = time.perf_counter() - start
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.startup_times[name] = time.perf_counter() - start
+
+    @contextmanager
+    def _session(self):
+        # a (T2S, S2A) session pair for the duration of one request
+        with self.sessions_lock:
+            session = self.free_sessions.pop() if self.free_sessions else None
+        if session is None: session = (self.t2s.new_session(), self.s2a.new_session())
+        try: yield session
+        finally:
+            with self.sessions_lock:
+                # the default caches are always kept, the extra ones only up to `max_sessions`
+                if session[0] is None or len(self.free_sessions) < self.max_sessions: self.free_sessions.append(session)
+
+    def _load_t2s(self, t2s_ref, device, optimize, optimize_args):
         args = dict(device = device)
         try:
             if t2s_ref:
                 args["ref"] = t2s_ref
-            self.t2s = TSARTransformer.load_model(**args)  # use obtained compute device
-            if optimize: self.t2s.optimize(torch_compile=torch_compile)
+            with self._timed('t2s.load'):
+                self.t2s = TSARTransformer.load_model(**args)  # use obtained compute device
+            if optimize:
+                with self._timed('t2s.optimize'): self.t2s.optimize(**optimize_args)
         except:
             print("Failed to load the T2S model:")
             print(traceback.format_exc())
+
+    def _load_s2a(self, s2a_ref, device, optimize, optimize_args):
         args = dict(device = device)
         try:
-            if s2a_ref:
-                spec = inference.load_model(ref=s2a_ref, device=device)
-                if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
-                    cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
-                    args['spec'] = spec
+            with self._timed('s2a.load'):
+                if s2a_ref:
+                    spec = inference.load_model(ref=s2a_ref, device=device)
+                    if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
+                        from whisperspeech import s2a_delar_mup_wds_mlang_cond
+                        cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
+                        args['spec'] = spec
+                    else:
+                        cls = SADelARTransformer
+                        args['spec'] = spec
                 else:
                     cls = SADelARTransformer
-                    args['spec'] = spec
-            else:
-                cls = SADelARTransformer
-            self.s2a = cls.load_model(**args)  # use obtained compute device
-            if optimize: self.s2a.optimize(torch_compile=torch_compile)
+                self.s2a = cls.load_model(**args)  # use obtained compute device
+            if optimize:
+                with self._timed('s2a.optimize'): self.s2a.optimize(**optimize_args)
         except:
             print("Failed to load the S2A model:")
             print(traceback.format_exc())
 
-        self.vocoder = Vocoder(device=device)
-        self.encoder = None
+    def _load_vocoder(self, device):
+        with self._timed('vocoder.load'):
+            self.vocoder = Vocoder(device=device)
+
+    def save_bundle(self, fname):
+        """Saves the optimized models and the vocoder into a single file for fast loading (see `bundle`)."""
+        from whisperspeech.bundle import save_bundle
+        save_bundle(self, fname)
 
     def extract_spk_emb(self, fname):
         """Extracts a speaker embedding from the first 30 seconds of the give audio file.
+
+        The embeddings are cached by the file contents hash (see `speaker_cache`).
         """
+        digest = file_hash(fname)
+        spk_emb = self.speaker_cache.get(digest)
+        if spk_emb is None:
+            spk_emb = self._extract_spk_emb(fname)
+            self.speaker_cache.put(digest, spk_emb)
+        return spk_emb.to(self.device)
+
+    def _extract_spk_emb(self, fname):
         import torchaudio
         if self.encoder is None:
             device = self.device
@@ -99,18 +229,142 @@ class Pipeline:
         spk_emb = self.encoder.encode_batch(samples.unsqueeze(0))
         
         return spk_emb[0,0].to(self.device)
+
+    def register_speaker(self, name, speaker):
+        """Saves a speaker embedding (or the embedding extracted from an audio file) under `name`.
+
+        Afterwards `name` can be passed as the `speaker` to all the `generate` methods."""
+        if isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
+        self.speaker_cache.register(name, speaker)
+
+    def get_speaker(self, speaker=None):
+        """Returns the speaker embedding for a registered speaker name, an audio file path,
+        an embedding tensor or `None` (the default speaker)."""
+        if speaker is None: return self.default_speaker
+        if isinstance(speaker, str):
+            spk_emb = self.speaker_cache.get_named(speaker)
+            if spk_emb is not None: return spk_emb.to(self.device)
+        if isinstance(speaker, (str, Path)): return self.extract_spk_emb(speaker)
+        return speaker
         
     def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        if speaker is None: speaker = self.default_speaker
-        elif isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
+        speaker = self.get_speaker(speaker)
         text = text.replace("\n", " ")
-        stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
-        atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback)
+        with self._session() as (t2s_session, s2a_session):
+            stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback, session=t2s_session)[0]
+            atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback, session=s2a_session)
         return atoks
         
     def generate(self, text, speaker=None, lang='en', cps=15, step_callback=None):
         return self.vocoder.decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback))
     
+    def generate_candidates(self, text, n=4, speaker=None, lang='en', cps=15, step_callback=None):
+        """Generates `n` alternative renditions of `text` (the T2S encoder runs only once for all of them).
+
+        Needs a Pipeline created with `max_batch_size >= n`."""
+        speaker = self.get_speaker(speaker)
+        text = text.replace("\n", " ")
+        with self._session() as (t2s_session, s2a_session):
+            stokss = self.t2s.generate_candidates(text, n=n, cps=cps, lang=lang, step=step_callback, session=t2s_session)
+            atokss = S2AScheduler(self.s2a, session=s2a_session).generate(stokss, [speaker] * n)
+        return [self.vocoder.decode(atoks) for atoks in atokss]
+
+    def generate_stream(self, text, speaker=None, lang='en', cps=15, step_callback=None, chunk_len=75, overlap=12):
+        """Generates speech like `generate` but yields it in audio chunks of roughly `chunk_len` EnCodec frames
+        (75 frames per second) as soon as they are vocoded. Chunk boundaries are crossfaded over `overlap` frames."""
+        speaker = self.get_speaker(speaker)
+        text = text.replace("\n", " ")
+        with self._session() as (t2s_session, s2a_session):
+            stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback, session=t2s_session)[0]
+            atoks_chunks = self.s2a.generate_chunks(stoks, speaker.unsqueeze(0), step=step_callback, chunk_len=chunk_len, session=s2a_session)
+            yield from self.vocoder.decode_stream(atoks_chunks, overlap=overlap)
+
+    def generate_long(self, text, speaker=None, lang='en', cps=15, overlap=6):
+        """Generates speech for texts of any length.
+
+        The text is split on sentence boundaries into chunks that fit into the T2S context (both the text
+        length and the ~30 seconds of generated speech) and all the chunks are generated in batches.
+        The audio is joined with `overlap` frame crossfades. Returns a `(1, samples)` audio tensor (with no
+        samples if the text is empty).
+
+        The chunks are decoded `max_batch_size` at a time (one per K/V cache row), so to batch them the Pipeline
+        has to be created with `max_batch_size > 1`."""
+        speaker = self.get_speaker(speaker)
+        text = text.replace("\n", " ")
+        # leave some headroom since the speaking rate is only approximately equal to `cps`
+        max_chars = int(0.8 * cps * self.t2s.stoks_len / 25)
+        chunks = [x for x in split_text(text, max_bytes=self.t2s.ttoks_len - 2, max_chars=max_chars) if x]
+        with self._session() as (t2s_session, s2a_session):
+            stokss = T2SScheduler(self.t2s, session=t2s_session).generate(chunks, cps=cps, lang=lang)
+            stokss = [x for x in stokss if len(x)]
+            atokss = S2AScheduler(self.s2a, session=s2a_session).generate(stokss, [speaker] * len(stokss))
+        if not atokss: return torch.zeros((1, 0), device=self.vocoder.device)
+        return self.vocoder.stitch(self.vocoder.decode_batch(atokss), overlap=overlap)
+
+    def generate_pipelined(self, text, speaker=None, lang='en', cps=15, queue_size=2, threads=None):
+        """Generates speech sentence by sentence and yields the audio of every sentence as soon as it is vocoded.
+
+        T2S, S2A and the vocoder run in separate threads (see `StagePipeline`) so sentence k+1 can be in T2S while
+        sentence k is in S2A and sentence k-1 is being vocoded. `text` can also be a list of sentences.
+        `threads` (e.g. `(4, 8, 2)`) are the PyTorch CPU thread budgets of the T2S, S2A and vocoder stages."""
+        speaker = self.get_speaker(speaker)
+        if isinstance(text, str):
+            max_chars = int(0.8 * cps * self.t2s.stoks_len / 25) # see `generate_long`
+            sentences = re.split(r'(?<=[.!?…])\s+', text.replace("\n", " ").strip())
+            text = [x for sentence in sentences if sentence for x in split_text(sentence, max_bytes=self.t2s.ttoks_len - 2, max_chars=max_chars)]
+        with self._session() as (t2s_session, s2a_session):
+            def t2s(txt):
+                return self.t2s.generate(txt, cps=cps, lang=lang, show_progress_bar=False, session=t2s_session)[0]
+            def s2a(stoks):
+                if not len(stoks): return None
+                return self.s2a.generate(stoks, speaker.unsqueeze(0), show_progress_bar=False, session=s2a_session)
+            def vocoder(atoks):
+                if atoks is None: return None
+                return self.vocoder.decode(atoks)
+            for audio in StagePipeline([t2s, s2a, vocoder], queue_size=queue_size, threads=threads).map(text):
+                if audio is not None: yield audio
+
+    def _batcher(self):
+        with self.sessions_lock:
+            if self.batcher is None: self.batcher = RequestBatcher(self)
+        return self.batcher
+
+    async def agenerate(self, text, speaker=None, lang='en', cps=15):
+        """Same as `generate` but as an asyncio coroutine that does not block the event loop.
+
+        The models run in a background inference thread that batches all the concurrent `agenerate`
+        and `agenerate_stream` calls (see `RequestBatcher`), so serving many requests at once is much
+        faster than running them one by one."""
+        loop = asyncio.get_running_loop()
+        # extracting a speaker embedding from an audio file takes a while too
+        speaker = await loop.run_in_executor(None, self.get_speaker, speaker)
+        batcher = self._batcher()
+        req = batcher.submit(text.replace("\n", " "), speaker, lang=lang, cps=cps)
+        try:
+            return await asyncio.wrap_future(req.future)
+        except asyncio.CancelledError:
+            # e.g. `asyncio.wait_for` timed out, the rows are freed for the other requests
+            batcher.cancel(req)
+            raise
+
+    async def agenerate_stream(self, text, speaker=None, lang='en', cps=15, chunk_len=75, overlap=12):
+        """Same as `generate_stream` but as an asyncio generator (batched with the other requests like `agenerate`)."""
+        loop = asyncio.get_running_loop()
+        speaker = await loop.run_in_executor(None, self.get_speaker, speaker)
+        batcher = self._batcher()
+        req = batcher.submit(text.replace("\n", " "), speaker, lang=lang, cps=cps, chunk_len=chunk_len)
+        # the vocoder waits for the chunks in a worker thread
+        audio_chunks = self.vocoder.decode_stream(req.atoks_chunks(), overlap=overlap)
+        done = object()
+        try:
+            while True:
+                audio = await loop.run_in_executor(None, next, audio_chunks, done)
+                if audio is done: return
+                yield audio
+        finally:
+            # stops the generation if the stream was closed (or cancelled) before the end
+            batcher.cancel(req)
+
     def generate_to_file(self, fname, text, speaker=None, lang='en', cps=15, step_callback=None):
         self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
         
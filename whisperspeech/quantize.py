@@ -0,0 +1,30 @@
+"""Weight-only int8/int4 quantization of the linear layers."""
+
+__all__ = ['quantize_model']
+
+import torch
+from pathlib import Path
+from fastcore.script import call_parse
+
+from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
+from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
+from whisperspeech import inference
+
+@call_parse
+def quantize_model(
+    fname:Path, # the source model file
+    output:Path, # the output file (use a `.safetensors` extension to get a file that can be memory-mapped)
+    bits:int=8, # the weight precision (8 or 4)
+):
+    "Stores the linear layer weights of the transformer blocks as int8 or int4 (see `QuantizedLinear`) and the rest in fp16."
+    spec = inference.load_spec(fname)
+    if 'speaker_map' in spec['config']:
+        model = SADelARTransformer.load_model(spec=spec)
+    else:
+        model = TSARTransformer.load_model(spec=spec)
+    model.quantize_weights(f'int{bits}')
+    model.switch_dtypes(torch.float16)
+    if output.suffix == '.safetensors':
+        inference.save_safetensors(model, output)
+    else:
+        model.save_model(output)
@@ -0,0 +1,171 @@
+"""Batching of concurrent generation requests in a background inference thread."""
+
+__all__ = ['BatchedRequest', 'RequestBatcher']
+
+import time
+import queue
+import threading
+import dataclasses
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError
+import torch
+
+from whisperspeech.continuous_batching import T2SRequest, T2SScheduler, S2AScheduler
+
+@dataclasses.dataclass
+class BatchedRequest:
+    txt: str
+    speaker: torch.Tensor
+    lang: str = "en"
+    cps: float = 15
+    chunk_len: int = None # stream the acoustic tokens in chunks of this many frames
+    future: Future = dataclasses.field(default_factory=Future) # receives the audio (for non-streaming requests)
+    chunks: queue.Queue = dataclasses.field(default_factory=queue.Queue) # receives the acoustic token chunks and a final `None`
+    cancelled: bool = False # set by `RequestBatcher.cancel`
+
+    def atoks_chunks(self):
+        """Yields the acoustic token chunks of a streaming request as they arrive (blocks while waiting)."""
+        while True:
+            x = self.chunks.get()
+            if x is None: return
+            if isinstance(x, BaseException): raise x
+            yield x
+
+    def fail(self, exc):
+        if self.chunk_len is not None: self.chunks.put(exc)
+        elif not self.future.done(): self.future.set_exception(exc)
+
+class RequestBatcher:
+    """Runs the T2S and S2A models of a `Pipeline` in a background inference thread and batches all the requests
+    submitted from other threads (or from asyncio coroutines, see `Pipeline.agenerate`).
+
+    When the models are idle, the requests arriving within `window` seconds of the first one are admitted
+    together. While they are decoded, new requests join the running batches in the free slots of the
+    continuous batching schedulers (see `T2SScheduler` and `S2AScheduler`) so every decoding step runs
+    with all the rows it can (up to the `max_batch_size` of the Pipeline) and every row has its own text,
+    language, speaking rate and speaker. The batcher decodes with its own KV caches (see `DecodingSession`)
+    so the regular `generate` methods can still be used at the same time."""
+    def __init__(self, pipe, window=0.02, T=0.7, top_k=None):
+        self.pipe = pipe
+        self.window = window
+        self.T, self.top_k = T, top_k
+        self.queue = queue.Queue()
+        self.finished = collections.deque(maxlen=10000) # (time, number of tokens) of the finished T2S and S2A rows
+        # the finished audio is decoded in another thread so the other rows do not wait for Vocos
+        self.vocoder_thread = ThreadPoolExecutor(1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, txt, speaker, lang="en", cps=15, chunk_len=None):
+        """Queues a request and returns a `BatchedRequest`. The audio is set on its `future` or, with a `chunk_len`,
+        the acoustic tokens are streamed through `atoks_chunks` (the caller vocodes them, see `Vocoder.decode_stream`).
+
+        Cancelling the `future` only works until the request starts decoding, use `cancel` to stop it later."""
+        req = BatchedRequest(txt, speaker, lang=lang, cps=cps, chunk_len=chunk_len)
+        self.queue.put(req)
+        return req
+
+    def tokens_per_second(self, window=60):
+        """The number of semantic and acoustic tokens generated per second over the last `window` seconds."""
+        start = time.monotonic() - window
+        return sum(n for t, n in list(self.finished) if t >= start) / window
+
+    def cancel(self, req):
+        """Stops generating `req` (e.g. because the client went away) so its rows are free for the other requests.
+
+        The rows are dropped from the batch before the next decoding step, then the `future` of the request raises
+        `CancelledError` (and the chunk stream of a streaming request ends)."""
+        req.cancelled = True
+
+    def close(self):
+        """Finishes all the submitted requests and stops the inference thread."""
+        self.queue.put(None)
+        self.thread.join()
+        self.vocoder_thread.shutdown()
+
+    def _schedulers(self):
+        pipe = self.pipe
+        return (T2SScheduler(pipe.t2s, T=self.T, top_k=self.top_k, session=pipe.t2s.new_session()),
+                S2AScheduler(pipe.s2a, T=self.T, top_k=self.top_k, session=pipe.s2a.new_session()))
+
+    def _collect(self, block):
+        # returns the new requests and False after `close`
+        reqs = []
+        try:
+            reqs.append(self.queue.get(block=block))
+        except queue.Empty:
+            return reqs, True
+        if block:
+            # wait a little for more requests so they start decoding in the same batch
+            deadline = time.monotonic() + self.window
+            while reqs[-1] is not None and time.monotonic() < deadline:
+                try: reqs.append(self.queue.get(timeout=deadline - time.monotonic()))
+                except queue.Empty: break
+        while reqs[-1] is not None:
+            try: reqs.append(self.queue.get_nowait())
+            except queue.Empty: break
+        if reqs[-1] is None: return reqs[:-1], False
+        return reqs, True
+
+    def _run(self):
+        t2s, s2a = self._schedulers()
+        pending = {} # scheduler request id -> (scheduler request, BatchedRequest)
+        running = True
+        while running or pending:
+            new, running = self._collect(block=running and not pending) if running else ([], False)
+            for req in new:
+                # from now on the future cannot be cancelled so we can always set its result
+                if not req.future.set_running_or_notify_cancel(): continue
+                x = t2s.submit(req.txt, cps=req.cps, lang=req.lang)
+                pending[id(x)] = (x, req)
+            self._drop_cancelled(t2s, s2a, pending)
+            try:
+                self._step(t2s, s2a, pending)
+            except Exception as e:
+                # the batch state is lost so we fail all the requests in flight and start over
+                for x, req in pending.values(): req.fail(e)
+                pending.clear()
+                t2s, s2a = self._schedulers()
+
+    def _drop_cancelled(self, t2s, s2a, pending):
+        for key, (x, req) in list(pending.items()):
+            if not req.cancelled: continue
+            (t2s if isinstance(x, T2SRequest) else s2a).cancel(x)
+            del pending[key]
+            req.future.set_exception(CancelledError())
+            req.chunks.put(None)
+
+    def _step(self, t2s, s2a, pending):
+        if t2s.busy:
+            for x in t2s.step():
+                self.finished.append((time.monotonic(), len(x.stoks)))
+                req = pending.pop(id(x))[1]
+                if len(x.stoks):
+                    y = s2a.submit(x.stoks, req.speaker, chunk_len=req.chunk_len)
+                    pending[id(y)] = (y, req)
+                elif req.chunk_len is not None:
+                    req.chunks.put(None)
+                else:
+                    req.future.set_result(torch.zeros((1, 0)))
+        if s2a.busy:
+            finished = s2a.step()
+            # pass on the chunks of the streaming requests as soon as they are sampled
+            for x in s2a.slots + finished:
+                if x is None or x.chunk_len is None: continue
+                req = pending[id(x)][1]
+                while x.chunks: req.chunks.put(x.chunks.pop(0))
+            done = []
+            for x in finished:
+                self.finished.append((time.monotonic(), x.atoks.numel()))
+                req = pending.pop(id(x))[1]
+                if req.chunk_len is not None: req.chunks.put(None)
+                else: done.append((x, req))
+            if done: self.vocoder_thread.submit(self._vocode, done)
+
+    def _vocode(self, done):
+        try:
+            audios = self.pipe.vocoder.decode_batch([x.atoks for x, req in done])
+        except Exception as e:
+            for x, req in done: req.fail(e)
+            return
+        for (x, req), audio in zip(done, audios): req.future.set_result(audio)
@@ -18,7 +18,6 @@ import torch.nn.functional as F
 import numpy as np
 from torch.profiler import profile, record_function, ProfilerActivity, schedule
 from fastcore.basics import store_attr
-from huggingface_hub import hf_hub_download
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 3
 from pathlib import Path
@@ -316,6 +315,7 @@ class SADelARTransformer(nn.Module):
         self.width = width
         self.base_width = 3 * head_width
         self.tunables = tunables
+        self.quantize = None
         
         if stoks_width is None: stoks_width = width
         if spk_width is None: spk_width = width
@@ -447,14 +447,14 @@ class SADelARTransformer(nn.Module):
         
         return xenc + cond_embs.unsqueeze(1), positions, enc_logits
 
-    def forward(self, Stoks, Atoks, conds, out_stoks=None, out_atoks=None, noloss=False, xenc=None, xenc_positions=None, atoks_positions=None):
+    def forward(self, Stoks, Atoks, conds, out_stoks=None, out_atoks=None, noloss=False, xenc=None, xenc_positions=None, atoks_positions=None, session=None):
         if xenc is None:
             Stoks, Atoks = [x.to(dtype=torch.long) for x in (Stoks, Atoks)]
             xenc, xenc_positions, enc_logits = self.run_encoder(Stoks, conds)
         with record_function("decoder"):
             embs = self.embds(Atoks, xenc)
             if atoks_positions is None: atoks_positions = torch.arange(0, embs.shape[1], device=embs.device)
-            x = self.decoder(embs, atoks_positions, xenc, xenc_positions)
+            x = self.decoder(embs, atoks_positions, xenc, xenc_positions, session=session)
             logits = self.head(x, embeddings=self.embds.embeddings)
             logits *= self.tunables.output_mult / (self.width / self.base_width)
             
@@ -498,7 +498,7 @@ class SADelARTransformer(nn.Module):
         spec = inference.load_model(ref=ref, spec=spec, device=device)
         if '_extra_state' not in spec['state_dict'] and 'speaker_map' in spec['config']: spec['state_dict']['_extra_state'] = { 'speaker_map': spec['config']['speaker_map'] }
         model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
-        model.load_state_dict(spec['state_dict'])
+        inference.load_state_dict(model, spec)
         model.eval().to(device)
         return model
     
@@ -532,9 +532,32 @@ class SADelARTransformer(nn.Module):
                 m.to(dtype)
             # take care of buffers ([kv]_cache, masks) that are not in the leaf layers
             for bn,b in m.named_buffers(recurse=False):
-                setattr(m,bn,b.to(dtype))
-
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
+                if b.is_floating_point(): setattr(m,bn,b.to(dtype)) # skip the quantized weights
+
+    def quantize_weights(self, quantize):
+        """Quantizes the linear layers of the transformer blocks (and the output head). `quantize` can be `'int8'` or `'int4'`
+        (weight-only, see `QuantizedLinear`) or `'dynamic'` (int8 weights and activations, CPU only)."""
+        blocks = [*self.encoder, *self.decoder.layers, self.head]
+        if quantize == 'dynamic':
+            inference.quantize_dynamic(blocks)
+        else:
+            quantize_linears(blocks, bits={'int8': 8, 'int4': 4}[quantize])
+        self.quantize = quantize
+
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=True, attn_bucket=None, quantize=None, kv_dtype=None, kv_block_size=None):
+        """Prepares the model for inference.
+
+        `attn_bucket` (e.g. `256`) makes the decoder self-attention skip the empty part of the KV cache
+        (`torch.compile` traces one graph per bucket).
+        `dtype` defaults to fp16 on GPUs and to bf16 or fp32 on the CPU (see `inference.default_dtype`).
+        `quantize` quantizes the linear layers of the transformer blocks (see `quantize_weights`), with `'dynamic'`
+        the rest of the model stays in fp32.
+        `kv_dtype=torch.int8` halves the memory used by the K/V caches (so we can fit a larger `max_batch_size`).
+        `kv_block_size` (e.g. `64`) pages the self-attention K/V caches so they only take memory for the tokens
+        we generate (see `BaseDecoder.setup_kv_cache`), `torch.compile` traces one graph per block count if
+        `attn_bucket` is not set."""
+        if dtype is None: dtype = torch.float32 if quantize == 'dynamic' else inference.default_dtype(self.device)
+        self.decoder.attn_bucket = attn_bucket
         for emb in self.embds.embeddings:
             emb.convert_for_eval()
         for l in self.encoder:
@@ -542,10 +565,21 @@ class SADelARTransformer(nn.Module):
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.ctx_n, self.stoks_len)
+        # before switching the dtypes so we quantize the full precision weights
+        if quantize: self.quantize_weights(quantize)
         self.switch_dtypes(dtype)
-        if torch_compile:
-            self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
+        self.decoder.setup_kv_cache(max_batch_size, self.ctx_n, self.stoks_len, dtype=dtype, kv_dtype=kv_dtype, block_size=kv_block_size)
+        if torch_compile: self.compile_generate()
+
+    def compile_generate(self):
+        """`torch.compile`s the decoding step for the device the model is on (called by `optimize`)."""
+        attn_bucket = self.decoder.kv_cache_bucket
+        if attn_bucket: inference.allow_recompiles(8 * math.ceil(self.ctx_n / attn_bucket))
+        fullgraph = self.quantize != 'dynamic'
+        # the dynamically quantized layers cannot be traced so we get a graph break around each of them
+        # and the code after the break is compiled separately for every layer
+        if not fullgraph: inference.allow_recompiles(8 * len(self.decoder.layers))
+        self.generate_next = inference.compile(self.generate_next, self.device, fullgraph=fullgraph)
             
     def optimize_training(self):
         self.decoder = torch.compile(self.decoder, fullgraph=True, mode="reduce-overhead")
@@ -555,8 +589,13 @@ class SADelARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k):
-        probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
+    def new_session(self):
+        """Returns a `DecodingSession` with its own K/V caches. Passing a different session to every concurrent call of
+        `generate` (or `generate_chunks`) lets several threads share one copy of the model."""
+        return self.decoder.new_session()
+
+    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k, session=None):
+        probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions, session=session)
         probs = probs[:,:,-1]
         return inference.sample(probs, T, top_k)
 
@@ -564,7 +603,51 @@ class SADelARTransformer(nn.Module):
         return self.generate_one(*args, **kwargs)
     
     @torch.no_grad()
-    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False):
+    def prefill_prompt(self, stoks, speakers, atoks_prompt, langs=None, session=None):
+        """Runs the encoder and prefills the decoder with `atoks_prompt` once, returns an `inference.PromptSnapshot`
+        that `generate` and `S2AScheduler.submit` can restore instead of doing it again for every request.
+
+        The snapshot is only valid for the same `stoks` and `speakers`. Uses the first row of the KV cache
+        (so it cannot run while a `S2AScheduler` is busy with the same `session`)."""
+        dev = self.device
+        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
+        speakers = speakers.to(device=dev, dtype=self.dtype)
+        n = atoks_prompt.shape[-1]
+        # with the delay pattern the prompt spans the first n + quantizers positions
+        toks = torch.full((1,self.quantizers,n+self.quantizers), self.codes+1, dtype=torch.long, device=dev)
+        for i in range(self.quantizers):
+            toks[:,i,1+i:n+i+1] = atoks_prompt[:,i]
+        encoder_state = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+        xenc, xenc_positions, _ = encoder_state
+        self.decoder.prime_cross_kv_cache(xenc, xenc_positions, session=session)
+        try:
+            # the last prompt position is left for the first decoding step
+            self.decoder.bound_self_attention(n, session=session)
+            self.decoder.reserve_kv_cache(1, n, session=session)
+            if n > 0:
+                self(None, toks[:,:,:n], None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=torch.arange(n, device=dev),
+                     session=session)
+            kv = self.decoder.snapshot_kv_cache(0, n, session=session)
+        finally:
+            self.decoder.invalidate_cross_kv_cache(session=session)
+            self.decoder.bound_self_attention(None, session=session)
+            self.decoder.release_kv_cache(session=session)
+        return inference.PromptSnapshot((stoks, speakers), encoder_state, toks, kv)
+
+    @torch.no_grad()
+    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False, prompt_snapshot=None, session=None):
+        """Generates acoustic tokens for `stoks` in the voice of `speakers` (`bs` alternative samples).
+
+        `prompt_snapshot` (see `prefill_prompt`) replaces `atoks_prompt` and skips the encoder and the prompt prefill.
+        `session` (see `new_session`) holds the K/V caches, by default we use the ones set up by `optimize`."""
+        return next(self.generate_chunks(stoks, speakers, langs=langs, atoks_prompt=atoks_prompt, N=N, bs=bs, T=T, top_k=top_k,
+                                         show_progress_bar=show_progress_bar, step=step, chunk_len=None, prompt_snapshot=prompt_snapshot,
+                                         session=session))
+
+    @torch.no_grad()
+    def generate_chunks(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, chunk_len=75, prompt_snapshot=None, session=None):
+        """Same as `generate` but yields the acoustic tokens in chunks of `chunk_len` frames as soon as all
+        the quantizers for them are sampled (with `chunk_len=None` everything is returned in one final chunk)."""
         dev = self.device
         N = N or len(stoks) * 3
         stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
@@ -573,36 +656,71 @@ class SADelARTransformer(nn.Module):
         T = torch.tensor(T, device=dev)
 
         start = 0 # number of valid tokens or the index of first empty spot
-        if atoks_prompt is not None:
+        if prompt_snapshot is not None:
+            assert atoks_prompt is None, "the prompt is already in the snapshot"
+            assert prompt_snapshot.matches(stoks, speakers), "the prompt snapshot was made for different inputs"
+            start = prompt_snapshot.length
+            toks[:,:,:prompt_snapshot.toks.shape[-1]] = prompt_snapshot.toks
+        elif atoks_prompt is not None:
             start = atoks_prompt.shape[-1]
             for i in range(self.quantizers):
                 toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
         start += 1 # we always start with at least an SOT
+        emitted = 0 # number of frames already yielded
+
+        def delayed_frames(t0, t1):
+            # undo the delay pattern: quantizer j of frame t is stored at position t + j + 1
+            return torch.stack([toks[:,j,1+t0+j:1+t1+j] for j in range(self.quantizers)], dim=1)
 
         with record_function("encode"):
-            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
-            xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+            # all the batch rows share the same input so we run the encoder only once
+            if prompt_snapshot is not None:
+                xenc, xenc_positions, _ = prompt_snapshot.encoder_state
+            else:
+                xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
             toks_positions = torch.arange(N, device=dev)
-        with record_function("prefill"):
-            initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k)
-            toks[:,:start,start:start+1] = initial[:,:start]
-            start += 1
-            
-        with inference.inference_context():
-            it = range(start,min(N,self.ctx_n-1))
-            if show_progress_bar: it = progress_bar(it)
-
-            for i in it:
-                with record_function("generate_one"):
-                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k)[:,:i]
-
-                # for profiling, debugging or early exit
-                if step is not None: step()
+            self.decoder.prime_cross_kv_cache(xenc, xenc_positions, session=session)
+            xenc = xenc.expand(bs, -1, -1)
+
+        try:
+            with record_function("prefill"):
+                if prompt_snapshot is not None:
+                    # the first decoding step feeds the last prompt position
+                    self.decoder.restore_kv_cache(prompt_snapshot.kv, bs, session=session)
+                else:
+                    self.decoder.bound_self_attention(start, session=session)
+                    self.decoder.reserve_kv_cache(bs, start, session=session)
+                    initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k, session=session)
+                    toks[:,:start,start:start+1] = initial[:,:start]
+                    start += 1
+
+            with inference.inference_context():
+                it = range(start,min(N,self.ctx_n-1))
+                if show_progress_bar: it = progress_bar(it)
+
+                for i in it:
+                    self.decoder.bound_self_attention(i, session=session)
+                    self.decoder.reserve_kv_cache(bs, i, session=session)
+                    with record_function("generate_one"):
+                        toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k,
+                                                              session=session)[:,:i]
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+
+                    # after sampling position i all the quantizers of frames up to i - quantizers are known
+                    if chunk_len is not None and min(i - self.quantizers + 1, N-4) - emitted >= chunk_len:
+                        yield delayed_frames(emitted, emitted + chunk_len)
+                        emitted += chunk_len
+        finally:
+            self.decoder.invalidate_cross_kv_cache(session=session)
+            self.decoder.bound_self_attention(None, session=session)
+            self.decoder.release_kv_cache(session=session)
         # shift tokens
         toks = toks[:,:,1:N]
         for j in range(self.quantizers):
             toks[:, j] = torch.roll(toks[:, j], -j)
-        return toks[:,:,:N-4]
+        yield toks[:,:,emitted:N-4]
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling with conditioning.ipynb 15
 def _make_model(size:str, quantizers:int=4, tunables:Tunables=Tunables(), **kwargs):
@@ -0,0 +1,252 @@
+"""A local HTTP server that streams the synthesized speech (`python -m whisperspeech.serve`)."""
+
+__all__ = ['SynthesisServer', 'serve']
+
+import json
+import time
+import struct
+import threading
+import traceback
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+from fastcore.script import call_parse
+
+from whisperspeech import languages
+from whisperspeech.pipeline import Pipeline, split_text
+from whisperspeech.request_batching import RequestBatcher
+
+SAMPLE_RATE = 24000
+
+def _wav_header():
+    # the length is unknown when we start streaming so we use the largest sizes (players read until the end of the data)
+    fmt = struct.pack('<HHIIHH', 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16) # PCM, mono, 16 bit
+    return b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + b'data' + struct.pack('<I', 0xFFFFFFFF)
+
+def _pcm16(audio):
+    return (audio.reshape(-1).float().clamp(-1, 1) * 32767).to(torch.int16).cpu().numpy().tobytes()
+
+class _BadRequest(Exception): pass
+
+class _Metrics:
+    # the admission counter and the numbers reported by `/metrics`
+    def __init__(self, max_queue):
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counts = collections.Counter()
+        self.ttfbs = collections.deque(maxlen=1000)
+
+    def admit(self):
+        with self.lock:
+            if self.in_flight >= self.max_queue:
+                self.counts['rejected'] += 1
+                return False
+            self.in_flight += 1
+            self.counts['accepted'] += 1
+            return True
+
+    def release(self, failed=False):
+        with self.lock:
+            self.in_flight -= 1
+            self.counts['failed' if failed else 'completed'] += 1
+
+    def ttfb_quantiles(self, qs=(0.5, 0.95)):
+        ttfbs = sorted(self.ttfbs)
+        if not ttfbs: return {}
+        return {q:ttfbs[min(int(q * len(ttfbs)), len(ttfbs) - 1)] for q in qs}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # needed for the chunked transfer encoding
+
+    def _send(self, code, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes): body = (json.dumps(body) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k,v in (headers or {}).items(): self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == '/health': self._send(200, dict(status='ok'))
+        elif self.path == '/metrics': self._send(200, self.server.metrics_text().encode(), 'text/plain; version=0.0.4')
+        else: self._send(404, dict(error='not found'))
+
+    def do_POST(self):
+        start = time.monotonic()
+        if self.path not in ('/synthesize', '/tts'):
+            self.close_connection = True # we did not read the body
+            return self._send(404, dict(error='not found'))
+        try:
+            args = self.server.parse_request(self._read_json())
+        except _BadRequest as e:
+            self.close_connection = True
+            return self._send(400, dict(error=str(e)))
+        if not self.server.metrics.admit():
+            # backpressure: the client should retry later (or go to another replica)
+            return self._send(503, dict(error='too many requests in the queue'), headers={'Retry-After': '1'})
+        failed = True
+        try:
+            self._stream(start, **args)
+            failed = False
+        except (BrokenPipeError, ConnectionResetError):
+            pass # the client went away
+        except Exception:
+            traceback.print_exc()
+            # the status line is already sent so we can only break off the response
+            self.close_connection = True
+        finally:
+            self.server.metrics.release(failed=failed)
+        if not failed:
+            # the request is released (and counted as completed) before the client sees the end of the response,
+            # so a client that sends the next request right away never finds its own request still in the queue
+            try:
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    def _read_json(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            raise _BadRequest('invalid Content-Length')
+        if length < 0: raise _BadRequest('invalid Content-Length')
+        if length > self.server.max_request_bytes: raise _BadRequest('the request is too large')
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            raise _BadRequest('the request body is not valid JSON')
+
+    def _stream(self, start, txts, speaker, lang, cps, format):
+        server = self.server
+        # all the text fragments are batched together, the audio is streamed in order and crossfaded like in `Pipeline.generate_long`
+        reqs = [server.batcher.submit(txt, speaker, lang=lang, cps=cps, chunk_len=server.chunk_len) for txt in txts]
+        vocoder = server.pipe.vocoder
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/wav' if format == 'wav' else f'audio/L16; rate={SAMPLE_RATE}; channels=1')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        first = True
+        try:
+            if format == 'wav': self._write_chunk(_wav_header())
+            streams = (vocoder.decode_stream(req.atoks_chunks(), overlap=server.overlap) for req in reqs)
+            for audio in vocoder.stitch_stream(streams):
+                self._write_chunk(_pcm16(audio))
+                if first:
+                    server.metrics.ttfbs.append(time.monotonic() - start)
+                    first = False
+        except BaseException:
+            # the client went away (or we failed), free the batch rows of the fragments still being generated
+            for req in reqs: server.batcher.cancel(req)
+            raise
+
+    def log_message(self, format, *args):
+        if self.server.verbose: super().log_message(format, *args)
+
+class SynthesisServer(ThreadingHTTPServer):
+    """An HTTP server that synthesizes speech with `pipe` and streams it to the clients.
+
+    `POST /synthesize` takes a JSON object with the `text` and the optional `lang`, `cps`, `speaker` (the name of
+    a speaker registered with `Pipeline.register_speaker`) and `format` (`wav` or `pcm`: raw 16 bit samples at 24kHz)
+    and streams the audio with the chunked transfer encoding as soon as it is generated. The requests from all
+    the clients are decoded together in batches (see `RequestBatcher`). At most `max_queue` requests are accepted
+    at once, the rest are rejected with `503 Service Unavailable` and a `Retry-After` header.
+
+    `GET /metrics` reports the queue depth, the generation throughput (tokens per second) and the time-to-first-byte
+    in the Prometheus text format."""
+    daemon_threads = True
+
+    def __init__(self, pipe, address=('127.0.0.1', 8080), max_queue=16, batch_window=0.02, chunk_len=75, overlap=12, verbose=False):
+        super().__init__(address, _Handler)
+        self.pipe = pipe
+        self.batcher = RequestBatcher(pipe, window=batch_window)
+        self.metrics = _Metrics(max_queue)
+        self.chunk_len, self.overlap = chunk_len, overlap
+        self.max_request_bytes = 1 << 20
+        self.verbose = verbose
+        self.start_time = time.monotonic()
+
+    def parse_request(self, args):
+        if not isinstance(args, dict): raise _BadRequest('the request should be a JSON object')
+        text = args.get('text')
+        if not isinstance(text, str) or not text.strip(): raise _BadRequest('`text` should be a non-empty string')
+        lang = args.get('lang', 'en')
+        try:
+            languages.to_id(lang)
+        except (ValueError, TypeError):
+            raise _BadRequest(f'unsupported language: {lang}')
+        cps = args.get('cps', 15)
+        if not isinstance(cps, (int, float)) or not 5 <= cps <= 30: raise _BadRequest('`cps` should be a number between 5 and 30')
+        format = args.get('format', 'wav')
+        if format not in ('wav', 'pcm'): raise _BadRequest('`format` should be `wav` or `pcm`')
+        speaker = args.get('speaker')
+        if speaker is None:
+            speaker = self.pipe.default_speaker
+        else:
+            # only registered speakers, the clients should not be able to read files on the server
+            speaker = self.pipe.speaker_cache.get_named(str(speaker))
+            if speaker is None: raise _BadRequest(f'unknown speaker: {args["speaker"]}')
+        t2s = self.pipe.t2s
+        max_chars = int(0.8 * cps * t2s.stoks_len / 25) # see `Pipeline.generate_long`
+        txts = split_text(text.replace("\n", " "), max_bytes=t2s.ttoks_len - 2, max_chars=max_chars)
+        return dict(txts=txts, speaker=speaker.to(self.pipe.device), lang=lang, cps=cps, format=format)
+
+    def metrics_text(self):
+        m = self.metrics
+        with m.lock: in_flight, counts = m.in_flight, dict(m.counts)
+        lines = [
+            "# HELP whisperspeech_queue_depth Requests accepted and not finished yet.",
+            "# TYPE whisperspeech_queue_depth gauge",
+            f"whisperspeech_queue_depth {in_flight}",
+            "# HELP whisperspeech_queue_limit The maximum number of requests accepted at once.",
+            "# TYPE whisperspeech_queue_limit gauge",
+            f"whisperspeech_queue_limit {m.max_queue}",
+            "# HELP whisperspeech_requests_total Requests by outcome.",
+            "# TYPE whisperspeech_requests_total counter",
+            *[f'whisperspeech_requests_total{{outcome="{k}"}} {counts.get(k, 0)}' for k in ['accepted', 'rejected', 'completed', 'failed']],
+            "# HELP whisperspeech_tokens_per_second Semantic and acoustic tokens generated per second (over the last minute).",
+            "# TYPE whisperspeech_tokens_per_second gauge",
+            f"whisperspeech_tokens_per_second {self.batcher.tokens_per_second(min(60, time.monotonic() - self.start_time)):.1f}",
+            "# HELP whisperspeech_ttfb_seconds Time from receiving a request to sending the first audio (the last 1000 requests).",
+            "# TYPE whisperspeech_ttfb_seconds summary",
+            *[f'whisperspeech_ttfb_seconds{{quantile="{q}"}} {t:.4f}' for q, t in m.ttfb_quantiles().items()],
+            f"whisperspeech_ttfb_seconds_count {len(m.ttfbs)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def server_close(self):
+        super().server_close()
+        self.batcher.close()
+
+@call_parse
+def serve(
+    host:str='127.0.0.1', # the address to listen on
+    port:int=8080, # the port to listen on
+    t2s_ref:str=None, # the T2S model reference (see `Pipeline`)
+    s2a_ref:str=None, # the S2A model reference (see `Pipeline`)
+    bundle:str=None, # load the models from a bundle file instead (see `save_bundle`)
+    device:str=None, # the compute device (e.g. `cpu`), autodetected by default
+    max_batch_size:int=4, # the number of requests decoded together
+    max_queue:int=16, # the number of requests accepted at once, the rest get `503` responses
+    batch_window:float=0.02, # how long (in seconds) to wait for more requests before starting a new batch
+    chunk_len:int=75, # the streaming chunk length (in EnCodec frames, 75 per second)
+    torch_compile:bool=False, # compile the models (slower startup, faster generation)
+    speaker_cache:str=None, # the `.npz` file with the registered speakers (see `Pipeline.register_speaker`)
+    verbose:bool=False, # log every request
+):
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, bundle=bundle, device=device, max_batch_size=max_batch_size,
+                    torch_compile=torch_compile, speaker_cache=speaker_cache)
+    server = SynthesisServer(pipe, (host, port), max_queue=max_queue, batch_window=batch_window, chunk_len=chunk_len, verbose=verbose)
+    print(f"Listening on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
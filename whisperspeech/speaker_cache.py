@@ -0,0 +1,104 @@
+"""A cache of speaker embeddings keyed by audio content hash or speaker name."""
+
+__all__ = ['file_hash', 'SpeakerCache']
+
+import os
+import hashlib
+import threading
+import collections
+import numpy as np
+import torch
+from pathlib import Path
+
+def file_hash(fname, block_size=1<<20):
+    """Returns the SHA-256 hex digest of the file contents."""
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class SpeakerCache:
+    """Speaker embeddings keyed by audio content hash or by a registered speaker name.
+
+    Keeps the `maxsize` most recently used embeddings in memory. If `path` is given the embeddings are also
+    stored in an `.npz` bank on disk so they survive restarts and can be shared between processes."""
+    def __init__(self, path=None, maxsize=256):
+        self.path = Path(path).expanduser() if path is not None else None
+        self.maxsize = maxsize
+        self.lru = collections.OrderedDict()
+        self.bank = {}
+        self.lock = threading.Lock()
+        if self.path is not None: self.bank = self._load()
+
+    def __getstate__(self):
+        # locks cannot be pickled (the cache is passed to the `WorkerPool` processes)
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _load(self):
+        if not self.path.exists(): return {}
+        with np.load(self.path) as bank:
+            return dict(bank)
+
+    @staticmethod
+    def _key(key, name=False):
+        return f"name:{key}" if name else f"sha256:{key}"
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                return self.lru[key]
+            if key not in self.bank: return None
+            emb = torch.from_numpy(self.bank[key])
+            self._remember(key, emb)
+            return emb
+
+    def _put(self, key, emb):
+        emb = emb.detach().to('cpu', torch.float32)
+        with self.lock:
+            self._remember(key, emb)
+            if self.path is not None:
+                self.bank[key] = emb.numpy()
+                self._save()
+
+    def _remember(self, key, emb):
+        self.lru[key] = emb
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.maxsize: self.lru.popitem(last=False)
+
+    def _save(self):
+        # keep the speakers added by other processes
+        self.bank = {**self._load(), **self.bank}
+        # write to a temporary file first so readers never see a partial bank
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, **self.bank)
+        os.replace(tmp, self.path)
+
+    def get(self, digest):
+        """Returns the embedding for the audio file with the given content hash (or `None`)."""
+        return self._get(self._key(digest))
+
+    def put(self, digest, emb):
+        self._put(self._key(digest), emb)
+
+    def get_named(self, name):
+        """Returns the embedding registered under `name` (or `None`)."""
+        return self._get(self._key(name, name=True))
+
+    def register(self, name, emb):
+        """Stores `emb` under `name` so it can be used without any audio files."""
+        self._put(self._key(name, name=True), emb)
+
+    @property
+    def names(self):
+        prefix = self._key('', name=True)
+        return sorted({k[len(prefix):] for k in [*self.bank, *self.lru] if k.startswith(prefix)})
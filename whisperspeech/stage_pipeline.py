@@ -0,0 +1,79 @@
+"""Running processing stages in overlapped threads."""
+
+__all__ = ['StagePipeline']
+
+import queue
+import threading
+import torch
+
+_DONE = object() # marks the end of the input
+
+class _Failure:
+    # an exception raised by one of the stages, passed down to the consumer
+    def __init__(self, exc): self.exc = exc
+
+class StagePipeline:
+    """Runs a sequence of processing stages in separate threads connected with bounded queues, so while
+    item k+1 is in the first stage, item k can be in the second and item k-1 in the third.
+
+    `stages` are functions taking the output of the previous stage. `queue_size` limits how many items can wait
+    between two stages (so a fast stage cannot run far ahead of a slow one). `threads` gives the number of
+    PyTorch threads (`torch.set_num_threads`) for every stage thread (`None` keeps the default), this lets us
+    split the CPU cores between the stages instead of having them all compete for every core."""
+    def __init__(self, stages, queue_size=2, threads=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.threads = threads or [None] * len(stages)
+        assert len(self.threads) == len(stages), "we need a thread budget for every stage"
+
+    def _worker(self, stage, threads, inputs, output, stop):
+        # with OpenMP the thread count is a per-thread setting so every stage can have its own
+        if threads: torch.set_num_threads(threads)
+        try:
+            for x in inputs:
+                if not isinstance(x, _Failure): x = stage(x)
+                # the consumer stops at the first failure so there is no point in processing the other items
+                if not self._put(output, x, stop) or isinstance(x, _Failure): return
+        except BaseException as e:
+            self._put(output, _Failure(e), stop)
+            return
+        self._put(output, _DONE, stop)
+
+    @staticmethod
+    def _put(q, x, stop):
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _items(q, stop):
+        while not stop.is_set():
+            try:
+                x = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if x is _DONE: return
+            yield x
+
+    def map(self, items):
+        """Runs `items` through all the stages and yields the results in order.
+
+        An exception in any stage is re-raised here (after the results of the items before it)."""
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        inputs = [iter(items)] + [self._items(q, stop) for q in queues[:-1]]
+        workers = [threading.Thread(target=self._worker, args=(stage, threads, xs, q, stop), daemon=True)
+                   for stage, threads, xs, q in zip(self.stages, self.threads, inputs, queues)]
+        for w in workers: w.start()
+        try:
+            for x in self._items(queues[-1], stop):
+                if isinstance(x, _Failure): raise x.exc
+                yield x
+        finally:
+            # also stops the workers if the consumer does not want any more results
+            stop.set()
+            for w in workers: w.join()
@@ -13,7 +13,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.profiler import record_function
 
-from huggingface_hub import hf_hub_download
 from fastcore.basics import store_attr
 from fastprogress import progress_bar
 
@@ -248,6 +247,8 @@ class TSARTransformer(nn.Module):
         self.width = width
         self.base_width = 3 * head_width
         self.tunables = tunables
+        self.ttoks_buckets = None
+        self.quantize = None
         if self.stoks_width is None: self.stoks_width = self.width
         if self.ttoks_width is None: self.ttoks_width = self.width
         
@@ -301,8 +302,23 @@ class TSARTransformer(nn.Module):
             xenc = self.encoder(in_ttoks.to(torch.long), positions, lang_emb=lang_embs)
 
         return xenc, positions, cps_emb
+
+    def run_encoder_bucketed(self, in_ttoks, languages, cpss):
+        """Like `run_encoder` but only encodes the shortest of `ttoks_buckets` that fits the text.
+
+        Returns an additional padding mask for the decoder cross-attention (`None` when bucketing is disabled)."""
+        if not self.ttoks_buckets: return (*self.run_encoder(in_ttoks, languages, cpss), None)
+        # the text is padded with EOT tokens (and starts with one)
+        lens = (in_ttoks != self.tokenizer.eot).sum(-1)
+        length = next((b for b in sorted(self.ttoks_buckets) if b >= int(lens.max()) + 2), self.ttoks_len)
+        if len(languages.shape) > 1: languages = languages[:,:length]
+        xenc, positions, cps_emb = self.run_encoder(in_ttoks[:,:length], languages, cpss)
+        # the causal encoder output for the text does not depend on the padding so we only have to make sure
+        # the decoder sees the same number of padding tokens for every bucket (a single one)
+        padding_mask = positions > lens.unsqueeze(1) + 1
+        return xenc, positions, cps_emb, padding_mask
     
-    def forward(self, in_ttoks, out_ttoks, languages, cpss, in_stoks, out_stoks=None, in_stoks_positions=None, loss=True, offset=None, xenc=None, xenc_positions=None, cps_emb=None):
+    def forward(self, in_ttoks, out_ttoks, languages, cpss, in_stoks, out_stoks=None, in_stoks_positions=None, loss=True, offset=None, xenc=None, xenc_positions=None, cps_emb=None, session=None):
         if xenc is None:
             xenc, xenc_positions, cps_emb = self.run_encoder(in_ttoks, languages, cpss)
 
@@ -310,7 +326,7 @@ class TSARTransformer(nn.Module):
             x = (self.embeddings.embedding(in_stoks) + 
                  self.embeddings.positional_embedding[in_stoks_positions] +
                  cps_emb).to(xenc[0].dtype)
-            x = self.decoder(x, in_stoks_positions, xenc.clone(), xenc_positions)
+            x = self.decoder(x, in_stoks_positions, xenc, xenc_positions, session=session)
             logits = self.embeddings.embedding.unembed(x)
             logits = logits * self.tunables.output_mult / (self.width / self.base_width)
 
@@ -336,11 +352,12 @@ class TSARTransformer(nn.Module):
             else:
                 local_filename = ref
         if not local_filename and spec is None:
+            from huggingface_hub import hf_hub_download # slow to import
             local_filename = hf_hub_download(repo_id=repo_id, filename=filename)
         if spec is None:
-            spec = torch.load(local_filename, map_location=device)
+            spec = inference.load_spec(local_filename, device=device)
         model = cls(**spec['config'], tunables=Tunables(**Tunables.upgrade(spec['tunables'])))
-        model.load_state_dict(spec['state_dict'])
+        inference.load_state_dict(model, spec)
         model.eval().to(device)
         return model
 
@@ -372,9 +389,36 @@ class TSARTransformer(nn.Module):
                 m.to(dtype)
             # take care of buffers ([kv]_cache, masks) that are not in the leaf layers
             for bn,b in m.named_buffers(recurse=False):
-                setattr(m,bn,b.to(dtype))
-
-    def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
+                if b.is_floating_point(): setattr(m,bn,b.to(dtype)) # skip the quantized weights
+
+    def quantize_weights(self, quantize):
+        """Quantizes the linear layers of the transformer blocks. `quantize` can be `'int8'` or `'int4'`
+        (weight-only, see `QuantizedLinear`) or `'dynamic'` (int8 weights and activations, CPU only)."""
+        blocks = [*self.encoder.layers, *self.decoder.layers]
+        if quantize == 'dynamic':
+            inference.quantize_dynamic(blocks)
+        else:
+            quantize_linears(blocks, bits={'int8': 8, 'int4': 4}[quantize])
+        self.quantize = quantize
+
+    def optimize(self, max_batch_size=1, dtype=None, torch_compile=True, ttoks_buckets=None, attn_bucket=None, quantize=None, kv_dtype=None, kv_block_size=None):
+        """Prepares the model for inference.
+
+        `ttoks_buckets` (e.g. `(64, 128, 256)`) enables encoding short texts at a shorter length which
+        makes both the encoder and every decoding step cheaper (`torch.compile` traces one graph per bucket).
+        `attn_bucket` (e.g. `128`) makes the decoder self-attention skip the empty part of the KV cache.
+        `dtype` defaults to fp16 on GPUs and to bf16 or fp32 on the CPU (see `inference.default_dtype`).
+        `quantize` quantizes the linear layers of the transformer blocks (see `quantize_weights`), with `'dynamic'`
+        the rest of the model stays in fp32.
+        `kv_dtype=torch.int8` halves the memory used by the K/V caches (so we can fit a larger `max_batch_size`).
+        `kv_block_size` (e.g. `64`) pages the self-attention K/V caches so they only take memory for the tokens
+        we generate (see `BaseDecoder.setup_kv_cache`), `torch.compile` traces one graph per block count if
+        `attn_bucket` is not set."""
+        if dtype is None: dtype = torch.float32 if quantize == 'dynamic' else inference.default_dtype(self.device)
+        self.decoder.attn_bucket = attn_bucket
+        if ttoks_buckets is not None:
+            assert self.tunables.causal_encoder, "length buckets need a causal text encoder"
+            self.ttoks_buckets = ttoks_buckets
         for emb in [self.embeddings.embedding, self.embeddings.embedding]:
             emb.convert_for_eval()
         for l in self.encoder.layers:
@@ -382,10 +426,22 @@ class TSARTransformer(nn.Module):
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len)
+        # before switching the dtypes so we quantize the full precision weights
+        if quantize: self.quantize_weights(quantize)
         self.switch_dtypes(dtype)
-        if torch_compile:
-            self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
+        self.decoder.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len, dtype=dtype, kv_dtype=kv_dtype, block_size=kv_block_size)
+        if torch_compile: self.compile_generate()
+
+    def compile_generate(self):
+        """`torch.compile`s the decoding step for the device the model is on (called by `optimize`)."""
+        attn_bucket = self.decoder.kv_cache_bucket
+        lengths = (len(self.ttoks_buckets or []) + 1) * (math.ceil(self.stoks_len / attn_bucket) if attn_bucket else 1)
+        inference.allow_recompiles(8 * lengths)
+        fullgraph = self.quantize != 'dynamic'
+        # the dynamically quantized layers cannot be traced so we get a graph break around each of them
+        # and the code after the break is compiled separately for every layer
+        if not fullgraph: inference.allow_recompiles(8 * len(self.decoder.layers))
+        self.generate_next = inference.compile(self.generate_next, self.device, fullgraph=fullgraph)
             
     def optimize_training(self):
         # breaks with: Error: accessing tensor output of CUDAGraphs that has been overwritten by a subsequent run.
@@ -397,8 +453,14 @@ class TSARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k):
-        probs, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb)
+    def new_session(self):
+        """Returns a `DecodingSession` with its own K/V caches. Passing a different session to every concurrent call of
+        `generate` (and the other generation methods) lets several threads share one copy of the model."""
+        return self.decoder.new_session()
+
+    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, session=None):
+        probs, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb,
+                        session=session)
         probs = probs[:,-1]
         probs[self.embeddings.embedding.codes:] = -torch.inf
         return inference.sample(probs, T, top_k)
@@ -416,9 +478,11 @@ class TSARTransformer(nn.Module):
         return ttoks, cpss, langs
     
     @torch.no_grad()
-    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True):
+    def encode_text(self, txt, cps=15, lang="en"):
+        """Tokenizes `txt` and returns the text tokens, languages and cps in the format expected by `run_encoder`.
+
+        `lang` can also be a list of languages if `txt` is a list of text fragments."""
         self.ensure_tokenizer()
-        N = N or self.stoks_len
         dev = self.device
         ttoks = []
         langs = []
@@ -436,64 +500,238 @@ class TSARTransformer(nn.Module):
             lang0 = lang
             ttoks = self.tokenizer.encode(txt)
             langs = torch.tensor([languages.to_id(lang)], device=dev)
+        assert len(ttoks) + 2 <= self.ttoks_len, f"the text is too long ({len(ttoks)} bytes), please use Pipeline.generate_long"
         ttoks = torch.tensor(ttoks, device=dev)
-        ttoks = F.pad(ttoks, (1, self.ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot)
+        ttoks = F.pad(ttoks, (1, self.ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot).unsqueeze(0)
         cpss = torch.tensor([cps], device=dev)
-        T = torch.tensor(T, device=dev)
         if not isinstance(langs, torch.Tensor):
             langs = torch.tensor(langs, device=dev)
-            langs = F.pad(langs, (1, self.ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
+            langs = F.pad(langs, (1, self.ttoks_len - len(langs) - 1), value=languages.to_id(lang0)).unsqueeze(0)
+        return ttoks, langs, cpss
+
+    @torch.no_grad()
+    def prefill_prompt(self, txt, stoks_prompt, cps=15, lang="en", session=None):
+        """Runs the encoder and prefills the decoder with `stoks_prompt` once, returns an `inference.PromptSnapshot`
+        that `generate` and `T2SScheduler.submit` can restore instead of doing it again for every request.
+
+        The snapshot is only valid for the same `txt`, `cps` and `lang`. Uses the first row of the KV cache
+        (so it cannot run while a `T2SScheduler` is busy with the same `session`)."""
+        self.ensure_tokenizer()
+        dev = self.device
+        ttoks, langs, cpss = self.encode_text(txt, cps=cps, lang=lang)
+        n = len(stoks_prompt)
+        toks = torch.zeros((1,n+1), dtype=torch.long, device=dev)
+        toks[:,0] = self.stoks_codes + self.tunables.padding_token_offset
+        toks[:,1:] = stoks_prompt
+        encoder_state = self.run_encoder_bucketed(ttoks, langs, cpss)
+        xenc, xenc_positions, cps_emb, padding_mask = encoder_state
+        self.decoder.prime_cross_kv_cache(xenc, xenc_positions, padding_mask=padding_mask, session=session)
+        try:
+            # the last prompt token is left for the first decoding step which samples the token after it
+            self.decoder.bound_self_attention(n, session=session)
+            self.decoder.reserve_kv_cache(1, n, session=session)
+            if n > 0:
+                self(None, None, None, None, toks[:,:n], in_stoks_positions=torch.arange(n, device=dev), loss=None,
+                     xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb, session=session)
+            kv = self.decoder.snapshot_kv_cache(0, n, session=session)
+        finally:
+            self.decoder.invalidate_cross_kv_cache(session=session)
+            self.decoder.bound_self_attention(None, session=session)
+            self.decoder.release_kv_cache(session=session)
+        return inference.PromptSnapshot((ttoks, langs, cpss), encoder_state, toks, kv)
+
+    @torch.no_grad()
+    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True, prompt_snapshot=None,
+                 draft=None, draft_tokens=4, session=None):
+        """Generates semantic tokens for `txt` (`bs` alternative samples).
+
+        `prompt_snapshot` (see `prefill_prompt`) replaces `stoks_prompt` and skips the encoder and the prompt prefill.
+
+        With a smaller T2S `draft` model (e.g. a `tiny` one for a `small` model) we use speculative decoding: the draft
+        model proposes `draft_tokens` tokens and this model checks all of them in a single forward pass
+        (see `generate_speculative`).
+
+        `session` (see `new_session`) holds the K/V caches, by default we use the ones set up by `optimize`."""
+        if draft is not None:
+            assert bs == 1 and prompt_snapshot is None, "speculative decoding only supports bs=1 without prompt snapshots"
+            return self.generate_speculative(txt, draft, k=draft_tokens, cps=cps, lang=lang, stoks_prompt=stoks_prompt, N=N, T=T, top_k=top_k, step=step,
+                                             session=session)
+        self.ensure_tokenizer()
+        N = N or self.stoks_len
+        dev = self.device
+        ttoks, langs, cpss = self.encode_text(txt, cps=cps, lang=lang)
+        T = torch.tensor(T, device=dev)
 
         toks = torch.zeros((bs,N), dtype=torch.long, device=dev)
         toks[:,0] = self.stoks_codes + self.tunables.padding_token_offset
         start = 0
-        if stoks_prompt is not None:
+        if prompt_snapshot is not None:
+            assert stoks_prompt is None, "the prompt is already in the snapshot"
+            assert prompt_snapshot.matches(ttoks, langs, cpss), "the prompt snapshot was made for a different text"
+            start = prompt_snapshot.toks.shape[1] - 1
+            toks[:,:start+1] = prompt_snapshot.toks
+        elif stoks_prompt is not None:
             toks[:,1:len(stoks_prompt)+1] = stoks_prompt
             start = len(stoks_prompt)
         it = range(start+1,N-1)
+        if prompt_snapshot is not None: it = range(start,N-1)
         if show_progress_bar: it = progress_bar(it)
 
         toks_positions = torch.arange(N, device=dev)
         with record_function("encode"):
-            ttoks = ttoks.repeat(bs, 1)
-            langs, cpss = [x.repeat(bs) for x in (langs, cpss)]
-            xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
+            # all the batch rows share the same text so we run the encoder only once
+            if prompt_snapshot is not None:
+                xenc, xenc_positions, cps_emb, padding_mask = prompt_snapshot.encoder_state
+            else:
+                xenc, xenc_positions, cps_emb, padding_mask = self.run_encoder_bucketed(ttoks, langs, cpss)
             toks_positions = torch.arange(N+1, device=dev)
-        
-        with record_function("prefill"):
-            toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-        with inference.inference_context():
-            for i in it:
-                toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-                if (toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset).all(): return toks[:,1:i+1]
-
-                # for profiling, debugging or early exit
-                if step is not None: step()
+            self.decoder.prime_cross_kv_cache(xenc, xenc_positions, padding_mask=padding_mask, session=session)
+            xenc = xenc.expand(bs, -1, -1)
+
+        try:
+            with record_function("prefill"):
+                if prompt_snapshot is not None:
+                    self.decoder.restore_kv_cache(prompt_snapshot.kv, bs, session=session)
+                else:
+                    self.decoder.bound_self_attention(start+1, session=session)
+                    self.decoder.reserve_kv_cache(bs, start+1, session=session)
+                    toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k,
+                                                        session=session)[:,0]
+            with inference.inference_context():
+                for i in it:
+                    self.decoder.bound_self_attention(i+1, session=session)
+                    self.decoder.reserve_kv_cache(bs, i+1, session=session)
+                    toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k, session=session)[:,0]
+                    if (toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset).all(): return toks[:,1:i+1]
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+        finally:
+            self.decoder.invalidate_cross_kv_cache(session=session)
+            self.decoder.bound_self_attention(None, session=session)
+            self.decoder.release_kv_cache(session=session)
         return toks[:,1:]
     
+    def _decoder_logits(self, toks, toks_positions, cps_emb, xenc, xenc_positions, session=None):
+        # the logits for all the positions of `toks` (which are also added to the self-attention KV cache)
+        self.decoder.bound_self_attention(int(toks_positions[-1]) + 1, session=session)
+        self.decoder.reserve_kv_cache(1, int(toks_positions[-1]) + 1, session=session)
+        logits, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb,
+                         session=session)
+        return logits[0]
+
     @torch.no_grad()
-    def generate_batch(self, txts, N=None, T=1.1, top_k=7, show_progress_bar=True):
+    def generate_speculative(self, txt, draft, k=4, cps=15, lang="en", stoks_prompt=None, N=None, T=0.7, top_k=None, step=None, session=None):
+        """Speculative decoding with a smaller `draft` T2S model (with the same semantic token vocabulary).
+
+        In every round the draft model samples `k` tokens one by one and this model computes the logits for all of them
+        in a single forward pass. The draft tokens are accepted or rejected with `inference.speculative_sample` so the
+        result follows the same distribution (with the same `T` and `top_k`) as `generate`.
+        The number of drafted and accepted tokens is stored in `speculative_stats`. With a `session` the draft model
+        also gets a new session of its own."""
         self.ensure_tokenizer()
-        N = self.stoks_len
+        draft.ensure_tokenizer()
+        eot = self.stoks_codes + self.tunables.padding_token_offset
+        assert draft.stoks_codes + draft.tunables.padding_token_offset == eot, "the draft model has to use the same semantic tokens"
+        N = N or self.stoks_len
         dev = self.device
-        ttoks = []
-        for txt in txts:
-            ttoks_ = torch.tensor(self.tokenizer.encode(txt), device=dev)
-            ttoks_ = F.pad(ttoks_, (0, self.ttoks_len - len(ttoks_)), value=self.tokenizer.eot).unsqueeze(0)
-            ttoks.append(ttoks_)
-        ttoks = torch.cat(ttoks, dim=0)
-        toks = torch.zeros((len(ttoks),N), dtype=torch.long, device=dev)
-        it = range(N)
-        if show_progress_bar: it = progress_bar(it)
-        for i in it:
-            p, _ = self(ttoks, toks[:,:i], loss=None)
-            last_p = p[:,-1]
-            if top_k:
-                last_p[last_p < torch.topk(last_p, top_k).values[:,-1,None]] = -torch.inf
-            tok = torch.multinomial((last_p / float(T)).softmax(-1), 1)
-            toks[:,i] = tok[:,0]
-            if (toks[:,i] == self.stoks_codes-1).all(): return toks[:,:i]
-        return toks
+        T = torch.tensor(T, device=dev)
+        toks = torch.zeros((1,N), dtype=torch.long, device=dev)
+        toks[:,0] = eot
+        length = 1 # the number of known tokens
+        if stoks_prompt is not None:
+            toks[:,1:len(stoks_prompt)+1] = stoks_prompt
+            length += len(stoks_prompt)
+        toks_positions = torch.arange(N, device=dev)
+
+        models = [self, draft]
+        sessions = [session, draft.new_session() if session is not None else None]
+        conds = []
+        with record_function("encode"):
+            for model, sess in zip(models, sessions):
+                ttoks, langs, cpss = model.encode_text(txt, cps=cps, lang=lang)
+                xenc, xenc_positions, cps_emb, padding_mask = model.run_encoder_bucketed(ttoks, langs, cpss)
+                model.decoder.prime_cross_kv_cache(xenc, xenc_positions, padding_mask=padding_mask, session=sess)
+                conds.append((cps_emb, xenc, xenc_positions, sess))
+        def logits(model, cond, start, end):
+            return model._decoder_logits(toks[:,start:end], toks_positions[start:end], *cond)
+
+        drafted, accepted = 0, 0
+        try:
+            with inference.inference_context():
+                # the last known token is always fed in the next round
+                if length > 1:
+                    for model, cond in zip(models, conds): logits(model, cond, 0, length-1)
+                draft_length = length - 1 # the number of positions in the draft model KV cache
+                while length < N:
+                    n = min(k, N - length - 1)
+                    draft_logits = []
+                    for j in range(n):
+                        # after a fully accepted round the draft model has to catch up by two tokens
+                        q = logits(draft, conds[1], draft_length, length+j)[-1]
+                        draft_length = length + j
+                        toks[0,length+j] = inference.sample(q, T, top_k)[0]
+                        draft_logits.append(q)
+                    p = logits(self, conds[0], length-1, length+n)
+                    draft_logits = torch.stack(draft_logits) if n else p.new_zeros((0, p.shape[-1]))
+                    new = inference.speculative_sample(p, draft_logits, toks[0,length:length+n], T, top_k)
+                    drafted += n
+                    accepted += len(new) - 1
+                    toks[0,length:length+len(new)] = new
+                    draft_length = min(draft_length, length + len(new) - 1)
+                    ends = (new == eot).nonzero()
+                    if len(ends): return toks[:,1:length+int(ends[0,0])]
+                    length += len(new)
+
+                    # for profiling, debugging or early exit
+                    if step is not None: step()
+        finally:
+            self.speculative_stats = dict(drafted=drafted, accepted=accepted)
+            for model, sess in zip(models, sessions):
+                model.decoder.invalidate_cross_kv_cache(session=sess)
+                model.decoder.bound_self_attention(None, session=sess)
+                model.decoder.release_kv_cache(session=sess)
+        return toks[:,1:]
+
+    @torch.no_grad()
+    def generate_candidates(self, txt, n=4, **kwargs):
+        """Samples `n` alternative semantic token sequences for `txt` with a single encoder pass.
+
+        Returns a list of tensors, each one cut at its own end-of-text token."""
+        eot = self.stoks_codes + self.tunables.padding_token_offset
+        candidates = []
+        for row in self.generate(txt, bs=n, **kwargs):
+            ends = (row == eot).nonzero()
+            candidates.append(row[:ends[0,0]] if len(ends) else row)
+        return candidates
+
+    @torch.no_grad()
+    def generate_batch(self, txts, cps=15, lang="en", N=None, T=0.7, top_k=None, show_progress_bar=True, step=None, session=None):
+        """Generates semantic tokens for a list of different texts, up to `max_batch_size` (see `optimize`) at once.
+
+        `cps` and `lang` can also be lists with a value for every text. Every row is retired at its own end-of-text token
+        and its K/V cache rows are immediately reused for the next text (see `continuous_batching.T2SScheduler`).
+        Returns a list of token tensors (without the end-of-text tokens)."""
+        from whisperspeech.continuous_batching import T2SScheduler
+        self.ensure_tokenizer()
+        cpss = cps if isinstance(cps, (list, tuple)) else [cps] * len(txts)
+        langs = lang if isinstance(lang, (list, tuple)) else [lang] * len(txts)
+        scheduler = T2SScheduler(self, T=T, top_k=top_k, session=session)
+        reqs = [scheduler.submit(txt, cps=cps, lang=lang, N=N) for txt, cps, lang in zip(txts, cpss, langs)]
+        pb = progress_bar(range(len(reqs))) if show_progress_bar else None
+        if pb is not None: pb.update(0)
+        finished = 0
+        try:
+            while scheduler.busy:
+                finished += len(scheduler.step())
+                if pb is not None: pb.update(finished)
+
+                # for profiling, debugging or early exit
+                if step is not None: step()
+        finally:
+            # free the K/V cache rows if we were interrupted
+            for req in reqs: scheduler.cancel(req)
+        return [req.stoks for req in reqs]
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 16
 def _make_model(size:str, tunables:Tunables=Tunables(), dataset=None, **kwargs):
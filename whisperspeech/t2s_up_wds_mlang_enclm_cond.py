@@ -497,7 +497,7 @@ class TSARTransformer(nn.Module):
         for l in self.decoder.layers:
             l.attn.convert_for_eval()
             l.cross_attn.convert_for_eval()
-            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len)
+            l.setup_kv_cache(max_batch_size, self.stoks_len, self.ttoks_len, dtype=dtype, device=self.device)
         self.switch_dtypes(dtype)
         if torch_compile:
             self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
@@ -0,0 +1,161 @@
+"""A multi-process CPU serving pool with shared weights."""
+
+__all__ = ['core_groups', 'WorkerPool']
+
+import os
+import threading
+import traceback
+import collections
+import multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import Future
+import torch
+
+from whisperspeech.bundle import bundle_contents
+
+def core_groups(workers, cores=None):
+    """Splits `cores` (by default all the cores this process may run on) into `workers` groups of neighbouring cores.
+
+    With more workers than cores every worker gets a single core and the cores are shared round-robin."""
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    assert workers > 0 and len(cores) > 0
+    if workers > len(cores): return [[cores[i % len(cores)]] for i in range(workers)]
+    size, extra = divmod(len(cores), workers)
+    groups, start = [], 0
+    for i in range(workers):
+        end = start + size + (i < extra)
+        groups.append(list(cores[start:end]))
+        start = end
+    return groups
+
+class _Error:
+    # an exception raised in a worker (the exception itself may not be picklable)
+    def __init__(self, msg): self.msg = msg
+
+def _worker(cores, conn):
+    if hasattr(os, 'sched_setaffinity'): os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    contents, speaker_cache, default_speaker, torch_compile = conn.recv()
+    from whisperspeech.pipeline import Pipeline
+    pipe = Pipeline(bundle=contents, device='cpu', torch_compile=torch_compile, speaker_cache=speaker_cache)
+    pipe.default_speaker = default_speaker
+    while True:
+        try:
+            req = conn.recv()
+        except EOFError:
+            return # the pool is gone
+        if req is None: return
+        method, args, kwargs = req
+        try:
+            # plain arrays are pickled through the pipe, tensors would need a shared memory segment per result
+            conn.send(getattr(pipe, method)(*args, **kwargs).cpu().numpy())
+        except Exception:
+            conn.send(_Error(traceback.format_exc()))
+
+class _Worker:
+    # a worker process, our end of its connection and the future of the request it is working on
+    def __init__(self, ctx, args, cores):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker, args=(cores, child_conn), daemon=True)
+        self.process.start()
+        child_conn.close()
+        # the shared tensors are passed as file descriptors, more than the process arguments can take with forkserver
+        self.conn.send(args)
+        self.future = None
+
+class WorkerPool:
+    """Serves `Pipeline` requests with several worker processes on one CPU host.
+
+    The models of `pipe` are loaded only once: their parameters and buffers are moved into shared memory
+    and every worker rebuilds the models around them (see `bundle_contents`), so all of them use the same copy
+    of the weights. The workers are started with `forkserver` (or `spawn`) and not forked from this process
+    so they do not inherit its threads or its OpenMP state. The scripts using the pool should therefore
+    create it under `if __name__ == '__main__':`.
+
+    Every worker is pinned to its own group of cores (see `core_groups`, by default one worker for every 4 cores)
+    and runs PyTorch with that many threads. The requests wait in a single queue and every idle worker gets
+    the next one so long and short texts are balanced automatically. If a worker process dies (e.g. it is
+    killed by the OOM killer) the request it was working on fails and the pool continues without it.
+
+    With `torch_compile` every worker compiles its own models (the first requests will be slow)."""
+    methods = ('generate', 'generate_long')
+
+    def __init__(self, pipe, workers=None, cores=None, torch_compile=False):
+        assert pipe.device == 'cpu', "the worker pool only supports CPU inference"
+        if workers is None: workers = max(1, len(core_groups(1, cores)[0]) // 4)
+        self.groups = core_groups(workers, cores)
+        for m in [pipe.t2s, pipe.s2a, pipe.vocoder.vocos]: m.share_memory()
+        ctx = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        args = (bundle_contents(pipe), pipe.speaker_cache, pipe.default_speaker, torch_compile)
+        self.workers = [_Worker(ctx, args, cores) for cores in self.groups]
+        self.queue = collections.deque() # (future, request) pairs waiting for an idle worker
+        self.lock = threading.Lock()
+        self.closing = False
+        self.wakeup_recv, self.wakeup_send = multiprocessing.Pipe(duplex=False)
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            with self.lock:
+                for w in self.workers:
+                    if w.future is None and self.queue:
+                        w.future, req = self.queue.popleft()
+                        try: w.conn.send(req)
+                        except OSError: pass # the worker is dead, we will see its sentinel
+                if self.closing and not self.queue and all(w.future is None for w in self.workers): return
+                ready = [self.wakeup_recv, *[w.conn for w in self.workers], *[w.process.sentinel for w in self.workers]]
+            ready = wait(ready)
+            while self.wakeup_recv.poll(): self.wakeup_recv.recv_bytes()
+            for w in list(self.workers):
+                if w.conn in ready:
+                    try:
+                        result = w.conn.recv()
+                    except (EOFError, OSError):
+                        pass # the worker is dead (the connection is reset if it did not read our last request)
+                    else:
+                        future, w.future = w.future, None
+                        if isinstance(result, _Error): future.set_exception(RuntimeError(f"worker failed:\n{result.msg}"))
+                        else: future.set_result(torch.from_numpy(result))
+                if w.process.sentinel in ready: self._lost(w)
+
+    def _lost(self, w):
+        w.process.join()
+        failed = [] if w.future is None else [w.future]
+        with self.lock:
+            self.workers.remove(w)
+            if not self.workers:
+                failed += [future for future, req in self.queue]
+                self.queue.clear()
+        for future in failed:
+            future.set_exception(RuntimeError(f"worker process died (exit code {w.process.exitcode})"))
+
+    def submit(self, text, method='generate', **kwargs):
+        """Queues `text` for `Pipeline.generate` (or `generate_long`) with the given arguments and returns
+        a `concurrent.futures.Future` of the audio tensor."""
+        assert method in self.methods, f"unsupported method: {method}"
+        future = Future()
+        with self.lock:
+            if not self.workers: raise RuntimeError("all the worker processes died")
+            self.queue.append((future, (method, (text,), kwargs)))
+            self.wakeup_send.send_bytes(b'')
+        return future
+
+    def map(self, texts, **kwargs):
+        """Generates all the `texts` in parallel and returns the audio tensors in order."""
+        return [f.result() for f in [self.submit(text, **kwargs) for text in texts]]
+
+    def close(self):
+        """Finishes all the submitted requests and stops the workers."""
+        with self.lock:
+            self.closing = True
+            self.wakeup_send.send_bytes(b'')
+        self.dispatcher.join()
+        for w in self.workers:
+            try: w.conn.send(None)
+            except OSError: pass
+        for w in self.workers: w.process.join()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()